@@ -0,0 +1,470 @@
+#!/usr/bin/env python
+"""
+Benchmark harness for translate_pdf.py.
+
+Four commands:
+  make-pdfs    Generate synthetic multi-page PDFs with Devanagari, Gujarati and
+               English text at fixed page counts, always the same for a given seed.
+  stub-server  Serve a local fake of the Vision images:annotate REST endpoint with
+               configurable latency and error rates.
+  run          Start the stub server and run translate_pdf.py against every PDF for
+               each pipeline configuration, reporting pages/sec, p50/p99 per-page
+               latency and peak RSS.
+  check        Smoke check of the page analysis functions of translate_pdf.py on a
+               generated scanned page, without any OCR.
+
+Example:
+    python benchmark_ocr.py make-pdfs -o /tmp/bench --pages 10 50 200 --scanned
+    python benchmark_ocr.py run -i /tmp/bench --latency-ms 300 --error-rate 0.02
+
+Pipeline configurations are read from a JSON file (--configs) holding a list of
+{"name": ..., "args": [...]} entries, where args are extra translate_pdf.py options.
+"""
+
+import argparse
+import base64
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+import fitz  # PyMuPDF
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+TRANSLATE_SCRIPT = os.path.join(SCRIPT_DIR, "translate_pdf.py")
+
+DEFAULT_PAGE_COUNTS = [10, 50, 200]
+DEFAULT_SEED = 42
+SCAN_DPI = 150
+RSS_SAMPLE_SECONDS = 0.1
+
+HINDI_WORDS = [
+    "जैन", "धर्म", "आत्मा", "ज्ञान", "दर्शन", "चारित्र", "मोक्ष", "तीर्थंकर", "भगवान",
+    "महावीर", "अहिंसा", "सत्य", "अपरिग्रह", "सम्यक्", "जीव", "अजीव", "कर्म", "बंध",
+    "निर्जरा", "संवर", "आस्रव", "पुण्य", "पाप", "स्वाध्याय", "प्रवचन", "शास्त्र", "गाथा",
+]
+GUJARATI_WORDS = [
+    "જૈન", "ધર્મ", "આત્મા", "જ્ઞાન", "દર્શન", "ચારિત્ર", "મોક્ષ", "તીર્થંકર", "ભગવાન",
+    "મહાવીર", "અહિંસા", "સત્ય", "જીવ", "અજીવ", "કર્મ", "પ્રવચન", "શાસ્ત્ર", "ગાથા",
+]
+ENGLISH_WORDS = [
+    "soul", "knowledge", "perception", "conduct", "liberation", "karma", "bondage",
+    "scripture", "discourse", "verse", "chapter", "non-violence", "truth", "self",
+]
+LANGUAGES = {
+    "hindi": HINDI_WORDS,
+    "gujarati": GUJARATI_WORDS,
+    "english": ENGLISH_WORDS,
+}
+
+# Default pipeline configurations. A high --max-rpm keeps the client side rate
+# limiter out of the way so the pipeline itself is measured.
+DEFAULT_CONFIGS = [
+    {"name": "threads", "args": ["--max-rpm", "100000"]},
+    {"name": "threads-batch4", "args": ["--max-rpm", "100000", "--batch-size", "4"]},
+    {"name": "threads-jpeg", "args": ["--max-rpm", "100000", "--image-format", "jpeg"]},
+    {"name": "asyncio", "args": ["--max-rpm", "100000", "--engine", "asyncio"]},
+]
+
+
+def make_paragraph(rng, words, length):
+    """A paragraph of `length` random words"""
+    return " ".join(rng.choice(words) for _ in range(length))
+
+
+def make_pdf(path, pages, seed, scanned):
+    """Write a synthetic PDF where each page mixes Hindi, Gujarati and English paragraphs.
+    With `scanned`, every page is replaced by an image of itself so there is no text layer."""
+    rng = random.Random(f"{seed}-{pages}")
+    document = fitz.open()
+    for page_num in range(pages):
+        page = document.new_page(width=595, height=842)
+        header = f"<p style='text-align:center'>Synthetic book {pages} - page {page_num + 1}</p>"
+        paragraphs = []
+        for words in (HINDI_WORDS, GUJARATI_WORDS, HINDI_WORDS, ENGLISH_WORDS, GUJARATI_WORDS):
+            paragraphs.append(f"<p>{make_paragraph(rng, words, rng.randint(30, 60))}</p>")
+        page.insert_htmlbox(fitz.Rect(50, 20, 545, 60), header)
+        page.insert_htmlbox(fitz.Rect(50, 70, 545, 800), "".join(paragraphs),
+                            css="p { font-size: 13px; line-height: 1.5; }")
+
+    if scanned:
+        scanned_document = fitz.open()
+        for page in document:
+            pix = page.get_pixmap(dpi=SCAN_DPI, colorspace=fitz.csGRAY)
+            new_page = scanned_document.new_page(width=page.rect.width, height=page.rect.height)
+            new_page.insert_image(new_page.rect, stream=pix.tobytes("png"))
+        document.close()
+        document = scanned_document
+
+    document.save(path, garbage=3, deflate=True)
+    document.close()
+
+
+def make_pdfs(output_dir, page_counts, seed, scanned):
+    """Generate one synthetic PDF per page count, returns their paths"""
+    os.makedirs(output_dir, exist_ok=True)
+    paths = []
+    for pages in page_counts:
+        path = os.path.join(output_dir, f"synthetic_{pages}.pdf")
+        start = time.time()
+        make_pdf(path, pages, seed, scanned)
+        print(f"Created {path} ({pages} pages, {os.path.getsize(path) / (1024 * 1024):.1f} MB) "
+              f"in {time.time() - start:.1f}s")
+        paths.append(path)
+    return paths
+
+
+class StubSettings:
+    """Behaviour of the fake Vision endpoint"""
+    def __init__(self, latency_ms=200, jitter_ms=50, per_image_ms=0, error_rate=0.0,
+                 unavailable_rate=0.0, words=60, seed=DEFAULT_SEED):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.per_image_ms = per_image_ms
+        self.error_rate = error_rate
+        self.unavailable_rate = unavailable_rate
+        self.words = words
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.images = 0
+        self.errors = 0
+
+    def random(self):
+        with self.lock:
+            return self.rng.random()
+
+
+def fake_annotation(content, words):
+    """A full_text_annotation in REST JSON form with `words` words laid out in lines.
+    The words are chosen from the image content so the same page always gets the same text."""
+    rng = random.Random(content[:4096])
+    language_words = list(LANGUAGES.values())
+    paragraphs = []
+    text_lines = []
+    y = 10
+    for _ in range(max(1, words // 20)):
+        vocabulary = rng.choice(language_words)
+        paragraph_words = []
+        x = 10
+        for _ in range(20):
+            word = rng.choice(vocabulary)
+            width = 12 * len(word)
+            paragraph_words.append({
+                "boundingBox": {"vertices": [
+                    {"x": x, "y": y}, {"x": x + width, "y": y},
+                    {"x": x + width, "y": y + 20}, {"x": x, "y": y + 20},
+                ]},
+                "symbols": [{"text": symbol} for symbol in word],
+                "confidence": 0.95,
+            })
+            x += width + 8
+        paragraphs.append({"words": paragraph_words})
+        text_lines.append(" ".join("".join(s["text"] for s in w["symbols"]) for w in paragraph_words))
+        y += 30
+    return {
+        "text": "\n".join(text_lines) + "\n",
+        "pages": [{"width": 1200, "height": 1700, "blocks": [{"paragraphs": paragraphs}]}],
+    }
+
+
+def make_handler(settings):
+    """Request handler class serving images:annotate with the given settings"""
+    class StubHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def send_json(self, status, body):
+            data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            body = json.loads(self.rfile.read(length) or b"{}")
+            path = urlparse(self.path).path
+            if not path.rstrip("/").endswith("images:annotate"):
+                self.send_json(404, {"error": {"code": 404, "message": f"Unknown path {path}", "status": "NOT_FOUND"}})
+                return
+
+            requests = body.get("requests", [])
+            with settings.lock:
+                settings.requests += 1
+                settings.images += len(requests)
+
+            delay_ms = settings.latency_ms + settings.per_image_ms * len(requests)
+            if settings.jitter_ms:
+                delay_ms += (settings.random() * 2 - 1) * settings.jitter_ms
+            time.sleep(max(0.0, delay_ms) / 1000.0)
+
+            draw = settings.random()
+            if draw < settings.error_rate:
+                with settings.lock:
+                    settings.errors += 1
+                self.send_json(429, {"error": {"code": 429, "message": "Quota exceeded (stub)", "status": "RESOURCE_EXHAUSTED"}})
+                return
+            if draw < settings.error_rate + settings.unavailable_rate:
+                with settings.lock:
+                    settings.errors += 1
+                self.send_json(503, {"error": {"code": 503, "message": "Service unavailable (stub)", "status": "UNAVAILABLE"}})
+                return
+
+            responses = []
+            for request in requests:
+                content = base64.b64decode(request.get("image", {}).get("content", ""))
+                responses.append({"fullTextAnnotation": fake_annotation(content, settings.words)})
+            self.send_json(200, {"responses": responses})
+
+    return StubHandler
+
+
+def start_stub_server(settings, host="127.0.0.1", port=0):
+    """Start the stub server in a background thread, returns (server, endpoint url)"""
+    server = ThreadingHTTPServer((host, port), make_handler(settings))
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+
+def process_tree_rss(pid):
+    """Resident memory in bytes of a process and all its descendants, read from /proc"""
+    total = 0
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        try:
+            with open(f"/proc/{current}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1]) * 1024
+                        break
+            for task in os.listdir(f"/proc/{current}/task"):
+                with open(f"/proc/{current}/task/{task}/children") as f:
+                    pending.extend(int(child) for child in f.read().split())
+        except (FileNotFoundError, ProcessLookupError, PermissionError):
+            continue
+    return total
+
+
+def run_translate(pdf_path, endpoint, config):
+    """Run translate_pdf.py once on a PDF, returns its statistics plus peak RSS"""
+    with tempfile.TemporaryDirectory() as tmp:
+        stats_path = os.path.join(tmp, "stats.json")
+        log_path = os.path.join(tmp, "run.log")
+        command = [sys.executable, TRANSLATE_SCRIPT, "-f", pdf_path, "--no-cache",
+                   "--vision-endpoint", endpoint, "--stats-json", stats_path] + config.get("args", [])
+        with open(log_path, "w") as log:
+            process = subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT)
+            peak_rss = 0
+            can_sample = os.path.exists(f"/proc/{process.pid}")
+            while True:
+                if can_sample:
+                    peak_rss = max(peak_rss, process_tree_rss(process.pid))
+                pid, status, usage = os.wait4(process.pid, os.WNOHANG)
+                if pid:
+                    process.returncode = os.waitstatus_to_exitcode(status)
+                    break
+                time.sleep(RSS_SAMPLE_SECONDS)
+        # ru_maxrss is in KB on Linux, covers only the main process
+        peak_rss = max(peak_rss, usage.ru_maxrss * 1024)
+
+        if process.returncode != 0 or not os.path.exists(stats_path):
+            with open(log_path) as f:
+                tail = f.read()[-2000:]
+            raise RuntimeError(f"translate_pdf.py failed on {pdf_path} with {config['name']}:\n{tail}")
+        with open(stats_path) as f:
+            stats = json.load(f)
+    stats["peak_rss"] = peak_rss
+    return stats
+
+
+def load_configs(path):
+    """Pipeline configurations from a JSON file, the defaults without one"""
+    if not path:
+        return DEFAULT_CONFIGS
+    with open(path, encoding="utf-8") as f:
+        configs = json.load(f)
+    for config in configs:
+        if "name" not in config:
+            raise ValueError(f"Configuration without a name in {path}: {config}")
+    return configs
+
+
+def list_pdfs(paths):
+    """PDF files given directly or found in the given directories"""
+    pdfs = []
+    for path in paths:
+        if os.path.isdir(path):
+            pdfs.extend(sorted(os.path.join(path, name) for name in os.listdir(path)
+                               if name.lower().endswith(".pdf")))
+        else:
+            pdfs.append(path)
+    return pdfs
+
+
+def run_benchmark(args):
+    """Run every configuration against every PDF and print a results table"""
+    pdfs = list_pdfs(args.input)
+    if not pdfs:
+        print("No PDF files to benchmark")
+        return 1
+    configs = load_configs(args.configs)
+    settings = StubSettings(args.latency_ms, args.jitter_ms, args.per_image_ms,
+                            args.error_rate, args.unavailable_rate, args.words, args.seed)
+    server, endpoint = start_stub_server(settings)
+    print(f"Stub Vision endpoint: {endpoint}")
+
+    results = []
+    try:
+        for pdf_path in pdfs:
+            for config in configs:
+                for repeat in range(args.repeat):
+                    stats = run_translate(pdf_path, endpoint, config)
+                    result = {"pdf": os.path.basename(pdf_path), "config": config["name"], "repeat": repeat}
+                    result.update(stats)
+                    results.append(result)
+                    print(f"{result['pdf']:<24} {result['config']:<18} "
+                          f"{stats['pages']:>5} pages  {stats['pages_per_second']:>7.2f} pages/s  "
+                          f"p50 {stats['latency_p50']:>6.2f}s  p99 {stats['latency_p99']:>6.2f}s  "
+                          f"peak RSS {stats['peak_rss'] / (1024 * 1024):>7.1f} MB  "
+                          f"retries {stats['retries']}  failed {stats['failed_pages']}")
+    finally:
+        server.shutdown()
+
+    print(f"Stub served {settings.requests} requests ({settings.images} images, {settings.errors} injected errors)")
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=1)
+        print(f"Results written to {args.output}")
+    return 0
+
+
+def run_checks():
+    """Call the page analysis functions of translate_pdf.py on a generated scanned
+    page and report the ones that fail. Returns the exit status."""
+    sys.path.insert(0, SCRIPT_DIR)
+    import translate_pdf
+
+    failures = []
+
+    def check(name, function):
+        try:
+            result = function()
+        except Exception as e:
+            result = f"{type(e).__name__}: {e}"
+        if result is not True:
+            failures.append(name)
+        print(f"{'ok  ' if result is True else 'FAIL'} {name}{'' if result is True else f' ({result})'}")
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "check.pdf")
+        make_pdf(path, 1, DEFAULT_SEED, scanned=True)
+        _, options = translate_pdf.parse_args(["-f", path, "--adaptive-dpi", "--deskew"])
+        document = fitz.open(path)
+        page = document[0]
+        try:
+            # Body text of 13 px must not be rendered larger than at the fixed zoom
+            check("analyse_page adaptive + deskew", lambda: (
+                translate_pdf.MIN_ZOOM <= translate_pdf.analyse_page(page, None, True, True)[0] <= translate_pdf.RENDER_ZOOM))
+            check("extract_page_as_image adaptive + deskew", lambda: (
+                translate_pdf.extract_page_as_image(document, 0, 0, 0, options)[0] is not None))
+            check("page_row_profile", lambda: (
+                len(translate_pdf.page_row_profile(path, 0)) == int(page.rect.height * translate_pdf.PROBE_ZOOM)))
+        finally:
+            document.close()
+
+        # --hybrid: a scan with a one-line caption as text still needs OCR, a
+        # page with real text doesn't
+        caption_page = fitz.open(path)
+        caption_page[0].insert_text((50, 830), "Chapter 3 - Samyag Darshan, page 41", fontsize=9)
+        text_page = fitz.open()
+        rng = random.Random(DEFAULT_SEED)
+        text_page.new_page(width=595, height=842).insert_text(
+            (50, 72), "\n".join(make_paragraph(rng, ENGLISH_WORDS, 10) for _ in range(40)), fontsize=11)
+        try:
+            check("extract_text_layer scan with caption", lambda: (
+                translate_pdf.extract_text_layer(caption_page[0], 0, 0) is None))
+            check("extract_text_layer text page", lambda: (
+                translate_pdf.extract_text_layer(text_page[0], 0, 0) is not None))
+        finally:
+            caption_page.close()
+            text_page.close()
+
+    print(f"{len(failures)} of the checks failed" if failures else "All checks passed")
+    return 1 if failures else 0
+
+def add_stub_arguments(parser):
+    """Options controlling the fake Vision endpoint"""
+    parser.add_argument("--latency-ms", type=float, default=200, help="Base latency of each request")
+    parser.add_argument("--jitter-ms", type=float, default=50, help="Random +/- variation of the latency")
+    parser.add_argument("--per-image-ms", type=float, default=0, help="Extra latency for every image in a batch")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests answered with 429")
+    parser.add_argument("--unavailable-rate", type=float, default=0.0, help="Fraction of requests answered with 503")
+    parser.add_argument("--words", type=int, default=60, help="Words returned for each image")
+    parser.add_argument("--seed", type=int, default=DEFAULT_SEED, help="Random seed")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark harness for translate_pdf.py")
+    subparser = parser.add_subparsers(dest='command', required=True)
+
+    make_pdfs_parser = subparser.add_parser('make-pdfs', help="Generate synthetic PDFs")
+    stub_parser = subparser.add_parser('stub-server', help="Serve the fake Vision endpoint")
+    run_parser = subparser.add_parser('run', help="Benchmark pipeline configurations")
+    subparser.add_parser('check', help="Smoke check the page analysis functions")
+
+    make_pdfs_parser.add_argument("-o", "--output", type=str, required=True, help="Directory for the PDFs")
+    make_pdfs_parser.add_argument("--pages", type=int, nargs="+", default=DEFAULT_PAGE_COUNTS,
+                                  help="Page count of each generated PDF")
+    make_pdfs_parser.add_argument("--seed", type=int, default=DEFAULT_SEED, help="Random seed")
+    make_pdfs_parser.add_argument("--scanned", action="store_true",
+                                  help="Store pages as images only, like a scanned book")
+
+    stub_parser.add_argument("--host", type=str, default="127.0.0.1")
+    stub_parser.add_argument("--port", type=int, default=8080)
+    add_stub_arguments(stub_parser)
+
+    run_parser.add_argument("-i", "--input", type=str, nargs="+", required=True,
+                            help="PDF files or directories of PDF files")
+    run_parser.add_argument("--configs", type=str, help="JSON file with pipeline configurations")
+    run_parser.add_argument("--repeat", type=int, default=1, help="Runs of each configuration")
+    run_parser.add_argument("-o", "--output", type=str, help="Write all results to this JSON file")
+    add_stub_arguments(run_parser)
+
+    args = parser.parse_args()
+
+    if args.command == "make-pdfs":
+        make_pdfs(args.output, args.pages, args.seed, args.scanned)
+
+    elif args.command == "stub-server":
+        settings = StubSettings(args.latency_ms, args.jitter_ms, args.per_image_ms,
+                                args.error_rate, args.unavailable_rate, args.words, args.seed)
+        server = ThreadingHTTPServer((args.host, args.port), make_handler(settings))
+        print(f"Stub Vision endpoint listening on http://{args.host}:{args.port}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            print(f"Served {settings.requests} requests ({settings.images} images, {settings.errors} injected errors)")
+
+    elif args.command == "run":
+        sys.exit(run_benchmark(args))
+
+    elif args.command == "check":
+        sys.exit(run_checks())
+
+if __name__ == '__main__':
+    main()
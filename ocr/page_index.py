@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+"""
+Random access to the pages of a combined text file (<name>_all_pages.txt) of
+translate_pdf.py through its page offset index (<name>_all_pages.idx).
+
+translate_pdf.py writes the index next to the combined file. It holds the byte
+offset and length of the text of every page, so CombinedText returns any page
+or page range by memory mapping the combined file and slicing it, without
+reading the rest of the book:
+
+    with CombinedText("output_book/book_all_pages.txt") as book:
+        text = book.page(12)
+        for page, text in book.page_range(10, 20):
+            ...
+
+Two commands:
+  build   Write the index of combined files written before translate_pdf.py
+          wrote one, by scanning their page banners.
+  show    Print pages of a combined file, e.g. 12 or 10-20.
+
+Example:
+    python page_index.py build output_book/book_all_pages.txt
+    python page_index.py show output_book/book_all_pages.txt 10-20
+
+Index format, little endian: a header with the magic, the format version, the
+first page number, the number of pages and the size of the combined file it
+describes, then (offset, length) of pages first_page, first_page + 1, ...
+Pages that are not in the combined file have offset MISSING.
+"""
+
+import argparse
+import mmap
+import os
+import re
+import struct
+import sys
+
+MAGIC = b"OCRPAGES"
+INDEX_VERSION = 1
+HEADER = struct.Struct("<8sIIIQ")
+ENTRY = struct.Struct("<QQ")
+MISSING = 2 ** 64 - 1
+
+# Page banner written by translate_pdf.py before the text of every page
+BANNER = re.compile(rb"^={50}(\r?\n)Page (\d+)\r?\n={50}\r?\n\r?\n", re.MULTILINE)
+
+def index_filename(path):
+    """Path of the page offset index of a combined text file"""
+    return f"{os.path.splitext(path)[0]}.idx"
+
+def write_index(index_path, pages, text_size):
+    """Atomically write a page offset index. pages maps page numbers to the
+    (offset, length) in bytes of their text in a combined file of text_size bytes."""
+    first_page = min(pages, default=1)
+    count = max(pages, default=0) - first_page + 1 if pages else 0
+    entries = bytearray(HEADER.pack(MAGIC, INDEX_VERSION, first_page, count, text_size))
+    for number in range(first_page, first_page + count):
+        entries += ENTRY.pack(*pages.get(number, (MISSING, 0)))
+
+    tmp_path = f"{index_path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(entries)
+    os.replace(tmp_path, index_path)
+
+def scan_pages(path):
+    """(offset, length) of the text of every page of a combined text file, from its banners"""
+    pages = {}
+    with open(path, 'rb') as f:
+        data = f.read()
+    matches = list(BANNER.finditer(data))
+    for match, following in zip(matches, matches[1:] + [None]):
+        end = following.start() if following else len(data)
+        # Every page is followed by an empty line
+        if data.endswith(match[1] * 2, match.end(), end):
+            end -= 2 * len(match[1])
+        pages[int(match[2])] = (match.end(), end - match.end())
+    return pages
+
+def build_index(path):
+    """Write the page offset index of an existing combined text file. Returns the number of pages."""
+    pages = scan_pages(path)
+    write_index(index_filename(path), pages, os.path.getsize(path))
+    return len(pages)
+
+class CombinedText:
+    """Pages of a combined text file, read through its page offset index. The
+    file is memory mapped, so a page costs one index lookup and one slice
+    whatever the size of the book. Raises FileNotFoundError without an index
+    and ValueError if the index does not describe the file."""
+
+    def __init__(self, path, index_path=None):
+        self.path = path
+        index_path = index_path or index_filename(path)
+        with open(index_path, 'rb') as f:
+            self.index = f.read()
+        if len(self.index) < HEADER.size:
+            raise ValueError(f"{index_path} is not a page index")
+        magic, version, self.first_page, self.count, text_size = HEADER.unpack_from(self.index)
+        if magic != MAGIC or version != INDEX_VERSION or len(self.index) != HEADER.size + self.count * ENTRY.size:
+            raise ValueError(f"{index_path} is not a page index")
+
+        self.file = open(path, 'rb')
+        if os.fstat(self.file.fileno()).st_size != text_size:
+            self.file.close()
+            raise ValueError(f"{index_path} is out of date, rebuild it with: page_index.py build {path}")
+        # An empty file can't be mapped
+        self.text = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if text_size else b""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if isinstance(self.text, mmap.mmap):
+            self.text.close()
+        self.file.close()
+
+    def _entry(self, number):
+        """(offset, length) of a page, None if it is not in the file"""
+        if not self.first_page <= number < self.first_page + self.count:
+            return None
+        offset, length = ENTRY.unpack_from(self.index, HEADER.size + (number - self.first_page) * ENTRY.size)
+        return None if offset == MISSING else (offset, length)
+
+    def __contains__(self, number):
+        return self._entry(number) is not None
+
+    def __len__(self):
+        return len(self.pages())
+
+    def pages(self):
+        """Page numbers in the file, in order"""
+        return [number for number in range(self.first_page, self.first_page + self.count) if number in self]
+
+    def page(self, number):
+        """Text of a (1-based) page. Raises KeyError if it is not in the file."""
+        entry = self._entry(number)
+        if entry is None:
+            raise KeyError(number)
+        offset, length = entry
+        return self.text[offset:offset + length].decode('utf-8')
+
+    def page_range(self, first, last):
+        """(page number, text) of the pages from first to last that are in the file"""
+        return [(number, self.page(number)) for number in range(first, last + 1) if number in self]
+
+def main():
+    parser = argparse.ArgumentParser(description="Page offset index of the combined text files of translate_pdf.py")
+    subparser = parser.add_subparsers(dest='command', required=True)
+
+    build_parser = subparser.add_parser('build', help="Write the index of combined text files")
+    show_parser = subparser.add_parser('show', help="Print pages of a combined text file")
+
+    build_parser.add_argument("paths", type=str, nargs="+", help="<name>_all_pages.txt files")
+
+    show_parser.add_argument("path", type=str, help="<name>_all_pages.txt file")
+    show_parser.add_argument("pages", type=str, help="Page number or range, e.g. 12 or 10-20")
+
+    args = parser.parse_args()
+
+    if args.command == "build":
+        for path in args.paths:
+            print(f"{path}: {build_index(path)} pages")
+
+    elif args.command == "show":
+        match = re.fullmatch(r"(\d+)(?:-(\d+))?", args.pages)
+        if not match:
+            sys.exit(f"Invalid page range {args.pages}")
+        first = int(match[1])
+        last = int(match[2]) if match[2] else first
+        try:
+            with CombinedText(args.path) as book:
+                for number, text in book.page_range(first, last):
+                    print(f"--- Page {number} ---")
+                    print(text)
+        except FileNotFoundError as e:
+            if os.path.exists(args.path):
+                sys.exit(f"No page index for {args.path}, create it with: page_index.py build {args.path}")
+            sys.exit(str(e))
+        except (OSError, ValueError) as e:
+            sys.exit(str(e))
+
+if __name__ == '__main__':
+    main()
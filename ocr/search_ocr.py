@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+"""
+Full-text search over the OCR output of translate_pdf.py.
+
+Two commands:
+  index   Add the page_XXX.txt files of output_* folders to a SQLite FTS5 index.
+          Only pages whose file changed since the last run are read again, pages
+          that disappeared are removed, and blank and duplicate pages skipped by
+          translate_pdf.py are not indexed.
+  query   Print the book and page of the best matching pages with a snippet.
+
+Example:
+    python search_ocr.py index ~/Documents/A/ocr
+    python search_ocr.py query सम्यग्दर्शन "मोक्ष मार्ग" --limit 10
+
+Indexed text and queries are normalized the same way, so spelling variants
+common in OCR output find each other: with or without nukta, chandrabindu or
+anusvara, Devanagari/Gujarati or ASCII digits, and any of the danda look-alikes.
+Query words must all occur on a page, "quoted words" must occur in that order
+and a trailing * matches any word starting with the prefix. --raw passes the
+query to FTS5 as it is (https://www.sqlite.org/fts5.html#full_text_query_syntax).
+"""
+
+import argparse
+import json
+import os
+import re
+import sqlite3
+import sys
+import time
+import unicodedata
+
+DEFAULT_INDEX = "%s/.cache/jaincatalogue/ocr_search.sqlite" % os.getenv("HOME")
+DEFAULT_LIMIT = 20
+SNIPPET_TOKENS = 16
+
+# Folders and files written by translate_pdf.py
+OUTPUT_PREFIX = "output_"
+PAGE_FILE = re.compile(r"page_(\d+)\.txt$")
+MANIFEST_FILE = "manifest.json"
+SKIPPED_SOURCES = ("blank", "duplicate")
+
+# Bumped whenever normalization or tokenization changes, an index built with
+# another version is rebuilt from scratch
+INDEX_VERSION = 1
+
+DANDA = "\u0964"
+DOUBLE_DANDA = "\u0965"
+
+# Spelling variants folded together: the nukta is dropped (क़ -> क), chandrabindu
+# becomes anusvara (हैँ -> हैं), joiners are removed, digits become ASCII, and the
+# characters used in place of a danda, like the "∣" in data/JainPraveshika.txt,
+# become a danda
+NORMALIZE_TABLE = str.maketrans({
+    "\u093c": None, "\u0abc": None,          # nukta
+    "\u0901": "\u0902", "\u0a81": "\u0a82",  # chandrabindu -> anusvara
+    "\u200c": None, "\u200d": None, "\ufeff": None, "\u200b": " ",
+    "\u2223": DANDA, "|": DANDA, "\u00a6": DANDA, "\uff5c": DANDA,
+    **{0x0966 + i: str(i) for i in range(10)},
+    **{0x0ae6 + i: str(i) for i in range(10)},
+})
+REPEATED_DANDA = re.compile(f"{DANDA}\\s*{DANDA}")
+
+# FTS5's unicode61 tokenizer splits words at combining marks, which would cut
+# Devanagari and Gujarati words at every vowel sign and virama
+TOKEN_CHARS = "".join(
+    chr(code) for code in list(range(0x0900, 0x0980)) + list(range(0x0a80, 0x0b00))
+    if unicodedata.category(chr(code)).startswith("M")
+)
+
+SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS books (
+    id INTEGER PRIMARY KEY,
+    folder TEXT NOT NULL UNIQUE,
+    name TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS pages (
+    id INTEGER PRIMARY KEY,
+    book_id INTEGER NOT NULL REFERENCES books(id),
+    page INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    UNIQUE (book_id, page)
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS page_text USING fts5(
+    text,
+    tokenize = "unicode61 tokenchars '{TOKEN_CHARS}'",
+    prefix = '2 3'
+);
+"""
+
+
+def normalize(text):
+    """Fold the spelling variants of Devanagari and Gujarati text together"""
+    # NFC splits precomposed nukta letters into letter + nukta
+    text = unicodedata.normalize("NFC", text).translate(NORMALIZE_TABLE)
+    return REPEATED_DANDA.sub(DOUBLE_DANDA, text)
+
+
+def open_index(path):
+    """Open the index database, creating it or rebuilding it if it was made by
+    another INDEX_VERSION"""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    db = sqlite3.connect(path)
+    db.execute("PRAGMA journal_mode = WAL")
+    db.execute("PRAGMA synchronous = NORMAL")
+    version = db.execute("PRAGMA user_version").fetchone()[0]
+    if version not in (0, INDEX_VERSION):
+        print(f"Index {path} was built by version {version}, rebuilding it")
+        with db:
+            db.executescript("DROP TABLE IF EXISTS page_text; DROP TABLE IF EXISTS pages; DROP TABLE IF EXISTS books;")
+    with db:
+        db.executescript(SCHEMA)
+        db.execute(f"PRAGMA user_version = {INDEX_VERSION}")
+    return db
+
+
+def find_output_folders(paths):
+    """output_* folders given directly or found directly inside the given folders"""
+    folders = set()
+    for path in paths:
+        path = os.path.abspath(path)
+        if os.path.basename(path).startswith(OUTPUT_PREFIX) and os.path.isdir(path):
+            folders.add(path)
+            continue
+        for entry in os.scandir(path):
+            if entry.name.startswith(OUTPUT_PREFIX) and entry.is_dir():
+                folders.add(entry.path)
+    return sorted(folders)
+
+
+def skipped_pages(folder):
+    """Pages of an output folder that translate_pdf.py saved without OCR"""
+    try:
+        with open(os.path.join(folder, MANIFEST_FILE), 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return set()
+    return {int(page) for page, entry in manifest.get("pages", {}).items()
+            if entry.get("source") in SKIPPED_SOURCES}
+
+
+def index_folder(db, folder):
+    """Bring the index of one output folder up to date. Returns (added, updated, removed) pages."""
+    name = os.path.basename(folder)[len(OUTPUT_PREFIX):]
+    db.execute("INSERT OR IGNORE INTO books (folder, name) VALUES (?, ?)", (folder, name))
+    book_id = db.execute("SELECT id FROM books WHERE folder = ?", (folder,)).fetchone()[0]
+    indexed = {page: (page_id, mtime_ns, size) for page_id, page, mtime_ns, size in
+               db.execute("SELECT id, page, mtime_ns, size FROM pages WHERE book_id = ?", (book_id,))}
+    skipped = skipped_pages(folder)
+
+    added = updated = 0
+    seen = set()
+    for entry in os.scandir(folder):
+        match = PAGE_FILE.match(entry.name)
+        if not match or int(match.group(1)) in skipped:
+            continue
+        page = int(match.group(1))
+        seen.add(page)
+        stat = entry.stat()
+        current = indexed.get(page)
+        if current is not None and current[1:] == (stat.st_mtime_ns, stat.st_size):
+            continue
+
+        with open(entry.path, 'r', encoding='utf-8') as f:
+            text = normalize(f.read())
+        if current is None:
+            cursor = db.execute("INSERT INTO pages (book_id, page, mtime_ns, size) VALUES (?, ?, ?, ?)",
+                                (book_id, page, stat.st_mtime_ns, stat.st_size))
+            db.execute("INSERT INTO page_text (rowid, text) VALUES (?, ?)", (cursor.lastrowid, text))
+            added += 1
+        else:
+            db.execute("UPDATE pages SET mtime_ns = ?, size = ? WHERE id = ?",
+                       (stat.st_mtime_ns, stat.st_size, current[0]))
+            db.execute("UPDATE page_text SET text = ? WHERE rowid = ?", (text, current[0]))
+            updated += 1
+
+    removed = [(page_id,) for page, (page_id, _, _) in indexed.items() if page not in seen]
+    db.executemany("DELETE FROM page_text WHERE rowid = ?", removed)
+    db.executemany("DELETE FROM pages WHERE id = ?", removed)
+    return added, updated, len(removed)
+
+
+def remove_missing_books(db):
+    """Drop books whose output folder no longer exists. Returns their names."""
+    missing = [(book_id, name) for book_id, folder, name in db.execute("SELECT id, folder, name FROM books")
+               if not os.path.isdir(folder)]
+    for book_id, _ in missing:
+        db.execute("DELETE FROM page_text WHERE rowid IN (SELECT id FROM pages WHERE book_id = ?)", (book_id,))
+        db.execute("DELETE FROM pages WHERE book_id = ?", (book_id,))
+        db.execute("DELETE FROM books WHERE id = ?", (book_id,))
+    return [name for _, name in missing]
+
+
+def build_index(paths, index_path, optimize=False):
+    """Index the output folders under paths incrementally"""
+    start = time.time()
+    db = open_index(index_path)
+    totals = [0, 0, 0]
+    folders = find_output_folders(paths)
+    for folder in folders:
+        # One transaction per book, an interrupted run keeps the books it finished
+        with db:
+            counts = index_folder(db, folder)
+        totals = [total + count for total, count in zip(totals, counts)]
+        if any(counts):
+            print(f"{os.path.basename(folder)}: {counts[0]} added, {counts[1]} updated, {counts[2]} removed")
+    with db:
+        for name in remove_missing_books(db):
+            print(f"{OUTPUT_PREFIX}{name}: folder is gone, removed from the index")
+        if optimize:
+            db.execute("INSERT INTO page_text (page_text) VALUES ('optimize')")
+    pages = db.execute("SELECT count(*) FROM pages").fetchone()[0]
+    db.close()
+    print(f"Indexed {len(folders)} folders in {time.time() - start:.1f}s: {totals[0]} pages added, "
+          f"{totals[1]} updated, {totals[2]} removed, {pages} pages in {index_path}")
+
+
+def match_expression(query, raw=False):
+    """FTS5 MATCH expression for a normalized query. Words and "quoted phrases"
+    are quoted so that FTS5 operators and punctuation in them are plain text."""
+    query = normalize(query)
+    if raw:
+        return query
+    terms = []
+    for phrase, word in re.findall(r'"([^"]*)"|(\S+)', query):
+        term = phrase or word
+        prefix = term.endswith("*") and not phrase
+        term = term.rstrip("*") if prefix else term
+        if term.strip():
+            terms.append('"' + term.replace('"', '""') + '"' + ("*" if prefix else ""))
+    return " ".join(terms)
+
+
+def search(index_path, query, limit=DEFAULT_LIMIT, book=None, raw=False):
+    """Best matching pages for a query as (book name, page, snippet), best first"""
+    expression = match_expression(query, raw)
+    if not expression:
+        return []
+    sql = ("SELECT books.name, pages.page, snippet(page_text, 0, '[', ']', '…', ?) "
+           "FROM page_text JOIN pages ON pages.id = page_text.rowid JOIN books ON books.id = pages.book_id "
+           "WHERE page_text MATCH ?")
+    params = [SNIPPET_TOKENS, expression]
+    if book:
+        sql += " AND books.name = ?"
+        params.append(book)
+    sql += " ORDER BY rank LIMIT ?"
+    params.append(limit)
+
+    db = sqlite3.connect(f"file:{index_path}?mode=ro", uri=True)
+    try:
+        return [(name, page, " ".join(snippet.split())) for name, page, snippet in db.execute(sql, params)]
+    finally:
+        db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Full-text search over the OCR output of translate_pdf.py")
+    parser.add_argument("--index", type=str, default=DEFAULT_INDEX, help="SQLite index file")
+    subparser = parser.add_subparsers(dest='command', required=True)
+
+    index_parser = subparser.add_parser('index', help="Add output folders to the index")
+    query_parser = subparser.add_parser('query', help="Search the index")
+
+    index_parser.add_argument("paths", type=str, nargs="+",
+                              help="output_* folders, or folders containing them")
+    index_parser.add_argument("--optimize", action="store_true",
+                              help="Merge the index into one segment afterwards, for the fastest queries")
+
+    query_parser.add_argument("query", type=str, nargs="+", help="Words to search for")
+    query_parser.add_argument("--limit", "-n", type=int, default=DEFAULT_LIMIT, help="Maximum number of hits")
+    query_parser.add_argument("--book", type=str, help="Only search this book (name of the PDF without .pdf)")
+    query_parser.add_argument("--raw", action="store_true", help="Pass the query to FTS5 unchanged")
+
+    args = parser.parse_args()
+
+    if args.command == "index":
+        build_index(args.paths, args.index, args.optimize)
+
+    elif args.command == "query":
+        if not os.path.exists(args.index):
+            sys.exit(f"No index at {args.index}, create it with: search_ocr.py index <folders>")
+        start = time.perf_counter()
+        try:
+            hits = search(args.index, " ".join(args.query), args.limit, args.book, args.raw)
+        except sqlite3.OperationalError as e:
+            sys.exit(f"Invalid query: {e}")
+        for name, page, snippet in hits:
+            print(f"{name} page {page}: {snippet}")
+        print(f"{len(hits)} hits in {(time.perf_counter() - start) * 1000:.1f} ms")
+
+if __name__ == '__main__':
+    main()
@@ -1,21 +1,61 @@
 #!/usr/bin/env python
 
 import argparse
+import asyncio
+import contextlib
+import hashlib
+import importlib
 import io
+import json
 import logging
+import math
 import os
+import queue
+import random
+import re
 import shutil
+import sys
+import threading
 import time
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import urllib.request
+import zipfile
+import zlib
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from difflib import SequenceMatcher
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import repeat
+from xml.sax.saxutils import escape
 
-from docx import Document
-from docx.shared import Pt
-import docx2pdf
 import fitz  # PyMuPDF
-from PIL import Image
+import numpy as np
 from tqdm import tqdm
 
-from google.cloud import vision
+try:
+    from . import page_index
+except ImportError:
+    # Run as a script, or imported from this folder
+    import page_index
+
+class LazyModule:
+    """A module imported on first attribute access. The Google client libraries
+    take a while to import, and importing this file or starting a run that never
+    touches them should not wait for that."""
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+        self._lock = threading.Lock()
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+google_exceptions = LazyModule("google.api_core.exceptions")
+vision = LazyModule("google.cloud.vision")
 
 """
 The tool accepts a PDF file and converts it into a fully translated
@@ -53,23 +93,243 @@ Setup:
     gcloud auth application-default login
 
   - Install required Python libraries:
-    pip install PyMuPDF pillow python-docx google-cloud-vision docx2pdf tqdm
-
+    pip install PyMuPDF numpy pillow google-cloud-vision tqdm
+
+  - Optional, for the offline --ocr-backend tesseract: install Tesseract with
+    the hin, guj and eng language packs, and
+    pip install pytesseract
+
+Usage as a library: run() takes an Options object, or the command line options
+as a list, e.g.
+    from ocr import translate_pdf
+    book = translate_pdf.Book("book.pdf", start_page=9, end_page=11)
+    stats = translate_pdf.run(translate_pdf.Options(books=[book], adaptive_dpi=True))
+
+Service mode: a long-lived process started with
+    python translate_pdf.py --serve
+runs jobs one at a time from a queue. The Google libraries, the Vision client
+with its connection pool and the render workers with their open PDFs stay warm
+between jobs. Submit a job with the usual options plus --server:
+    python translate_pdf.py --server http://127.0.0.1:8765 -f book.pdf -s 10 -e 12
 """
 
 # Default values - will be overridden by command line args
 DEFAULT_BASE_FOLDER = "%s/Documents/A/ocr" % os.getenv("HOME")
+DEFAULT_CACHE_FOLDER = "%s/.cache/jaincatalogue/ocr" % os.getenv("HOME")
+DEFAULT_CACHE_MAX_MB = 2048
+
+# Rendering / OCR parameters. These are part of the OCR cache key, so a
+# change here never returns results produced with different settings.
+RENDER_ZOOM = 2.0  # 2.0 = 144 DPI, adjust for quality vs speed
+OCR_FEATURE = "DOCUMENT_TEXT_DETECTION"
+
+# Adaptive DPI: every page is probed at PROBE_ZOOM to measure its text lines and
+# rendered at the zoom that makes the x-height come out at --target-x-height pixels
+PROBE_ZOOM = 1.0
+MIN_ZOOM = 1.0
+MAX_ZOOM = 4.0
+ZOOM_STEP = 0.25
+# 10 px is an x-height of 5 points at the fixed RENDER_ZOOM, so book text of 11 points
+# and larger is rendered at RENDER_ZOOM or below and only small print above it
+DEFAULT_TARGET_X_HEIGHT = 10
+# The x-height (for Devanagari and Gujarati: headline to baseline) is measured as
+# the rows holding the middle X_HEIGHT_INK_SHARE of the ink of a text line, which
+# leaves out ascenders, descenders and matras
+X_HEIGHT_INK_SHARE = 0.8
+# Deskew searches this range of angles
+MAX_SKEW_DEGREES = 5.0
+SKEW_STEP_DEGREES = 0.25
+# Fixed zooms compared with the adaptive one by --dpi-report
+DPI_REPORT_ZOOMS = (1.0, 1.5, 2.0, 3.0)
+
+# Blank and duplicate page detection, on the page probed at PROBE_ZOOM. Pixels
+# INK_CONTRAST gray levels darker than the paper are ink; a page is blank if less
+# than BLANK_INK_RATIO of it is ink, not counting a border where scans have shadows.
+INK_CONTRAST = 48
+BLANK_INK_RATIO = 0.0001
+BLANK_MARGIN_RATIO = 0.05
+# Pages whose 64-bit perceptual hashes are at most --duplicate-distance bits apart
+# are candidates; a candidate is a duplicate if the ink of both pages, rendered at
+# DUPLICATE_ZOOM and overlaid with a shift of up to DUPLICATE_MAX_SHIFT pixels,
+# correlates by at least DUPLICATE_MIN_SIMILARITY. Different pages of running
+# text in the same layout stay below 0.7.
+PHASH_SIZE = 32
+DEFAULT_DUPLICATE_DISTANCE = 6
+DUPLICATE_ZOOM = 0.5
+DUPLICATE_MAX_SHIFT = 8
+DUPLICATE_MIN_SIMILARITY = 0.85
+DUPLICATE_MAX_CANDIDATES = 8
+# Text saved for pages that are not sent for OCR
+BLANK_PAGE_TEXT = "[blank page]"
+DUPLICATE_PAGE_TEXT = "[duplicate of {page}]"
+
+# --auto-crop: the pages are probed at PROBE_ZOOM and split into bands of rows
+# with ink in more than AUTO_CROP_MIN_INK of their width, joining bands less than
+# AUTO_CROP_JOIN apart (all as shares of the page height). The first or last band
+# of a page is a header or footer candidate if it is at most AUTO_CROP_MAX_BAND
+# high, within AUTO_CROP_ZONE of the edge and set off from the text by a gap of
+# at least AUTO_CROP_GAP_FACTOR line gaps. Candidates at the same height, within
+# AUTO_CROP_TOLERANCE, on at least AUTO_CROP_MIN_SHARE of the pages (and at least
+# AUTO_CROP_MIN_PAGES) are cropped in the middle of their gap.
+AUTO_CROP_MIN_INK = 0.005
+AUTO_CROP_JOIN = 0.004
+AUTO_CROP_MAX_BAND = 0.05
+AUTO_CROP_ZONE = 0.15
+AUTO_CROP_GAP_FACTOR = 1.5
+AUTO_CROP_MIN_GAP = 0.01
+AUTO_CROP_TOLERANCE = 0.015
+AUTO_CROP_MIN_SHARE = 0.3
+AUTO_CROP_MIN_PAGES = 3
+
+# Vision accepts at most 16 images in one batch_annotate_images request
+MAX_BATCH_SIZE = 16
+# --mosaic: pages whose text takes up at most MOSAIC_MAX_FILL of the page height
+# are cropped to their text, with MOSAIC_PADDING pixels around it, and stacked
+# MOSAIC_GAP pixels apart into one image. Mosaics stay far below Vision's 20 MB
+# image limit and a few pages tall, so the text is not scaled down.
+MOSAIC_MAX_FILL = 0.4
+MOSAIC_PADDING = 16
+MOSAIC_GAP = 64
+MOSAIC_MAX_PAGES = 8
+MOSAIC_MAX_HEIGHT = 4000
+MOSAIC_MAX_PIXELS = 10_000_000
+# Rows and columns with ink in less than this share of their pixels are dust
+MOSAIC_MIN_INK = 0.002
+# Pages per JSON result file written by the async file annotation API
+ASYNC_OUTPUT_BATCH_SIZE = 20
+ASYNC_TIMEOUT_SECONDS = 3600
+
+# Vision request limits. Concurrency starts at INITIAL_CONCURRENCY and adapts
+# (AIMD) between 1 and --max-concurrency based on latency and throttling errors.
+DEFAULT_MAX_RPM = 1800
+DEFAULT_MAX_CONCURRENCY = 32
+DEFAULT_MAX_RETRIES = 5
+DEFAULT_LATENCY_TARGET = 10.0
+INITIAL_CONCURRENCY = 8
+# Pages waiting between two stages of the asyncio engine
+DEFAULT_QUEUE_SIZE = 32
+# Page images held in memory between rendering and the end of their OCR request.
+# A page is admitted for rendering with the size of an RGB raster of it and
+# holds the size of its encoded image once rendered.
+DEFAULT_MEMORY_BUDGET_MB = 1536
+RASTER_BYTES_PER_PIXEL = 3
+BACKOFF_BASE_SECONDS = 1.0
+BACKOFF_MAX_SECONDS = 60.0
+# Don't decrease concurrency again for this long, one burst of errors halves it once
+DECREASE_COOLDOWN_SECONDS = 2.0
+# Retries allowed per run: a fixed allowance plus a fraction of all requests
+RETRY_BUDGET_BASE = 20
+RETRY_BUDGET_RATIO = 0.1
+
+# Hybrid mode: a page's embedded text layer is used instead of OCR if it has at
+# least this many characters and at most this fraction of them look broken
+MIN_TEXT_LAYER_CHARS = 20
+MAX_BAD_CHAR_RATIO = 0.05
+# A page whose images cover at least MIN_IMAGE_COVERAGE of it is a scan and needs
+# OCR, unless its text blocks cover at least MIN_TEXT_IMAGE_RATIO of the image
+# area (a scan with a full text layer), e.g. a scan with only a caption as text
+MIN_IMAGE_COVERAGE = 0.3
+MIN_TEXT_IMAGE_RATIO = 0.3
+# Legacy (non-Unicode) Devanagari/Gujarati fonts. Their text layer maps glyphs
+# onto Latin codepoints and reads as garbage, e.g. "Hkkjr" for "भारत".
+LEGACY_FONT_PATTERNS = (
+    "krutidev", "kruti dev", "chanakya", "shivaji", "devlys", "dv-tt", "dvb-tt",
+    "akruti", "shree-dev", "shree-guj", "sulekh", "ghanshyam", "gopika", "terafont",
+)
 
-# Global variables set by parse_args()
-FNAME_PREFIX = None
-BASE_FILE = None
-OUTPUT_FOLDER = None
-START_PAGE = None
-END_PAGE = None
-TOP_CROP = None
-BOTTOM_CROP = None
-
-vision_client = vision.ImageAnnotatorClient()
+# Tesseract language packs used by the local OCR backend
+DEFAULT_TESSERACT_LANG = "hin+guj+eng"
+
+# A render worker keeps this many PDFs open, closing the least recently used
+MAX_OPEN_DOCUMENTS = 4
+
+# Vision DOCUMENT_TEXT_DETECTION list price per 1000 images, the monthly free
+# tier is not taken into account. https://cloud.google.com/vision/pricing
+VISION_PRICE_PER_1000 = 1.50
+
+# Shard runs (--shard) keep their manifest, report and combined text in this
+# subfolder of the book's output folder, --merge assembles them
+SHARD_FOLDER = "shards"
+
+# Stored annotations: serialized TextAnnotation protobufs, zlib compressed
+ANNOTATION_FOLDER = "annotations"
+ANNOTATION_COMPRESSION_LEVEL = 6
+
+# Invisible text layer of --searchable-pdf: MuPDF's built-in Noto fonts, picked
+# by UCDN script code, and how often the copy is saved incrementally
+TEXT_LAYER_SCRIPTS = {"devanagari": 9, "gujarati": 12}
+TEXT_LAYER_FONT_SCALE = 0.8
+SEARCHABLE_SAVE_PAGES = 50
+
+# Style of the generated docx
+DOCX_FONT = "NotoSansDevanagari-Regular"
+DOCX_FONT_SIZE_PT = 10
+
+# Service mode (--serve): jobs are accepted on localhost only. A finished job
+# keeps the last SERVICE_LOG_LINES lines of its log, and the last SERVICE_KEEP_JOBS
+# finished jobs can be looked up.
+DEFAULT_SERVICE_PORT = 8765
+SERVICE_LOG_LINES = 500
+SERVICE_KEEP_JOBS = 100
+
+# Per-page measurements summarised in the report, in pipeline order
+REPORT_STAGES = ("open", "crop", "analyse", "zoom", "angle", "render", "encode", "upload_bytes", "rpc", "retries", "parse", "write", "latency")
+
+# PDF handles kept open for the lifetime of a render worker process, by path, mtime and size
+render_documents = {}
+# Options of a render worker process, set by init_render_worker()
+render_options = None
+
+# Bytes uploaded to the OCR service, shared by all worker threads
+upload_lock = threading.Lock()
+upload_bytes = 0
+upload_pages = 0
+
+# Token bucket for requests per minute
+rate_lock = threading.Lock()
+rate_tokens = 0.0
+rate_updated = None
+
+# Adaptive concurrency limit and request counters
+concurrency_cond = threading.Condition()
+concurrency_limit = INITIAL_CONCURRENCY
+concurrency_in_flight = 0
+concurrency_successes = 0
+concurrency_last_decrease = 0.0
+request_count = 0
+retry_count = 0
+throttle_count = 0
+
+# Vision client, created on first use by get_vision_client()
+vision_client = None
+vision_client_endpoint = None
+vision_client_lock = threading.Lock()
+
+# Render process pool kept across jobs in service mode, and the settings its
+# workers were started with
+keep_render_pool = False
+render_pool = None
+render_pool_settings = None
+
+# SHA-256 of input files by (path, mtime, size)
+file_hashes = {}
+
+# Per-page measurements keyed by (pdf path, page_num), shared by all worker threads
+metrics_lock = threading.Lock()
+page_metrics = {}
+
+# Runs in one process take turns, the state below belongs to the running one
+run_lock = threading.Lock()
+
+# OCR backend and OCR cache of the run, created by execute()
+ocr_backend = None
+ocr_cache = None
+
+# Page images in flight and their high-water marks, reset for every run
+memory_budget = None
+
+# Perceptual hashes of the pages OCR'd in this run, created by execute() with --skip-duplicates
+duplicate_index = None
 
 # Setup logging
 logging.basicConfig(
@@ -78,17 +338,35 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-def parse_args():
-    """Parse command line arguments"""
+def build_parser(add_help=True):
+    """Command line arguments"""
     parser = argparse.ArgumentParser(
-        description='Extract text from PDF using Google Vision API'
+        description='Extract text from PDF using Google Vision API',
+        add_help=add_help
     )
-    parser.add_argument(
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument(
         '--filename', '-f',
         type=str,
-        required=True,
         help='Full path to PDF file (including .pdf extension)'
     )
+    source.add_argument(
+        '--directory', '-d',
+        type=str,
+        help='Process every PDF file in this folder with the same options'
+    )
+    source.add_argument(
+        '--jobs', '-j',
+        type=str,
+        help='JSON file listing PDFs to process, each with optional filename, start_page, '
+             'end_page, top_crop and bottom_crop (defaults come from the command line)'
+    )
+    source.add_argument(
+        '--serve',
+        action='store_true',
+        help='Service mode: run jobs submitted with --server one after the other, keeping '
+             'the Vision client and the render workers warm'
+    )
     parser.add_argument(
         '--start-page', '-s',
         type=int,
@@ -111,363 +389,3553 @@ def parse_args():
         default=0.0,
         help='Percentage of page height to crop from bottom (0.0-100.0)'
     )
-    
-    args = parser.parse_args()
-    
-    # Set global variables
-    global FNAME_PREFIX, BASE_FILE, OUTPUT_FOLDER, START_PAGE, END_PAGE, TOP_CROP, BOTTOM_CROP
-    
-    BASE_FILE = args.filename
-    # Extract filename without extension for prefix
-    base_name = os.path.splitext(os.path.basename(BASE_FILE))[0]
-    FNAME_PREFIX = base_name
-    
-    # Set output folder in same directory as input file
-    file_dir = os.path.dirname(BASE_FILE)
-    OUTPUT_FOLDER = os.path.join(file_dir, f"output_{FNAME_PREFIX}")
-    
-    START_PAGE = args.start_page - 1 if args.start_page else None  # Convert to 0-based
-    END_PAGE = args.end_page - 1 if args.end_page else None  # Convert to 0-based
-    TOP_CROP = args.top_crop
-    BOTTOM_CROP = args.bottom_crop
-    
-    return args
+    parser.add_argument(
+        '--auto-crop',
+        action='store_true',
+        help='Detect running headers, page numbers and footers that recur across the pages '
+             'of a book and crop them per page, on top of --top-crop and --bottom-crop'
+    )
+    parser.add_argument(
+        '--cache-dir',
+        type=str,
+        default=DEFAULT_CACHE_FOLDER,
+        help='Folder for the persistent OCR result cache'
+    )
+    parser.add_argument(
+        '--cache-max-mb',
+        type=int,
+        default=DEFAULT_CACHE_MAX_MB,
+        help='Maximum size of the OCR cache in MB, least recently used entries are evicted first'
+    )
+    parser.add_argument(
+        '--no-cache',
+        action='store_true',
+        help='Disable the OCR result cache and always call the Vision API'
+    )
+    parser.add_argument(
+        '--resume', '-r',
+        action='store_true',
+        help='Keep the output folder and only process pages that are missing, failed or stale'
+    )
+    parser.add_argument(
+        '--batch-size',
+        type=int,
+        default=1,
+        help=f'Number of pages sent in one batch_annotate_images request (1-{MAX_BATCH_SIZE})'
+    )
+    parser.add_argument(
+        '--gcs-bucket',
+        type=str,
+        help='Offline mode: upload the PDF to this GCS bucket and OCR it with the async file annotation API'
+    )
+    parser.add_argument(
+        '--render-workers',
+        type=int,
+        default=os.cpu_count() or 1,
+        help='Number of processes rendering pages to images (default: number of CPUs)'
+    )
+    parser.add_argument(
+        '--image-format',
+        choices=['png', 'gray-png', 'jpeg'],
+        default='png',
+        help='Encoding of the page images sent for OCR (jpeg is always grayscale)'
+    )
+    parser.add_argument(
+        '--jpeg-quality',
+        type=int,
+        default=85,
+        help='JPEG quality (1-100) used with --image-format jpeg'
+    )
+    parser.add_argument(
+        '--hybrid',
+        action='store_true',
+        help='Use the embedded PDF text layer where it is usable Unicode and OCR only the other pages'
+    )
+    parser.add_argument(
+        '--max-rpm',
+        type=int,
+        default=DEFAULT_MAX_RPM,
+        help='Maximum number of images sent to Vision per minute'
+    )
+    parser.add_argument(
+        '--max-concurrency',
+        type=int,
+        default=DEFAULT_MAX_CONCURRENCY,
+        help='Upper bound for the adaptive number of concurrent Vision requests'
+    )
+    parser.add_argument(
+        '--max-retries',
+        type=int,
+        default=DEFAULT_MAX_RETRIES,
+        help='Maximum retries per request for throttling and transient errors'
+    )
+    parser.add_argument(
+        '--latency-target',
+        type=float,
+        default=DEFAULT_LATENCY_TARGET,
+        help='Request latency in seconds above which concurrency is reduced'
+    )
+    parser.add_argument(
+        '--engine',
+        choices=['threads', 'asyncio'],
+        default='threads',
+        help='Pipeline engine: thread pool, or asyncio with bounded queues and the async Vision client'
+    )
+    parser.add_argument(
+        '--queue-size',
+        type=int,
+        default=DEFAULT_QUEUE_SIZE,
+        help='Maximum pages waiting between pipeline stages of the asyncio engine'
+    )
+    parser.add_argument(
+        '--memory-budget-mb',
+        type=int,
+        default=DEFAULT_MEMORY_BUDGET_MB,
+        help='Maximum MB of page images in flight; new pages are rendered only as '
+             'earlier ones finish OCR (0 for no limit)'
+    )
+    parser.add_argument(
+        '--ocr-backend',
+        choices=['vision', 'tesseract'],
+        default='vision',
+        help='OCR engine: Google Vision API, or a local Tesseract running on a process pool'
+    )
+    parser.add_argument(
+        '--tesseract-lang',
+        type=str,
+        default=DEFAULT_TESSERACT_LANG,
+        help='Tesseract languages, e.g. hin+guj+eng'
+    )
+    parser.add_argument(
+        '--tesseract-workers',
+        type=int,
+        default=os.cpu_count() or 1,
+        help='Number of Tesseract processes (default: number of CPUs)'
+    )
+    parser.add_argument(
+        '--vision-fallback-confidence',
+        type=float,
+        default=0.0,
+        help='With --ocr-backend tesseract, send pages whose mean word confidence (0-100) '
+             'is below this to Google Vision instead'
+    )
+    parser.add_argument(
+        '--vision-endpoint',
+        type=str,
+        help='Send Vision requests over REST to this endpoint without credentials, '
+             'e.g. http://127.0.0.1:8080 for the stub server of benchmark_ocr.py'
+    )
+    parser.add_argument(
+        '--stats-json',
+        type=str,
+        help='Write the final statistics of the run to this JSON file'
+    )
+    parser.add_argument(
+        '--text-layout',
+        choices=['paragraphs', 'lines'],
+        default='paragraphs',
+        help='paragraphs: words of a paragraph joined by spaces; lines: keep the line breaks detected by OCR'
+    )
+    parser.add_argument(
+        '--rerender',
+        action='store_true',
+        help='Regenerate the text files (and docx with --docx) of an earlier run from its stored '
+             'annotations, without OCR'
+    )
+    parser.add_argument(
+        '--docx',
+        action='store_true',
+        help='Also create <name>_extracted.docx with the text of all pages, written while pages complete'
+    )
+    parser.add_argument(
+        '--adaptive-dpi',
+        action='store_true',
+        help='Render every page at the lowest zoom that keeps its text x-height at --target-x-height '
+             f'pixels, instead of a fixed {RENDER_ZOOM}x'
+    )
+    parser.add_argument(
+        '--target-x-height',
+        type=int,
+        default=DEFAULT_TARGET_X_HEIGHT,
+        help=f'x-height in pixels aimed for by --adaptive-dpi (default: {DEFAULT_TARGET_X_HEIGHT})'
+    )
+    parser.add_argument(
+        '--deskew',
+        action='store_true',
+        help=f'Straighten pages scanned at an angle of up to {MAX_SKEW_DEGREES} degrees'
+    )
+    parser.add_argument(
+        '--binarize',
+        action='store_true',
+        help='Send pure black and white images, thresholded with Otsu\'s method'
+    )
+    parser.add_argument(
+        '--dpi-report',
+        type=int,
+        default=0,
+        metavar='PAGES',
+        help='Instead of extracting, OCR this many sample pages at several zooms and report '
+             'image size and accuracy against the highest zoom (costs OCR requests)'
+    )
+    parser.add_argument(
+        '--mosaic',
+        action='store_true',
+        help='Pack pages with little text, cropped to the text, into one image per Vision '
+             'request and split the result back into pages (threads engine only)'
+    )
+    parser.add_argument(
+        '--skip-blank',
+        action='store_true',
+        help=f'Don\'t OCR pages without ink, their text is "{BLANK_PAGE_TEXT}"'
+    )
+    parser.add_argument(
+        '--skip-duplicates',
+        action='store_true',
+        help='Don\'t OCR near-duplicates of a page OCR\'d earlier in this run, in the same or '
+             'another book, their text names the page they repeat'
+    )
+    parser.add_argument(
+        '--duplicate-distance',
+        type=int,
+        default=DEFAULT_DUPLICATE_DISTANCE,
+        help='Maximum number of differing perceptual hash bits (0-64) for two pages to be '
+             f'compared as duplicates (default: {DEFAULT_DUPLICATE_DISTANCE})'
+    )
+    parser.add_argument(
+        '--searchable-pdf',
+        action='store_true',
+        help='Also create <name>_searchable.pdf, a copy of the input with the OCR words '
+             'as an invisible text layer'
+    )
+    parser.add_argument(
+        '--shard',
+        type=str,
+        help='Process only a part of each book, e.g. 2/4 for the second of four equal parts '
+             'or 1-100,250 for those pages. Shards can run in separate processes or machines '
+             'sharing the output folder, each with its own credentials; a shard that is run '
+             'again only redoes its failed pages'
+    )
+    parser.add_argument(
+        '--merge',
+        action='store_true',
+        help='Check that every page of a book processed with --shard is done and assemble '
+             'its combined text file, manifest and report (and docx with --docx), without OCR'
+    )
+    parser.add_argument(
+        '--port',
+        type=int,
+        default=DEFAULT_SERVICE_PORT,
+        help=f'Localhost port of --serve (default: {DEFAULT_SERVICE_PORT})'
+    )
+    parser.add_argument(
+        '--server',
+        type=str,
+        help='Run the job on the service at this URL, e.g. http://127.0.0.1:8765, and print its log'
+    )
+    return parser
+
+class Options:
+    """Options of a run: one attribute per command line option, with the same
+    defaults. parse_args() builds them from the command line, library callers
+    build them directly, e.g. Options(books=[Book("book.pdf")], adaptive_dpi=True).
+    Raises TypeError for an unknown option."""
+
+    def __init__(self, **options):
+        self.books = []
+        self.cache_folder = DEFAULT_CACHE_FOLDER  # None disables the cache
+        self.cache_max_bytes = DEFAULT_CACHE_MAX_MB * 1024 * 1024
+        self.resume = False
+        self.batch_size = 1
+        self.gcs_bucket = None
+        self.render_workers = os.cpu_count() or 1
+        self.image_format = "png"
+        self.jpeg_quality = 85
+        self.hybrid = False
+        self.max_rpm = DEFAULT_MAX_RPM
+        self.max_concurrency = DEFAULT_MAX_CONCURRENCY
+        self.max_retries = DEFAULT_MAX_RETRIES
+        self.latency_target = DEFAULT_LATENCY_TARGET
+        self.engine = "threads"
+        self.queue_size = DEFAULT_QUEUE_SIZE
+        self.memory_budget_bytes = DEFAULT_MEMORY_BUDGET_MB * 1024 * 1024
+        self.ocr_backend = "vision"
+        self.tesseract_lang = DEFAULT_TESSERACT_LANG
+        self.tesseract_workers = os.cpu_count() or 1
+        self.fallback_confidence = 0.0
+        self.vision_endpoint = None
+        self.stats_json = None
+        self.text_layout = "paragraphs"
+        self.rerender = False
+        self.docx = False
+        self.searchable_pdf = False
+        self.adaptive_dpi = False
+        self.target_x_height = DEFAULT_TARGET_X_HEIGHT
+        self.deskew = False
+        self.binarize = False
+        self.dpi_report = 0
+        self.skip_blank = False
+        self.skip_duplicates = False
+        self.duplicate_distance = DEFAULT_DUPLICATE_DISTANCE
+        self.mosaic = False
+        self.auto_crop = False
+        self.shard = None  # a Shard
+        self.merge = False
+
+        for name, value in options.items():
+            if not hasattr(self, name):
+                raise TypeError(f"Unknown option {name}")
+            setattr(self, name, value)
+
+    def check(self):
+        """Raise ValueError for options that can't be used together"""
+        if self.gcs_bucket and self.ocr_backend != "vision":
+            raise ValueError("--gcs-bucket needs the vision OCR backend")
+        if self.mosaic and (self.engine != "threads" or self.gcs_bucket):
+            raise ValueError("--mosaic needs the threads engine")
+        if self.shard and (self.merge or self.rerender):
+            raise ValueError("--shard can't be used with --merge or --rerender")
+
+def parse_args(argv=None, parser=None):
+    """Parse command line arguments, from sys.argv without argv. Returns the
+    arguments and the Options of the run."""
+    if parser is None:
+        parser = build_parser()
+    args = parser.parse_args(argv)
 
-def init():
-    """Create clean output folder"""
+    try:
+        shard = Shard(args.shard) if args.shard else None
+    except ValueError as e:
+        parser.error(f"--shard: {e}")
+
+    options = Options(
+        books=[] if args.serve else load_books(args),
+        cache_folder=None if args.no_cache else args.cache_dir,
+        cache_max_bytes=args.cache_max_mb * 1024 * 1024,
+        resume=args.resume,
+        batch_size=max(1, min(args.batch_size, MAX_BATCH_SIZE)),
+        gcs_bucket=args.gcs_bucket,
+        render_workers=max(1, args.render_workers),
+        image_format=args.image_format,
+        jpeg_quality=max(1, min(args.jpeg_quality, 100)),
+        hybrid=args.hybrid,
+        max_rpm=max(1, args.max_rpm),
+        max_concurrency=max(1, args.max_concurrency),
+        max_retries=max(0, args.max_retries),
+        latency_target=args.latency_target,
+        engine=args.engine,
+        queue_size=max(1, args.queue_size),
+        memory_budget_bytes=max(0, args.memory_budget_mb) * 1024 * 1024,
+        ocr_backend=args.ocr_backend,
+        tesseract_lang=args.tesseract_lang,
+        tesseract_workers=max(1, args.tesseract_workers),
+        fallback_confidence=args.vision_fallback_confidence,
+        vision_endpoint=args.vision_endpoint,
+        stats_json=args.stats_json,
+        text_layout=args.text_layout,
+        rerender=args.rerender,
+        docx=args.docx,
+        searchable_pdf=args.searchable_pdf,
+        adaptive_dpi=args.adaptive_dpi,
+        target_x_height=max(1, args.target_x_height),
+        deskew=args.deskew,
+        binarize=args.binarize,
+        dpi_report=max(0, args.dpi_report),
+        skip_blank=args.skip_blank,
+        skip_duplicates=args.skip_duplicates,
+        duplicate_distance=max(0, min(args.duplicate_distance, 64)),
+        mosaic=args.mosaic,
+        auto_crop=args.auto_crop,
+        shard=shard,
+        merge=args.merge,
+    )
+    try:
+        options.check()
+    except ValueError as e:
+        parser.error(str(e))
+
+    return args, options
+
+class Book:
+    """A PDF to extract text from, with its own page range, crop and output folder"""
+
+    def __init__(self, pdf_path, start_page=None, end_page=None, top_crop=0.0, bottom_crop=0.0):
+        self.pdf_path = pdf_path
+        # Extract filename without extension for prefix
+        self.name = os.path.splitext(os.path.basename(pdf_path))[0]
+        # Set output folder in same directory as input file
+        self.output_folder = os.path.join(os.path.dirname(pdf_path), f"output_{self.name}")
+        self.manifest_file = os.path.join(self.output_folder, "manifest.json")
+        self.start_page = start_page  # 0-based
+        self.end_page = end_page  # 0-based
+        self.top_crop = top_crop
+        self.bottom_crop = bottom_crop
+
+        # Run state, set by prepare_book()
+        self.shard_name = None
+        self.pages = []
+        self.params = None
+        self.page_crops = {}
+        self.manifest = None
+        self.journal_file = None
+        self.input_hash = None
+        self.combined_writer = None
+        self.failed_pages = []
+        self.report_file = None
+        self.reports = []
+
+def load_books(args):
+    """Build the list of books to process from --filename, --directory or --jobs"""
+    def make_book(pdf_path, options):
+        start_page = options.get("start_page", args.start_page)
+        end_page = options.get("end_page", args.end_page)
+        return Book(
+            pdf_path,
+            start_page=start_page - 1 if start_page else None,  # Convert to 0-based
+            end_page=end_page - 1 if end_page else None,  # Convert to 0-based
+            top_crop=options.get("top_crop", args.top_crop),
+            bottom_crop=options.get("bottom_crop", args.bottom_crop),
+        )
+
+    if args.filename:
+        return [make_book(args.filename, {})]
+
+    if args.directory:
+        names = sorted(name for name in os.listdir(args.directory) if name.lower().endswith(".pdf"))
+        return [make_book(os.path.join(args.directory, name), {}) for name in names]
+
+    with open(args.jobs, 'r', encoding='utf-8') as f:
+        jobs = json.load(f)
+    # Relative filenames are relative to the jobs file
+    jobs_dir = os.path.dirname(os.path.abspath(args.jobs))
+    return [make_book(os.path.join(jobs_dir, job["filename"]), job) for job in jobs]
+
+def parse_page_list(text):
+    """0-based page numbers of a list of 1-based pages and ranges like "1-100,250".
+    Raises ValueError if it is malformed."""
+    pages = set()
+    for part in text.split(","):
+        match = re.fullmatch(r"\s*(\d+)\s*(?:-\s*(\d+)\s*)?", part)
+        if not match:
+            raise ValueError(f"invalid page list {text!r}")
+        first = int(match[1])
+        last = int(match[2]) if match[2] else first
+        if first < 1 or last < first:
+            raise ValueError(f"invalid page range {part.strip()!r}")
+        pages.update(range(first - 1, last))
+    return pages
+
+def format_page_list(pages):
+    """Compact list of 1-based pages and ranges for 0-based page numbers, e.g. "1-100,250" """
+    ranges = []
+    for page_num in sorted(pages):
+        if ranges and page_num == ranges[-1][1] + 1:
+            ranges[-1][1] = page_num
+        else:
+            ranges.append([page_num, page_num])
+    return ",".join(f"{first + 1}" if first == last else f"{first + 1}-{last + 1}" for first, last in ranges)
+
+class Shard:
+    """The part of each book's page range done by one of several runs sharing
+    the output folder: "i/N" is the i-th of N contiguous parts, a page list
+    like "1-100,250" takes those pages"""
+
+    def __init__(self, spec):
+        self.spec = spec.strip()
+        match = re.fullmatch(r"(\d+)/(\d+)", self.spec)
+        if match:
+            self.index, self.count = int(match[1]), int(match[2])
+            if not 1 <= self.index <= self.count:
+                raise ValueError(f"shard {self.spec} is out of range")
+            self.pages = None
+            self.name = f"shard_{self.index}_of_{self.count}"
+        else:
+            self.pages = parse_page_list(self.spec)
+            self.name = f"pages_{format_page_list(self.pages).replace(',', '_')}"
+            if len(self.name) > 64:
+                self.name = f"pages_{hashlib.sha256(self.name.encode()).hexdigest()[:16]}"
+
+    def select(self, pages):
+        """The shard's pages out of a book's page range"""
+        if self.pages is not None:
+            return [page_num for page_num in pages if page_num in self.pages]
+        return pages[len(pages) * (self.index - 1) // self.count:len(pages) * self.index // self.count]
+
+def page_label(book, page_num):
+    """Human readable name of a page for log messages"""
+    return f"{book.name} page {page_num + 1}"
+
+def init(book, options):
+    """Create clean output folder, or keep the existing one when resuming. Shard
+    runs share the output folder and always keep it."""
+    if (options.resume or options.shard) and os.path.exists(book.output_folder):
+        logger.info(f"Resuming in existing output folder: {book.output_folder}")
     # Remove existing output folder if it exists
-    if os.path.exists(OUTPUT_FOLDER):
-        shutil.rmtree(OUTPUT_FOLDER)
-        logger.info(f"Removed existing output folder: {OUTPUT_FOLDER}")
+    elif os.path.exists(book.output_folder):
+        shutil.rmtree(book.output_folder)
+        logger.info(f"Removed existing output folder: {book.output_folder}")
     
     # Create fresh output folder
-    os.makedirs(OUTPUT_FOLDER, exist_ok=True)
-    logger.info(f"Created output folder: {OUTPUT_FOLDER}")
+    os.makedirs(book.output_folder, exist_ok=True)
+    logger.info(f"Created output folder: {book.output_folder}")
+
+class OcrCache:
+    """Content-addressed OCR results on disk, by cache_key(), evicting the least
+    recently used entries once the folder grows beyond max_bytes. Shared by all
+    worker threads. A folder of None disables the cache."""
+
+    def __init__(self, folder, max_bytes):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+        if not folder:
+            logger.info("OCR cache disabled")
+            return
+        os.makedirs(folder, exist_ok=True)
+        self.size_bytes = sum(size for _, size, _ in self.list_entries())
+        logger.info(f"Using OCR cache: {folder} ({self.size_bytes / (1024 * 1024):.1f} MB)")
+
+    def list_entries(self):
+        """Return (path, size, mtime) for every entry in the OCR cache"""
+        entries = []
+        for root, _, files in os.walk(self.folder):
+            for name in files:
+                # Entries of older versions are counted too, so they get evicted
+                if name.endswith(".tmp"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((path, stat.st_size, stat.st_mtime))
+        return entries
+
+    def path(self, key):
+        """Location of a cache entry, sharded by the first two hex digits"""
+        return os.path.join(self.folder, key[:2], f"{key}.pb.z")
+
+    def get(self, key):
+        """Return the cached annotation for key, or None on a miss"""
+        if not self.folder:
+            return None
+
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as f:
+                annotation = f.read()
+            # Touch the entry so that eviction is least-recently-used
+            os.utime(path)
+        except OSError:
+            with self.lock:
+                self.misses += 1
+            return None
+
+        with self.lock:
+            self.hits += 1
+        return annotation
+
+    def put(self, key, annotation):
+        """Store an annotation for key and evict old entries if the cache grew too large"""
+        if not self.folder:
+            return
+
+        path = self.path(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp_path, 'wb') as f:
+                f.write(annotation)
+            # A rerendered or re-OCR'd page replaces its entry, which must not be counted twice
+            try:
+                replaced_size = os.path.getsize(path)
+            except OSError:
+                replaced_size = 0
+            os.replace(tmp_path, path)
+            size = os.path.getsize(path)
+        except OSError as e:
+            logger.warning(f"Could not write OCR cache entry {key}: {e}")
+            return
+
+        with self.lock:
+            self.size_bytes += size - replaced_size
+            if self.size_bytes > self.max_bytes:
+                self.evict()
+
+    def evict(self):
+        """Delete least recently used entries until the cache is at 90% of its limit.
+        Must be called with the lock held."""
+        entries = sorted(self.list_entries(), key=lambda entry: entry[2])
+        self.size_bytes = sum(size for _, size, _ in entries)
+        target = int(self.max_bytes * 0.9)
+        removed = 0
+
+        for path, size, _ in entries:
+            if self.size_bytes <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self.size_bytes -= size
+            removed += 1
+
+        logger.info(f"Evicted {removed} OCR cache entries ({self.size_bytes / (1024 * 1024):.1f} MB left)")
+
+def ocr_params(book, options):
+    """OCR parameters which, together with the image bytes, identify a result"""
+    params = {
+        "zoom": "auto" if options.adaptive_dpi else RENDER_ZOOM,
+        "target_x_height": options.target_x_height if options.adaptive_dpi else None,
+        "deskew": options.deskew,
+        "binarize": options.binarize,
+        "top_crop": book.top_crop,
+        "bottom_crop": book.bottom_crop,
+        "format": options.image_format,
+        "jpeg_quality": options.jpeg_quality if options.image_format == "jpeg" else None,
+    }
+    # Only present when set, so results of earlier runs stay valid
+    if options.auto_crop:
+        params["auto_crop"] = True
+    params.update(ocr_backend.params())
+    return params
+
+def cache_key(book, img_bytes):
+    """Content address of an OCR result: hash of image bytes plus the OCR
+    parameters of the book, set by prepare_book()"""
+    digest = hashlib.sha256(img_bytes)
+    digest.update(json.dumps(book.params, sort_keys=True).encode('utf-8'))
+    return digest.hexdigest()
+
+def file_hash(path):
+    """SHA-256 of a file, read in chunks. Remembered while the file is unchanged,
+    so later runs in the same process don't read the whole PDF again."""
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+    if key not in file_hashes:
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+        file_hashes[key] = digest.hexdigest()
+    return file_hashes[key]
+
+def load_manifest(book, path=None):
+    """Load the run manifest from the output folder, or another manifest of the
+    book from path, or an empty one, with the pages recorded in its journal
+    since it was last saved"""
+    path = path or book.manifest_file
+    manifest = {"source": book.pdf_path, "pages": {}}
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError) as e:
+        logger.warning(f"Ignoring unreadable manifest {path}: {e}")
+    manifest.setdefault("pages", {})
+
+    try:
+        with open(journal_filename(path), 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # The last line of a crashed run may be cut off
+                    continue
+                manifest["pages"][record["page"]] = record["entry"]
+    except FileNotFoundError:
+        pass
+    return manifest
+
+def journal_filename(manifest_file):
+    """Path of the journal of a manifest: one JSON line per page recorded since
+    the manifest was last saved"""
+    return f"{manifest_file}.journal"
+
+def save_manifest(book):
+    """Atomically write the run manifest, so a crash never leaves it half
+    written, and drop the journal it now includes"""
+    tmp_path = f"{book.manifest_file}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(book.manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, book.manifest_file)
+    if book.journal_file is not None:
+        book.journal_file.close()
+        book.journal_file = None
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(journal_filename(book.manifest_file))
+
+def journal_page(book, page_num):
+    """Append the manifest entry of a page to the journal. Rewriting the whole
+    manifest after every page would cost time growing with the square of the
+    page count; the manifest is saved once the book is done."""
+    if book.journal_file is None:
+        book.journal_file = open(journal_filename(book.manifest_file), 'a', encoding='utf-8')
+    page = str(page_num + 1)
+    book.journal_file.write(json.dumps({"page": page, "entry": book.manifest["pages"][page]}) + "\n")
+    book.journal_file.flush()
+
+def is_page_done(book, page_num, options):
+    """A page is done if it succeeded with the same input and parameters and its file exists.
+    Skipped pages are only done while they are still being skipped."""
+    entry = book.manifest["pages"].get(str(page_num + 1))
+    return (
+        entry is not None
+        and entry.get("status") == "done"
+        and entry.get("input_hash") == book.input_hash
+        and entry.get("params") == book.params
+        and (entry.get("source") != "blank" or options.skip_blank)
+        and (entry.get("source") != "duplicate" or options.skip_duplicates)
+        and os.path.exists(page_filename(book, page_num))
+    )
+
+def record_page(book, page_num, status, source="ocr", **details):
+    """Record the outcome of a page, where its text came from and the zoom and
+    angle it was rendered with in the manifest"""
+    entry = {
+        "input_hash": book.input_hash,
+        "params": book.params,
+        "status": status,
+        "source": source,
+    }
+    entry.update(details)
+    if page_num in book.page_crops:
+        entry["crop"] = list(page_crop(book, page_num))
+    with metrics_lock:
+        metrics = page_metrics.get((book.pdf_path, page_num), {})
+        if "zoom" in metrics:
+            entry["render"] = {"zoom": metrics["zoom"], "angle": metrics["angle"]}
+    book.manifest["pages"][str(page_num + 1)] = entry
+
+def page_crop(book, page_num):
+    """Top and bottom crop of a page in percent: the book's, or the header and
+    footer crop detected with --auto-crop where that is larger"""
+    top_crop, bottom_crop = book.page_crops.get(page_num, (0.0, 0.0))
+    return max(book.top_crop, top_crop), max(book.bottom_crop, bottom_crop)
+
+def crop_rect(page, top_crop, bottom_crop):
+    """Clip rectangle for a top/bottom crop in percent, None for the full page"""
+    if top_crop <= 0 and bottom_crop <= 0:
+        return None
+
+    # Convert percentages to page coordinates
+    rect = page.rect
+    top = rect.y0 + (top_crop / 100.0) * rect.height
+    bottom = rect.y1 - (bottom_crop / 100.0) * rect.height
+
+    # Ensure crop bounds are valid
+    if bottom <= top:
+        logger.warning(f"Invalid crop bounds for page {page.number + 1}, skipping crop")
+        return None
+
+    logger.debug(f"Cropped page {page.number + 1}: top={top_crop}%, bottom={bottom_crop}%")
+    return fitz.Rect(rect.x0, top, rect.x1, bottom)
+
+def is_bad_char(ch):
+    """Characters that show up when a text layer does not map to real Unicode"""
+    code = ord(ch)
+    return (
+        ch == "\ufffd"                   # replacement character
+        or 0x80 <= code <= 0xff          # Latin-1 symbols used by legacy Indic fonts
+        or 0xe000 <= code <= 0xf8ff      # private use area
+        or (code < 0x20 and ch not in "\t\n\r")
+    )
 
-def extract_page_as_image(pdf_document, page_num):
-    """Extract a single PDF page as PIL Image object with optional cropping"""
+def extract_text_layer(page, top_crop, bottom_crop):
+    """Return the embedded text of a page if it is usable Unicode and covers the
+    page's images, None if the page needs OCR.
+    Text is formatted like the OCR output: one paragraph per text block."""
+    for font in page.get_fonts():
+        font_name = font[3].lower()
+        if any(pattern in font_name for pattern in LEGACY_FONT_PATTERNS):
+            logger.debug(f"Page {page.number + 1} uses legacy font {font[3]}, needs OCR")
+            return None
+
+    clip = crop_rect(page, top_crop, bottom_crop)
+    area = clip or page.rect
+    paragraphs = []
+    text_area = 0.0
+    for block in page.get_text("blocks", clip=clip):
+        # Skip image blocks
+        if block[6] != 0:
+            continue
+        paragraph_text = " ".join(block[4].split())
+        if paragraph_text:
+            paragraphs.append(paragraph_text)
+            text_area += abs(fitz.Rect(block[:4]) & area)
+    text = "\n\n".join(paragraphs)
+
+    # Text next to a scanned image covers only a small part of what is on the page
+    image_area = min(abs(area), sum(abs(fitz.Rect(image["bbox"]) & area) for image in page.get_image_info()))
+    if image_area >= MIN_IMAGE_COVERAGE * abs(area) and text_area < MIN_TEXT_IMAGE_RATIO * image_area:
+        logger.debug(f"Page {page.number + 1} is mostly image ({image_area / abs(area):.0%}), needs OCR")
+        return None
+
+    chars = [ch for ch in text if not ch.isspace()]
+    if len(chars) < MIN_TEXT_LAYER_CHARS:
+        return None
+
+    bad_chars = sum(1 for ch in chars if is_bad_char(ch))
+    if bad_chars / len(chars) > MAX_BAD_CHAR_RATIO:
+        logger.debug(f"Page {page.number + 1} text layer looks garbled ({bad_chars}/{len(chars)}), needs OCR")
+        return None
+
+    return text
+
+def pixmap_array(pix):
+    """Samples of a grayscale pixmap as a 2-D NumPy array"""
+    return np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.stride)[:, :pix.width]
+
+def otsu_threshold(gray):
+    """Gray level separating ink from paper, by Otsu's method"""
+    hist = np.bincount(gray.ravel(), minlength=256).astype(np.float64)
+    weight_dark = np.cumsum(hist)
+    weight_light = weight_dark[-1] - weight_dark
+    level_sum = np.cumsum(hist * np.arange(256))
+    mean_dark = level_sum / np.maximum(weight_dark, 1)
+    mean_light = (level_sum[-1] - level_sum) / np.maximum(weight_light, 1)
+    return int(np.argmax(weight_dark * weight_light * (mean_dark - mean_light) ** 2))
+
+def row_profile(ink, angle):
+    """Ink pixels per row of a binary image turned by angle degrees"""
+    ys, xs = np.nonzero(ink)
+    theta = np.radians(angle)
+    rows = ys * np.cos(theta) + xs * np.sin(theta)
+    return np.bincount(np.round(rows - rows.min()).astype(np.int64))
+
+def estimate_skew(ink):
+    """Angle in degrees that lines up the text rows best: the row profile of
+    straight text has the sharpest peaks, i.e. the largest sum of squares"""
+    angles = np.arange(-MAX_SKEW_DEGREES, MAX_SKEW_DEGREES + SKEW_STEP_DEGREES / 2, SKEW_STEP_DEGREES)
+    scores = [np.square(row_profile(ink, angle).astype(np.float64)).sum() for angle in angles]
+    return float(angles[int(np.argmax(scores))])
+
+def estimate_x_height(profile):
+    """Median x-height in pixels of the text lines in a row profile, None without text"""
+    if profile.size == 0 or profile.max() == 0:
+        return None
+    is_text = np.concatenate(([False], profile > max(1, profile.max() * 0.05), [False]))
+    edges = np.flatnonzero(is_text[1:] != is_text[:-1])
+    low, high = (1 - X_HEIGHT_INK_SHARE) / 2, (1 + X_HEIGHT_INK_SHARE) / 2
+    heights = []
+    for top, bottom in zip(edges[0::2], edges[1::2]):
+        if bottom - top < 2:
+            continue
+        # Share of the line's ink above every row boundary, interpolated for sub-pixel heights
+        share = np.concatenate(([0.0], np.cumsum(profile[top:bottom], dtype=np.float64)))
+        share /= share[-1]
+        rows = np.arange(share.size)
+        heights.append(np.interp(high, share, rows) - np.interp(low, share, rows))
+    return float(np.median(heights)) if heights else None
+
+def analyse_page(page, clip, adaptive, deskew, target_x_height=DEFAULT_TARGET_X_HEIGHT):
+    """Probe a page at low resolution. Returns (zoom, angle): with adaptive the zoom
+    that brings the x-height of the text to target_x_height pixels, with deskew the
+    angle in degrees that straightens the page."""
+    pix = page.get_pixmap(matrix=fitz.Matrix(PROBE_ZOOM, PROBE_ZOOM), clip=clip, colorspace=fitz.csGRAY)
+    gray = pixmap_array(pix)
+    ink = gray <= otsu_threshold(gray)
+    if not ink.any() or ink.mean() > 0.5:
+        # Blank or mostly dark page, nothing to measure
+        return RENDER_ZOOM, 0.0
+
+    angle = estimate_skew(ink) if deskew else 0.0
+    zoom = RENDER_ZOOM
+    if adaptive:
+        x_height = estimate_x_height(row_profile(ink, angle))
+        if x_height:
+            x_height /= PROBE_ZOOM  # in points
+            zoom = round(target_x_height / x_height / ZOOM_STEP) * ZOOM_STEP
+            zoom = min(MAX_ZOOM, max(MIN_ZOOM, zoom))
+    return zoom, angle
+
+def render_matrix(zoom, angle):
+    """Render transformation for a zoom and a deskew angle"""
+    return fitz.Matrix(zoom, zoom).prerotate(angle)
+
+def render_pixmap(page, clip, zoom, angle, options):
+    """Render a page region, in color for png and gray otherwise, thresholded to
+    black and white with --binarize"""
+    mat = render_matrix(zoom, angle)
+    if options.image_format == "png" and not options.binarize:
+        return page.get_pixmap(matrix=mat, clip=clip)
+    pix = page.get_pixmap(matrix=mat, clip=clip, colorspace=fitz.csGRAY)
+    if options.binarize:
+        gray = pixmap_array(pix)
+        binary = np.where(gray > otsu_threshold(gray), 255, 0).astype(np.uint8)
+        pix = fitz.Pixmap(fitz.csGRAY, pix.width, pix.height, binary.tobytes(), False)
+    return pix
+
+def encode_pixmap(pix, options):
+    """Encode a rendered page in the --image-format"""
+    if options.image_format == "jpeg":
+        return pix.tobytes("jpg", jpg_quality=options.jpeg_quality)
+    return pix.tobytes("png")
+
+def ink_darkness(gray):
+    """How many gray levels each pixel is darker than the paper, which is the
+    brightest tenth of the page"""
+    paper = np.percentile(gray, 90) if gray.size else 255
+    return np.clip(paper - gray.astype(np.float32), 0, None)
+
+def ink_coverage(gray):
+    """Share of a page that is ink, without the border"""
+    height, width = gray.shape
+    dy, dx = int(height * BLANK_MARGIN_RATIO), int(width * BLANK_MARGIN_RATIO)
+    inner = gray[dy:height - dy, dx:width - dx]
+    if inner.size == 0:
+        return 0.0
+    return float(np.count_nonzero(ink_darkness(inner) > INK_CONTRAST) / inner.size)
+
+def shrink(gray, rows, cols):
+    """Area average of an image down to rows x cols"""
+    row_edges = np.linspace(0, gray.shape[0], rows + 1).astype(np.int64)
+    col_edges = np.linspace(0, gray.shape[1], cols + 1).astype(np.int64)
+    sums = np.add.reduceat(np.add.reduceat(gray.astype(np.float64), row_edges[:-1], axis=0), col_edges[:-1], axis=1)
+    return sums / np.outer(np.diff(row_edges), np.diff(col_edges))
+
+def perceptual_hash(gray):
+    """64-bit DCT hash of a page: which of the lowest 8x8 frequencies of a
+    PHASH_SIZE thumbnail are above their median. Similar pages differ in few bits.
+    None if the image is too small."""
+    if min(gray.shape) < PHASH_SIZE:
+        return None
+    k = np.arange(PHASH_SIZE)
+    dct = np.cos(np.pi * (2 * k[None, :] + 1) * k[:, None] / (2 * PHASH_SIZE))
+    low = (dct @ shrink(gray, PHASH_SIZE, PHASH_SIZE) @ dct.T)[:8, :8].ravel()
+    # The DC term is the mean brightness and is left out of the median
+    return int.from_bytes(np.packbits(low > np.median(low[1:])).tobytes(), "big")
+
+def overlay_similarity(a, b):
+    """Normalized cross-correlation of two ink darkness images at the best shift of up to
+    DUPLICATE_MAX_SHIFT pixels, 1.0 for identical images"""
+    shift = DUPLICATE_MAX_SHIFT
+    height = max(a.shape[0], b.shape[0]) + shift
+    width = max(a.shape[1], b.shape[1]) + shift
+    padded = []
+    for image in (a, b):
+        canvas = np.zeros((height, width))
+        canvas[:image.shape[0], :image.shape[1]] = image - image.mean()
+        padded.append(canvas)
+    norm = np.sqrt(np.square(padded[0]).sum() * np.square(padded[1]).sum())
+    if norm == 0:
+        return 0.0
+    correlation = np.fft.irfft2(np.fft.rfft2(padded[0]) * np.conj(np.fft.rfft2(padded[1])), s=(height, width))
+    # Circular correlation: small negative shifts wrap around to the end
+    rows = np.r_[0:shift + 1, height - shift:height]
+    cols = np.r_[0:shift + 1, width - shift:width]
+    return float(correlation[np.ix_(rows, cols)].max() / norm)
+
+def extract_page_as_image(pdf_document, page_num, top_crop, bottom_crop, options, timings=None):
+    """Render a single PDF page as encoded image bytes. Cropping is applied as a
+    clip rectangle while rendering, so the image is encoded exactly once.
+    Returns (image bytes, tile): with --mosaic a page with little text is not
+    encoded, tile is its text cropped out for a mosaic instead. Both are None
+    if the page could not be rendered.
+    Seconds spent in each step, and the zoom and angle used, are added to the
+    timings dict if one is given."""
+    if timings is None:
+        timings = {}
     try:
+        step = time.perf_counter()
         page = pdf_document[page_num]
-        # Render page as image with high resolution (300 DPI equivalent)
-        mat = fitz.Matrix(2.0, 2.0)  # 2.0 = 144 DPI, adjust for quality vs speed
-        pix = page.get_pixmap(matrix=mat)
-
-        # Convert to PIL Image
-        img_data = pix.tobytes("png")
-        img = Image.open(io.BytesIO(img_data))
-        
-        # Apply cropping if specified (percentage-based)
-        if TOP_CROP > 0 or BOTTOM_CROP > 0:
-            width, height = img.size
-            
-            # Convert percentages to pixels
-            top_pixels = int((TOP_CROP / 100.0) * height)
-            bottom_pixels = int((BOTTOM_CROP / 100.0) * height)
-            
-            left = 0
-            top = top_pixels
-            right = width
-            bottom = height - bottom_pixels
-            
-            # Ensure crop bounds are valid
-            if bottom > top and right > left:
-                img = img.crop((left, top, right, bottom))
-                logger.debug(f"Cropped page {page_num + 1}: top={TOP_CROP}% ({top_pixels}px), bottom={BOTTOM_CROP}% ({bottom_pixels}px)")
-            else:
-                logger.warning(f"Invalid crop bounds for page {page_num + 1}, skipping crop")
-        
-        return img
+        clip = crop_rect(page, top_crop, bottom_crop)
+        timings["crop"] = time.perf_counter() - step
+
+        zoom, angle = RENDER_ZOOM, 0.0
+        if options.adaptive_dpi or options.deskew:
+            step = time.perf_counter()
+            zoom, angle = analyse_page(page, clip, options.adaptive_dpi, options.deskew, options.target_x_height)
+            timings["analyse"] = time.perf_counter() - step
+        timings["zoom"] = zoom
+        timings["angle"] = angle
+
+        # Render page as image with high resolution
+        step = time.perf_counter()
+        pix = render_pixmap(page, clip, zoom, angle, options)
+        timings["render"] = time.perf_counter() - step
+
+        if options.mosaic:
+            tile = sparse_tile(pix)
+            if tile is not None:
+                timings["fill"] = tile["image"].shape[0] / pix.height
+                return None, tile
+
+        step = time.perf_counter()
+        img_bytes = encode_pixmap(pix, options)
+        timings["encode"] = time.perf_counter() - step
+        return img_bytes, None
     except Exception as e:
         logger.error(f"Error extracting page {page_num + 1}: {e}")
+        return None, None
+
+def sparse_tile(pix):
+    """Mosaic tile of a rendered page whose text takes up at most MOSAIC_MAX_FILL
+    of its height: the grayscale pixels around the text, where they were cut from
+    and the size of the rendering. None for pages with more or without text."""
+    if pix.n != 1:
+        pix = fitz.Pixmap(fitz.csGRAY, pix)
+    gray = pixmap_array(pix)
+    ink = ink_darkness(gray) > INK_CONTRAST
+    rows = np.flatnonzero(ink.sum(axis=1) > pix.width * MOSAIC_MIN_INK)
+    cols = np.flatnonzero(ink.sum(axis=0) > pix.height * MOSAIC_MIN_INK)
+    if rows.size == 0 or cols.size == 0:
+        return None
+    y0 = max(0, int(rows[0]) - MOSAIC_PADDING)
+    y1 = min(pix.height, int(rows[-1]) + 1 + MOSAIC_PADDING)
+    if y1 - y0 > pix.height * MOSAIC_MAX_FILL:
+        return None
+    x0 = max(0, int(cols[0]) - MOSAIC_PADDING)
+    x1 = min(pix.width, int(cols[-1]) + 1 + MOSAIC_PADDING)
+    return {"image": gray[y0:y1, x0:x1].copy(), "x": x0, "y": y0, "width": pix.width, "height": pix.height}
+
+def mosaic_fits(tiles, tile):
+    """Whether a tile can be added to a mosaic of tiles within the mosaic limits"""
+    if not tiles:
+        return True
+    height = sum(t["image"].shape[0] + MOSAIC_GAP for t in tiles) + tile["image"].shape[0]
+    width = max(t["image"].shape[1] for t in tiles + [tile])
+    return len(tiles) < MOSAIC_MAX_PAGES and height <= MOSAIC_MAX_HEIGHT and width * height <= MOSAIC_MAX_PIXELS
+
+def compose_mosaic(tiles):
+    """Stack tiles into one white grayscale pixmap. Returns (pixmap, top of each tile)"""
+    width = max(tile["image"].shape[1] for tile in tiles)
+    height = sum(tile["image"].shape[0] for tile in tiles) + MOSAIC_GAP * (len(tiles) - 1)
+    canvas = np.full((height, width), 255, dtype=np.uint8)
+    tops = []
+    top = 0
+    for tile in tiles:
+        tile_height, tile_width = tile["image"].shape
+        canvas[top:top + tile_height, :tile_width] = tile["image"]
+        tops.append(top)
+        top += tile_height + MOSAIC_GAP
+    return fitz.Pixmap(fitz.csGRAY, width, height, canvas.tobytes(), False), tops
+
+def get_vision_client(endpoint=None):
+    """Create the Vision client on first use, so runs that never call Vision
+    don't need Google credentials. The client is kept for later runs in the same
+    process as long as they use the same endpoint, None for Google's."""
+    global vision_client, vision_client_endpoint
+    with vision_client_lock:
+        if vision_client is None or vision_client_endpoint != endpoint:
+            if endpoint:
+                # Only needed for the stub endpoint
+                from google.auth.credentials import AnonymousCredentials
+                vision_client = vision.ImageAnnotatorClient(
+                    transport="rest",
+                    credentials=AnonymousCredentials(),
+                    client_options={"api_endpoint": endpoint},
+                )
+            else:
+                vision_client = vision.ImageAnnotatorClient()
+            vision_client_endpoint = endpoint
+    return vision_client
+
+def record_metrics(book, page_num, **values):
+    """Add measurements for a page"""
+    with metrics_lock:
+        page_metrics.setdefault((book.pdf_path, page_num), {}).update(values)
+
+def page_report(book, page_num):
+    """Report record of a page from its measurements"""
+    with metrics_lock:
+        record = {"page": page_num + 1}
+        record.update(page_metrics.get((book.pdf_path, page_num), {}))
+    if "attempts" in record:
+        record["retries"] = record["attempts"] - 1
+    return {key: round(value, 6) if isinstance(value, float) else value for key, value in record.items()}
+
+def summarize_reports(records):
+    """Percentiles of every report stage over page records, and the Vision cost"""
+    stages = {}
+    for stage in REPORT_STAGES:
+        values = [record[stage] for record in records if stage in record]
+        if values:
+            stages[stage] = {
+                "count": len(values),
+                "p50": percentile(values, 50),
+                "p90": percentile(values, 90),
+                "p99": percentile(values, 99),
+                "max": max(values),
+                "total": sum(values),
+            }
+    vision_units = sum(record.get("vision_units", 0) for record in records)
+    return {
+        "pages": len(records),
+        "cache_hits": sum(1 for record in records if record.get("cache") == "hit"),
+        "failed": sum(1 for record in records if record.get("status") == "failed"),
+        "skipped_blank": sum(1 for record in records if record.get("source") == "blank"),
+        "skipped_duplicate": sum(1 for record in records if record.get("source") == "duplicate"),
+        "stages": stages,
+        "vision_units": vision_units,
+        "estimated_cost_usd": round(vision_units * VISION_PRICE_PER_1000 / 1000, 4),
+    }
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a list of numbers, 0 for an empty list"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = math.ceil(pct / 100.0 * len(ordered))
+    return ordered[max(rank, 1) - 1]
+
+def encode_annotation(annotation):
+    """Compact stored form of a Vision TextAnnotation: serialized protobuf, zlib compressed"""
+    return zlib.compress(vision.TextAnnotation.serialize(annotation), ANNOTATION_COMPRESSION_LEVEL)
+
+def decode_annotation(data):
+    """TextAnnotation from its stored form"""
+    return vision.TextAnnotation.deserialize(zlib.decompress(data))
+
+def paragraph_lines(paragraph):
+    """Text of a paragraph keeping the spaces and line breaks detected by OCR"""
+    break_type = vision.TextAnnotation.DetectedBreak.BreakType
+    parts = []
+    for word in paragraph.words:
+        detected = break_type.UNKNOWN
+        for symbol in word.symbols:
+            parts.append(symbol.text)
+            detected = symbol.property.detected_break.type_
+            if detected in (break_type.SPACE, break_type.SURE_SPACE):
+                parts.append(" ")
+            elif detected in (break_type.EOL_SURE_SPACE, break_type.LINE_BREAK):
+                parts.append("\n")
+            elif detected == break_type.HYPHEN:
+                parts.append("-\n")
+        # Without break information words are still kept apart
+        if detected == break_type.UNKNOWN:
+            parts.append(" ")
+    return "".join(parts)
+
+def annotation_to_text(document, layout="paragraphs"):
+    """Flatten a Vision TextAnnotation into paragraphs separated by blank lines.
+    With the "paragraphs" layout the words of a paragraph are joined by spaces,
+    "lines" keeps the line breaks detected inside paragraphs."""
+    paragraphs = []
+    if document and document.pages:
+        page = document.pages[0]
+        for block in page.blocks:
+            for paragraph in block.paragraphs:
+                if layout == "lines":
+                    paragraph_text = paragraph_lines(paragraph)
+                else:
+                    paragraph_text = " ".join("".join(symbol.text for symbol in word.symbols)
+                                              for word in paragraph.words)
+                if paragraph_text.strip():
+                    paragraphs.append(paragraph_text.strip())
+    return "\n\n".join(paragraphs)
+
+def response_to_annotation(response, label, metrics):
+    """Stored form of the annotation of a single AnnotateImageResponse, None if
+    Vision reported an error for it"""
+    if response.error.message:
+        logger.error(f"Vision API error for {label}: {response.error.message}")
         return None
+    # Every annotated image is billed
+    metrics["vision_units"] = metrics.get("vision_units", 0) + 1
+    step = time.perf_counter()
+    annotation = encode_annotation(response.full_text_annotation)
+    metrics["parse"] = metrics.get("parse", 0.0) + time.perf_counter() - step
+    return annotation
+
+def record_upload(img_bytes, label, metrics):
+    """Count the bytes of an image about to be sent for OCR"""
+    global upload_bytes, upload_pages
+    with upload_lock:
+        upload_bytes += len(img_bytes)
+        upload_pages += 1
+    metrics["upload_bytes"] = metrics.get("upload_bytes", 0) + len(img_bytes)
+    logger.debug(f"Sending {label}: {len(img_bytes):,} bytes")
+
+def record_rpc(metrics, latency):
+    """Add one request attempt to the measurements of the pages it carried"""
+    for page in metrics:
+        page["rpc"] = page.get("rpc", 0.0) + latency
+        page["attempts"] = page.get("attempts", 0) + 1
+
+def take_rate_tokens(units, max_rpm):
+    """Take `units` tokens from the bucket refilled at max_rpm. Returns 0 on
+    success, otherwise the number of seconds to wait before trying again."""
+    global rate_tokens, rate_updated
+
+    rate_per_second = max_rpm / 60.0
+    capacity = max(float(units), rate_per_second)  # at most one second of burst
+    with rate_lock:
+        now = time.monotonic()
+        if rate_updated is None:
+            rate_tokens = capacity
+        else:
+            rate_tokens = min(capacity, rate_tokens + (now - rate_updated) * rate_per_second)
+        rate_updated = now
+        if rate_tokens >= units:
+            rate_tokens -= units
+            return 0
+        return (units - rate_tokens) / rate_per_second
+
+def acquire_rate_token(max_rpm, units=1):
+    """Block until the token bucket allows sending `units` more images"""
+    while True:
+        delay = take_rate_tokens(units, max_rpm)
+        if not delay:
+            return
+        time.sleep(delay)
 
-def detect_text_from_image(img, page_num, progress_bar):
-    """Extract text from PIL Image using Google Vision API"""
-    try:
-        # Convert PIL Image to bytes
-        img_byte_array = io.BytesIO()
-        img.save(img_byte_array, format='PNG')
-        img_bytes = img_byte_array.getvalue()
+async def acquire_rate_token_async(max_rpm, units=1):
+    """asyncio version of acquire_rate_token"""
+    while True:
+        delay = take_rate_tokens(units, max_rpm)
+        if not delay:
+            return
+        await asyncio.sleep(delay)
+
+def try_acquire_concurrency_slot(max_concurrency):
+    """Start a request if fewer than the current concurrency limit are in flight"""
+    global concurrency_in_flight, request_count
+    with concurrency_cond:
+        if concurrency_in_flight >= min(concurrency_limit, max_concurrency):
+            return False
+        concurrency_in_flight += 1
+        request_count += 1
+        return True
+
+def acquire_concurrency_slot(max_concurrency):
+    """Block until fewer requests than the current concurrency limit are in flight"""
+    with concurrency_cond:
+        while not try_acquire_concurrency_slot(max_concurrency):
+            concurrency_cond.wait()
+
+def release_concurrency_slot(latency, throttled, options):
+    """Finish a request and adapt the concurrency limit: additive increase after a
+    full window of fast successes, multiplicative decrease on throttling or slowness"""
+    global concurrency_in_flight, concurrency_limit, concurrency_successes, concurrency_last_decrease
+    with concurrency_cond:
+        concurrency_in_flight -= 1
+        now = time.monotonic()
+        if throttled or latency > options.latency_target:
+            if now - concurrency_last_decrease > DECREASE_COOLDOWN_SECONDS:
+                concurrency_limit = max(1, concurrency_limit // 2)
+                concurrency_last_decrease = now
+                concurrency_successes = 0
+                logger.debug(f"Reduced Vision concurrency to {concurrency_limit} (latency {latency:.1f}s, throttled={throttled})")
+        else:
+            concurrency_successes += 1
+            if concurrency_successes >= concurrency_limit and concurrency_limit < options.max_concurrency:
+                concurrency_limit += 1
+                concurrency_successes = 0
+        concurrency_cond.notify_all()
+
+def is_throttling_error(e):
+    """Quota and overload errors which mean we should slow down"""
+    return isinstance(e, (google_exceptions.TooManyRequests, google_exceptions.ResourceExhausted,
+                          google_exceptions.ServiceUnavailable))
+
+def is_retryable_error(e):
+    """Client errors other than throttling (bad image, permissions...) never succeed on retry"""
+    if isinstance(e, google_exceptions.ClientError):
+        return is_throttling_error(e)
+    return True
+
+def take_retry_budget():
+    """Use one retry from the per-run retry budget, False if it is exhausted"""
+    global retry_count
+    with concurrency_cond:
+        if retry_count >= RETRY_BUDGET_BASE + RETRY_BUDGET_RATIO * request_count:
+            return False
+        retry_count += 1
+        return True
+
+def retry_delay(description, e, attempt, latency, options):
+    """Account for a failed request. Returns the backoff delay (exponential with
+    full jitter) before the next attempt, or None if the request should fail."""
+    global throttle_count
+
+    throttled = is_throttling_error(e)
+    release_concurrency_slot(latency, throttled, options)
+    if throttled:
+        with concurrency_cond:
+            throttle_count += 1
+
+    if not is_retryable_error(e) or attempt == options.max_retries:
+        logger.error(f"Failed to process {description} after {attempt + 1} attempts: {e}")
+        return None
+    if not take_retry_budget():
+        logger.error(f"Failed to process {description}, retry budget exhausted: {e}")
+        return None
 
-        # Create Vision API image object
-        image = vision.Image(content=img_bytes)
+    delay = random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt))
+    logger.warning(f"Retrying {description} in {delay:.1f}s: {e}")
+    return delay
+
+def call_with_retry(options, description, func, *args, units=1, metrics=(), **kwargs):
+    """Call a Vision API method under the rate and concurrency limits of the
+    options, retrying throttling and transient errors with exponential backoff
+    and full jitter. Every attempt is added to the metrics dicts of the pages in
+    the request. Returns None on failure."""
+    for attempt in range(options.max_retries + 1):
+        acquire_rate_token(options.max_rpm, units)
+        acquire_concurrency_slot(options.max_concurrency)
+        started = time.monotonic()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            record_rpc(metrics, time.monotonic() - started)
+            delay = retry_delay(description, e, attempt, time.monotonic() - started, options)
+            if delay is None:
+                return None
+            time.sleep(delay)
+        else:
+            record_rpc(metrics, time.monotonic() - started)
+            release_concurrency_slot(time.monotonic() - started, False, options)
+            return result
+    return None
+
+async def call_with_retry_async(options, description, slot_cond, func, *args, units=1, metrics=(), **kwargs):
+    """asyncio version of call_with_retry. slot_cond is notified whenever a
+    request finishes, so waiting coroutines can recheck the concurrency limit."""
+    for attempt in range(options.max_retries + 1):
+        await acquire_rate_token_async(options.max_rpm, units)
+        async with slot_cond:
+            await slot_cond.wait_for(lambda: try_acquire_concurrency_slot(options.max_concurrency))
+        started = time.monotonic()
+        try:
+            result = await func(*args, **kwargs)
+        except Exception as e:
+            record_rpc(metrics, time.monotonic() - started)
+            delay = retry_delay(description, e, attempt, time.monotonic() - started, options)
+            async with slot_cond:
+                slot_cond.notify_all()
+            if delay is None:
+                return None
+            await asyncio.sleep(delay)
+        else:
+            record_rpc(metrics, time.monotonic() - started)
+            release_concurrency_slot(time.monotonic() - started, False, options)
+            async with slot_cond:
+                slot_cond.notify_all()
+            return result
+    return None
 
-        # Retry mechanism for Vision API
-        success = False
-        text_detection_response = None
+class OcrBackend:
+    """Turns encoded page images into annotations: a Vision TextAnnotation in the
+    stored form of encode_annotation(). Subclasses implement annotate and may
+    override the batched and asyncio variants."""
 
-        for attempt in range(2):
-            try:
-                text_detection_response = vision_client.document_text_detection(image=image)
-                success = True
-                break
-            except Exception as e:
-                if attempt == 0:
-                    time.sleep(1)  # Brief pause before retry
-                else:
-                    logger.error(f"Failed to process page {page_num + 1} after retries: {e}")
-
-        if success and text_detection_response:
-            document = text_detection_response.full_text_annotation
-            if document:
-                paragraphs = []
-                if document.pages:
-                    page = document.pages[0]
-                    for block in page.blocks:
-                        for paragraph in block.paragraphs:
-                            paragraph_text = ""
-                            for word in paragraph.words:
-                                word_text = ""
-                                for symbol in word.symbols:
-                                    word_text += symbol.text
-                                paragraph_text += word_text + " "
-                            if paragraph_text.strip():
-                                paragraphs.append(paragraph_text.strip())
-                text = "\n\n".join(paragraphs)
-            else:
-                text = ''
-        else:
-            text = ''
+    name = None
 
-        progress_bar.update(1)
-        return text, page_num
+    def params(self):
+        """Settings that change the OCR result, part of the cache key"""
+        raise NotImplementedError
 
-    except Exception as e:
-        logger.error(f"Error processing page {page_num + 1}: {e}")
-        progress_bar.update(1)
-        return '', page_num
+    def max_workers(self):
+        """Number of pages worth working on at the same time"""
+        raise NotImplementedError
 
-def process_single_page(pdf_path, page_num, progress_bar):
-    """Process a single page: extract image and get text"""
-    try:
-        # Open PDF document for this thread (fitz is thread-safe for read operations)
-        pdf_document = fitz.open(pdf_path)
+    def annotate(self, img_bytes, label, metrics):
+        """Annotation of one page image, None if OCR failed. Measurements of the
+        request (upload_bytes, rpc, attempts, parse) are added to metrics."""
+        raise NotImplementedError
 
-        # Extract page as image
-        img = extract_page_as_image(pdf_document, page_num)
-        pdf_document.close()
+    def annotate_batch(self, images):
+        """Annotations of several (image bytes, label, metrics) tuples, in the same order"""
+        return [self.annotate(img_bytes, label, metrics) for img_bytes, label, metrics in images]
 
-        if img is None:
-            progress_bar.update(1)
-            return '', page_num
+    async def annotate_async(self, img_bytes, label, metrics, slot_cond):
+        """asyncio version of annotate, by default on the loop's thread pool"""
+        return await asyncio.get_running_loop().run_in_executor(None, self.annotate, img_bytes, label, metrics)
+
+    def close(self):
+        """Release resources held by the backend"""
+
+class VisionBackend(OcrBackend):
+    """Google Vision document text detection, with batched and asyncio requests
+    under the endpoint and request limits of the options"""
+
+    name = "vision"
+
+    def __init__(self, options):
+        self.options = options
+        self.async_client = None
+
+    def params(self):
+        return {"feature": OCR_FEATURE}
 
-        # Extract text from image
-        text, _ = detect_text_from_image(img, page_num, progress_bar)
-        return text, page_num
+    def max_workers(self):
+        # The adaptive limiter decides how many of these actually talk to Vision at once
+        return self.options.max_concurrency
 
+    def annotate(self, img_bytes, label, metrics):
+        # Create Vision API image object
+        image = vision.Image(content=img_bytes)
+        record_upload(img_bytes, label, metrics)
+
+        response = call_with_retry(self.options, label,
+                                   get_vision_client(self.options.vision_endpoint).document_text_detection,
+                                   image=image, metrics=[metrics])
+        return response_to_annotation(response, label, metrics) if response else None
+
+    def annotate_batch(self, images):
+        feature = vision.Feature(type_=vision.Feature.Type[OCR_FEATURE])
+        requests = [
+            vision.AnnotateImageRequest(image=vision.Image(content=img_bytes), features=[feature])
+            for img_bytes, _, _ in images
+        ]
+        for img_bytes, label, metrics in images:
+            record_upload(img_bytes, label, metrics)
+            metrics["batch_size"] = len(images)
+        batch_label = ", ".join(label for _, label, _ in images)
+        batch_response = call_with_retry(self.options, batch_label,
+                                         get_vision_client(self.options.vision_endpoint).batch_annotate_images,
+                                         requests=requests, units=len(requests),
+                                         metrics=[metrics for _, _, metrics in images])
+
+        # Responses come back in request order
+        responses = batch_response.responses if batch_response else [None] * len(images)
+        return [response_to_annotation(response, label, metrics) if response else None
+                for (_, label, metrics), response in zip(images, responses)]
+
+    async def annotate_async(self, img_bytes, label, metrics, slot_cond):
+        # The async client only speaks gRPC, a REST endpoint goes through the sync client
+        if self.options.vision_endpoint:
+            return await super().annotate_async(img_bytes, label, metrics, slot_cond)
+        # The async client must be created inside the running event loop
+        if self.async_client is None:
+            self.async_client = vision.ImageAnnotatorAsyncClient()
+        record_upload(img_bytes, label, metrics)
+        response = await call_with_retry_async(
+            self.options, label, slot_cond, self.async_client.document_text_detection,
+            image=vision.Image(content=img_bytes), metrics=[metrics])
+        return response_to_annotation(response, label, metrics) if response else None
+
+def run_tesseract(img_bytes, lang):
+    """Run Tesseract on one page image in a worker process. Returns (annotation,
+    mean word confidence), the annotation in the same stored form as Vision's:
+    Tesseract blocks and paragraphs with word boxes, confidences and line breaks."""
+    # Optional dependency, only needed for the tesseract backend
+    import pytesseract
+    from PIL import Image
+
+    try:
+        image = Image.open(io.BytesIO(img_bytes))
+        data = pytesseract.image_to_data(image, lang=lang, output_type=pytesseract.Output.DICT)
     except Exception as e:
-        logger.error(f"Error processing page {page_num + 1}: {e}")
-        progress_bar.update(1)
-        return '', page_num
+        # pytesseract errors can't be pickled back to the parent process
+        raise RuntimeError(str(e)) from None
+
+    break_type = vision.TextAnnotation.DetectedBreak.BreakType
+    blocks = {}
+    confidences = []
+    previous = None
+    for i, word in enumerate(data["text"]):
+        word = word.strip()
+        if not word:
+            continue
+        confidence = float(data["conf"][i])
+        if confidence >= 0:
+            confidences.append(confidence)
+        left, top = data["left"][i], data["top"][i]
+        right, bottom = left + data["width"][i], top + data["height"][i]
+        annotated_word = vision.Word(
+            bounding_box=vision.BoundingPoly(vertices=[
+                vision.Vertex(x=left, y=top), vision.Vertex(x=right, y=top),
+                vision.Vertex(x=right, y=bottom), vision.Vertex(x=left, y=bottom),
+            ]),
+            symbols=[vision.Symbol(text=ch) for ch in word],
+            confidence=max(confidence, 0.0) / 100,
+        )
+        paragraphs = blocks.setdefault(data["block_num"][i], {})
+        paragraphs.setdefault(data["par_num"][i], []).append(annotated_word)
+
+        # The break after a word is known once the next word shows which line it is on
+        line = (data["block_num"][i], data["par_num"][i], data["line_num"][i])
+        if previous is not None:
+            previous_word, previous_line = previous
+            previous_word.symbols[-1].property.detected_break.type_ = (
+                break_type.SPACE if line == previous_line else break_type.LINE_BREAK)
+        previous = (annotated_word, line)
+    if previous is not None:
+        previous[0].symbols[-1].property.detected_break.type_ = break_type.LINE_BREAK
+
+    mean_confidence = sum(confidences) / len(confidences) if confidences else 0.0
+    page = vision.Page(
+        width=image.width,
+        height=image.height,
+        confidence=mean_confidence / 100,
+        blocks=[vision.Block(paragraphs=[vision.Paragraph(words=words) for words in paragraphs.values()])
+                for paragraphs in blocks.values()],
+    )
+    annotation = vision.TextAnnotation(pages=[page])
+    annotation.text = annotation_to_text(annotation)
+    return encode_annotation(annotation), mean_confidence
+
+class TesseractBackend(OcrBackend):
+    """Local Tesseract OCR on a process pool. Fully offline, throughput is bound
+    by CPU cores. Pages below a mean word confidence can optionally be sent to a
+    fallback backend (Vision) so only the hard pages cost money."""
+
+    name = "tesseract"
+
+    def __init__(self, lang, workers, fallback=None, fallback_confidence=0.0):
+        self.lang = lang
+        self.workers = workers
+        self.fallback = fallback
+        self.fallback_confidence = fallback_confidence
+        self.executor = ProcessPoolExecutor(max_workers=workers)
+
+    def params(self):
+        return {
+            "feature": "tesseract",
+            "lang": self.lang,
+            "fallback_confidence": self.fallback_confidence if self.fallback else None,
+        }
+
+    def max_workers(self):
+        return self.workers
+
+    def annotate(self, img_bytes, label, metrics):
+        started = time.monotonic()
+        try:
+            annotation, confidence = self.executor.submit(run_tesseract, img_bytes, self.lang).result()
+        except Exception as e:
+            logger.error(f"Tesseract failed on {label}: {e}")
+            return None
+        finally:
+            record_rpc([metrics], time.monotonic() - started)
+
+        if self.fallback and confidence < self.fallback_confidence:
+            logger.debug(f"Tesseract confidence {confidence:.0f} for {label}, using {self.fallback.name}")
+            metrics["backend"] = self.fallback.name
+            return self.fallback.annotate(img_bytes, label, metrics)
+        return annotation
+
+    def close(self):
+        self.executor.shutdown()
+
+def create_ocr_backend(options):
+    """Build the OCR backend selected by the options"""
+    if options.ocr_backend == "tesseract":
+        fallback = VisionBackend(options) if options.fallback_confidence > 0 else None
+        return TesseractBackend(options.tesseract_lang, options.tesseract_workers, fallback,
+                                options.fallback_confidence)
+    return VisionBackend(options)
+
+def annotate_image(book, page_num, img_bytes, progress_bar):
+    """OCR encoded image bytes with the OCR backend. Returns the stored form of
+    the annotation, None if the page failed."""
+    label = page_label(book, page_num)
+    metrics = {"backend": ocr_backend.name}
+    try:
+        # Skip OCR if this exact image was already processed
+        key = cache_key(book, img_bytes)
+        annotation = ocr_cache.get(key)
+        if annotation is not None:
+            logger.debug(f"OCR cache hit for {label}")
+            record_metrics(book, page_num, cache="hit")
+            progress_bar.update(1)
+            return annotation
+
+        annotation = ocr_backend.annotate(img_bytes, label, metrics)
+        record_metrics(book, page_num, cache="miss", **metrics)
 
-def extract_text_from_pdf_parallel():
-    """Extract text from all PDF pages in parallel"""
+        # Only successful results are cached, failures are retried next run
+        if annotation is not None:
+            ocr_cache.put(key, annotation)
 
-    logger.info(f"Opening PDF: {BASE_FILE}")
+        progress_bar.update(1)
+        return annotation
+
+    except Exception as e:
+        logger.error(f"Error processing {label}: {e}")
+        progress_bar.update(1)
+        return None
 
+def annotate_images(images, progress_bar):
+    """OCR several (book, page_num, image bytes) with a single batched backend
+    call. Returns the annotations in the same order."""
+    counted = 0
     try:
-        # Open PDF to get page count
-        pdf_document = fitz.open(BASE_FILE)
-        total_pages = len(pdf_document)
-        pdf_document.close()
+        annotations = [None] * len(images)
+        misses = []
+
+        for i, (book, page_num, img_bytes) in enumerate(images):
+            key = cache_key(book, img_bytes)
+            annotation = ocr_cache.get(key)
+            if annotation is not None:
+                annotations[i] = annotation
+                record_metrics(book, page_num, cache="hit")
+                progress_bar.update(1)
+                counted += 1
+            else:
+                misses.append((i, key, page_label(book, page_num), img_bytes, {"backend": ocr_backend.name}))
+
+        if misses:
+            miss_annotations = ocr_backend.annotate_batch([(img_bytes, label, metrics)
+                                                           for _, _, label, img_bytes, metrics in misses])
+            for (i, key, _, _, metrics), annotation in zip(misses, miss_annotations):
+                book, page_num, _ = images[i]
+                record_metrics(book, page_num, cache="miss", **metrics)
+                if annotation is not None:
+                    ocr_cache.put(key, annotation)
+                annotations[i] = annotation
+                progress_bar.update(1)
+                counted += 1
+
+        return annotations
+    except Exception as e:
+        # One unexpected error fails the pages of this request, not the run
+        label = "batch of " + ", ".join(page_label(book, page_num) for book, page_num, _ in images)
+        logger.error(f"Error processing {label}: {e}")
+        progress_bar.update(len(images) - counted)
+        return [None] * len(images)
+
+def annotate_mosaic(tiles, options, progress_bar):
+    """OCR several (book, page_num, tile) packed into one mosaic image. Returns
+    the annotations of the pages in the same order, each in the coordinates of
+    its own page rendering."""
+    counted = 0
+    try:
+        annotations = [None] * len(tiles)
+        misses = []
+
+        for i, (book, page_num, tile) in enumerate(tiles):
+            geometry = [tile["x"], tile["y"], tile["width"], tile["height"], *tile["image"].shape]
+            key = cache_key(book, tile["image"].tobytes() + json.dumps(["mosaic", geometry]).encode('utf-8'))
+            annotation = ocr_cache.get(key)
+            if annotation is not None:
+                annotations[i] = annotation
+                record_metrics(book, page_num, cache="hit")
+                progress_bar.update(1)
+                counted += 1
+            else:
+                misses.append((i, key))
 
-        # Determine page range
-        start_page = START_PAGE if START_PAGE is not None else 0
-        end_page = END_PAGE if END_PAGE is not None else total_pages - 1
-        
-        # Validate page range
-        start_page = max(0, min(start_page, total_pages - 1))
-        end_page = max(start_page, min(end_page, total_pages - 1))
-        
-        pages_to_process = list(range(start_page, end_page + 1))
-        logger.info(f"Processing pages {start_page + 1}-{end_page + 1} ({len(pages_to_process)} pages out of {total_pages} total)...")
-
-        # Process pages in parallel
-        max_workers = min(8, len(pages_to_process))  # Balance between speed and API limits
-        page_texts = {}
-
-        # Create progress bar
-        with tqdm(total=len(pages_to_process), desc="Extracting text", unit="page") as progress_bar:
-            with ThreadPoolExecutor(max_workers=max_workers) as executor:
-                # Submit all page processing tasks
-                futures = {
-                    executor.submit(process_single_page, BASE_FILE, page_num, progress_bar): page_num
-                    for page_num in pages_to_process
-                }
-
-                # Collect results
-                for future in as_completed(futures):
-                    text, page_num = future.result()
-                    page_texts[page_num] = text
-
-        logger.info(f"Text extraction completed for {len(pages_to_process)} pages!")
-
-        # Return texts in correct page order
-        ordered_texts = [page_texts[i] for i in pages_to_process]
-        return ordered_texts
+        if not misses:
+            return annotations
 
+        label = "mosaic of " + ", ".join(page_label(*tiles[i][:2]) for i, _ in misses)
+        metrics = {"backend": ocr_backend.name}
+        parts = [None] * len(misses)
+        try:
+            step = time.perf_counter()
+            pix, tops = compose_mosaic([tiles[i][2] for i, _ in misses])
+            img_bytes = encode_pixmap(pix, options)
+            metrics["encode"] = time.perf_counter() - step
+            annotation = ocr_backend.annotate(img_bytes, label, metrics)
+            if annotation is not None:
+                parts = split_mosaic(annotation, [(top, tiles[i][2]) for top, (i, _) in zip(tops, misses)])
+        except Exception as e:
+            logger.error(f"Error processing {label}: {e}")
+
+        for n, ((i, key), part) in enumerate(zip(misses, parts)):
+            book, page_num, _ = tiles[i]
+            # The image is uploaded and paid for once, by the first page of the mosaic
+            page_values = {name: value for name, value in metrics.items()
+                           if n == 0 or name not in ("encode", "upload_bytes", "vision_units")}
+            record_metrics(book, page_num, cache="miss", mosaic_pages=len(misses), **page_values)
+            if part is not None:
+                ocr_cache.put(key, part)
+            annotations[i] = part
+            progress_bar.update(1)
+            counted += 1
+        return annotations
     except Exception as e:
-        logger.error(f"Error opening PDF file: {e}")
-        return []
+        # One unexpected error fails the pages of this request, not the run
+        label = "mosaic of " + ", ".join(page_label(book, page_num) for book, page_num, _ in tiles)
+        logger.error(f"Error processing {label}: {e}")
+        progress_bar.update(len(tiles) - counted)
+        return [None] * len(tiles)
+
+def split_mosaic(annotation, layout):
+    """Split the annotation of a mosaic into one annotation per (top, tile) of the
+    layout. Every word goes to the tile its center falls into, boxes are moved
+    to where the tile was cut from its page rendering, and blocks and paragraphs
+    that span tiles are split with boxes around their remaining words."""
+    source = vision.TextAnnotation.pb(decode_annotation(annotation))
+    annotation_type = type(source)
+    parts = []
+    for _, tile in layout:
+        part = annotation_type()
+        page = part.pages.add()
+        page.width = tile["width"]
+        page.height = tile["height"]
+        parts.append(part)
+    if not source.pages:
+        return [encode_annotation(vision.TextAnnotation.wrap(part)) for part in parts]
+
+    # A word belongs to a tile up to the middle of the gap below it
+    bottoms = [top + tile["image"].shape[0] + MOSAIC_GAP / 2 for top, tile in layout]
+    for block in source.pages[0].blocks:
+        block_parts = {}
+        for paragraph in block.paragraphs:
+            paragraph_parts = {}
+            for word in paragraph.words:
+                vertices = word.bounding_box.vertices
+                center = sum(v.y for v in vertices) / len(vertices) if vertices else 0
+                slot = min(sum(1 for bottom in bottoms if center >= bottom), len(layout) - 1)
+                if slot not in block_parts:
+                    new_block = parts[slot].pages[0].blocks.add()
+                    new_block.block_type = block.block_type
+                    new_block.confidence = block.confidence
+                    new_block.property.CopyFrom(block.property)
+                    block_parts[slot] = new_block
+                if slot not in paragraph_parts:
+                    new_paragraph = block_parts[slot].paragraphs.add()
+                    new_paragraph.confidence = paragraph.confidence
+                    new_paragraph.property.CopyFrom(paragraph.property)
+                    paragraph_parts[slot] = new_paragraph
+                new_word = paragraph_parts[slot].words.add()
+                new_word.CopyFrom(word)
+                top, tile = layout[slot]
+                boxes = [new_word.bounding_box] + [symbol.bounding_box for symbol in new_word.symbols]
+                for box in boxes:
+                    for vertex in box.vertices:
+                        vertex.x += tile["x"]
+                        vertex.y += tile["y"] - top
+
+    for part in parts:
+        for block in part.pages[0].blocks:
+            for paragraph in block.paragraphs:
+                enclose(paragraph.bounding_box, [word.bounding_box for word in paragraph.words])
+            enclose(block.bounding_box, [paragraph.bounding_box for paragraph in block.paragraphs])
+    return [encode_annotation(vision.TextAnnotation.wrap(part)) for part in parts]
+
+def enclose(box, boxes):
+    """Set a bounding polygon to the rectangle around other bounding polygons"""
+    xs = [vertex.x for b in boxes for vertex in b.vertices]
+    ys = [vertex.y for b in boxes for vertex in b.vertices]
+    del box.vertices[:]
+    if xs:
+        for x, y in ((min(xs), min(ys)), (max(xs), min(ys)), (max(xs), max(ys)), (min(xs), max(ys))):
+            box.vertices.add(x=x, y=y)
+
+def render_settings(options):
+    """Options a render worker needs, without the books"""
+    return {
+        "image_format": options.image_format,
+        "jpeg_quality": options.jpeg_quality,
+        "adaptive_dpi": options.adaptive_dpi,
+        "target_x_height": options.target_x_height,
+        "deskew": options.deskew,
+        "binarize": options.binarize,
+        "mosaic": options.mosaic,
+    }
+
+def init_render_worker(settings):
+    """Process pool initializer"""
+    global render_options
+    render_options = Options(**settings)
+
+@contextlib.contextmanager
+def open_render_pool(options, workers):
+    """Process pool rendering pages. In service mode one pool is kept across
+    jobs so its workers keep their PDFs open, and only replaced when the render
+    settings change."""
+    global render_pool, render_pool_settings
+    settings = render_settings(options)
+    if not keep_render_pool:
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_render_worker,
+                                 initargs=(settings,)) as executor:
+            yield executor
+        return
 
-def create_docx_from_texts(page_texts):
-    """Create DOCX document from extracted texts"""
-    if not page_texts:
-        logger.warning("No text extracted to create document!")
+    if render_pool is None or render_pool_settings != settings:
+        close_render_pool()
+        render_pool = ProcessPoolExecutor(max_workers=options.render_workers, initializer=init_render_worker,
+                                          initargs=(settings,))
+        render_pool_settings = settings
+    yield render_pool
+
+def close_render_pool():
+    """Stop the render pool kept in service mode"""
+    global render_pool
+    if render_pool is not None:
+        render_pool.shutdown(cancel_futures=True)
+        render_pool = None
+
+def render_page(pdf_path, page_num, top_crop, bottom_crop):
+    """Render a single page in a worker process. Returns (image bytes, timings, tile)
+    where timings has the start time and the seconds of each render step, and
+    tile is set instead of image bytes for pages packed into a mosaic.
+    Image bytes are None if the page could not be rendered.
+    Each worker opens a PDF once and keeps it open for the following pages."""
+    timings = {"started": time.time()}
+    step = time.perf_counter()
+    pdf_document = open_cached_document(render_documents, pdf_path)
+    timings["open"] = time.perf_counter() - step
+    img_bytes, tile = extract_page_as_image(pdf_document, page_num, top_crop, bottom_crop, render_options, timings)
+    return img_bytes, timings, tile
+
+def open_cached_document(documents, pdf_path):
+    """Open a PDF through a dict of open documents, closing the least recently
+    used one when more than MAX_OPEN_DOCUMENTS are open. A file that changed on
+    disk since it was opened is opened again."""
+    stat = os.stat(pdf_path)
+    key = (pdf_path, stat.st_mtime_ns, stat.st_size)
+    pdf_document = documents.pop(key, None)
+    if pdf_document is None:
+        pdf_document = fitz.open(pdf_path)
+        if len(documents) >= MAX_OPEN_DOCUMENTS:
+            oldest = next(iter(documents))
+            documents.pop(oldest).close()
+    # Re-insert so the dict stays in least recently used order
+    documents[key] = pdf_document
+    return pdf_document
+
+def fingerprint_page(pdf_path, page_num, top_crop, bottom_crop):
+    """Probe a page at low resolution in a worker process. Returns (ink coverage,
+    perceptual hash), None if the page could not be rendered."""
+    try:
+        page = open_cached_document(render_documents, pdf_path)[page_num]
+        pix = page.get_pixmap(matrix=fitz.Matrix(PROBE_ZOOM, PROBE_ZOOM),
+                              clip=crop_rect(page, top_crop, bottom_crop), colorspace=fitz.csGRAY)
+        gray = pixmap_array(pix)
+        return ink_coverage(gray), perceptual_hash(gray)
+    except Exception as e:
+        logger.error(f"Error probing page {page_num + 1} of {pdf_path}: {e}")
         return None
 
-    base_fname = FNAME_PREFIX
-    final_fname = os.path.join(OUTPUT_FOLDER, f"{base_fname}_extracted.docx")
+class MemoryBudget:
+    """Bytes of page images in flight, from admission for rendering until their
+    OCR request is done. A page is admitted while the total stays within the
+    limit, or when nothing else is in flight so a single huge page can't stall
+    the run. Only used from the thread that schedules the pages."""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.bytes = 0
+        self.pages = 0
+        self.peak_bytes = 0
+        self.peak_pages = 0
+
+    def fits(self, size):
+        return not self.limit or self.pages == 0 or self.bytes + size <= self.limit
+
+    def reserve(self, size):
+        self.bytes += size
+        self.pages += 1
+        self.peak_bytes = max(self.peak_bytes, self.bytes)
+        self.peak_pages = max(self.peak_pages, self.pages)
+
+    def resize(self, old_size, new_size):
+        """A rendered page holds its image instead of the estimate it was admitted with"""
+        self.bytes += new_size - old_size
+        self.peak_bytes = max(self.peak_bytes, self.bytes)
+
+    def release(self, size):
+        self.bytes -= size
+        self.pages -= 1
+
+def page_footprint(documents, book, page_num, options):
+    """Estimated bytes of a page while it is rendered: an RGB raster of its
+    cropped area at the render zoom, the highest one with --adaptive-dpi"""
+    try:
+        page = open_cached_document(documents, book.pdf_path)[page_num]
+        rect = crop_rect(page, *page_crop(book, page_num)) or page.rect
+    except Exception:
+        return 0
+    zoom = MAX_ZOOM if options.adaptive_dpi else RENDER_ZOOM
+    return int(rect.width * zoom) * int(rect.height * zoom) * RASTER_BYTES_PER_PIXEL
+
+def held_bytes(image):
+    """Bytes held by a rendered page until its OCR request is done: its encoded
+    image, or its mosaic tile"""
+    if image is None:
+        return 0
+    return image["image"].nbytes if isinstance(image, dict) else len(image)
+
+def page_row_profile(pdf_path, page_num):
+    """Probe a whole page at low resolution in a worker process. Returns the share
+    of ink in each row, not counting the side borders, None if the page could not
+    be rendered."""
+    try:
+        page = open_cached_document(render_documents, pdf_path)[page_num]
+        gray = pixmap_array(page.get_pixmap(matrix=fitz.Matrix(PROBE_ZOOM, PROBE_ZOOM), colorspace=fitz.csGRAY))
+        dx = int(gray.shape[1] * BLANK_MARGIN_RATIO)
+        return (ink_darkness(gray[:, dx:gray.shape[1] - dx]) > INK_CONTRAST).mean(axis=1).astype(np.float32)
+    except Exception as e:
+        logger.error(f"Error probing page {page_num + 1} of {pdf_path}: {e}")
+        return None
 
-    logger.info(f"Creating DOCX with {len(page_texts)} pages...")
+def ink_bands(profile):
+    """(top, bottom) of the bands of rows with ink in a row profile, as shares of the page height"""
+    height = len(profile)
+    rows = np.flatnonzero(profile > AUTO_CROP_MIN_INK)
+    if rows.size == 0:
+        return []
+    breaks = np.flatnonzero(np.diff(rows) > max(1, AUTO_CROP_JOIN * height))
+    tops = np.r_[rows[0], rows[breaks + 1]]
+    bottoms = np.r_[rows[breaks], rows[-1]] + 1
+    return [(float(top / height), float(bottom / height)) for top, bottom in zip(tops, bottoms)]
+
+def header_candidate(bands):
+    """The first band of a page if it looks like a header: small, near the top
+    and further from the text than the lines of the text are from each other.
+    Returns (center of the band, middle of the gap below it), None otherwise.
+    Footers are found by passing the bands of the page upside down."""
+    if len(bands) < 2:
+        return None
+    (top, bottom), next_top = bands[0], bands[1][0]
+    line_gaps = [below[0] - above[1] for above, below in zip(bands[1:], bands[2:])]
+    line_gap = float(np.median(line_gaps)) if line_gaps else 0.0
+    if (bottom - top > AUTO_CROP_MAX_BAND or bottom > AUTO_CROP_ZONE
+            or next_top - bottom < max(AUTO_CROP_MIN_GAP, AUTO_CROP_GAP_FACTOR * line_gap)):
+        return None
+    return (top + bottom) / 2, (bottom + next_top) / 2
+
+def recurring_cuts(candidates, total_pages):
+    """Cuts of the pages whose candidate band is at the height most candidates
+    share, if that height recurs on enough pages. candidates maps page_num to
+    (band center, cut)."""
+    if not candidates:
+        return {}
+    centers = np.array([center for center, _ in candidates.values()])
+    close = np.abs(centers[:, None] - centers[None, :]) <= AUTO_CROP_TOLERANCE
+    members = close[close.sum(axis=1).argmax()]
+    if members.sum() < max(AUTO_CROP_MIN_PAGES, AUTO_CROP_MIN_SHARE * total_pages):
+        return {}
+    return {page_num: cut for (page_num, (_, cut)), member in zip(candidates.items(), members) if member}
+
+def detect_page_crops(book, pages, options):
+    """Pre-pass for --auto-crop: probe the pages of a book's page range on a
+    process pool, find the header and footer bands that recur across them and
+    crop them per page"""
+    workers = max(1, min(options.render_workers, len(pages)))
+    with open_render_pool(options, workers) as executor:
+        profiles = list(executor.map(page_row_profile, repeat(book.pdf_path), pages,
+                                     chunksize=max(1, len(pages) // (workers * 4))))
+
+    headers = {}
+    footers = {}
+    for page_num, profile in zip(pages, profiles):
+        if profile is None:
+            continue
+        bands = ink_bands(profile)
+        header = header_candidate(bands)
+        if header is not None:
+            headers[page_num] = header
+        footer = header_candidate([(1 - bottom, 1 - top) for top, bottom in reversed(bands)])
+        if footer is not None:
+            footers[page_num] = footer
+
+    top_cuts = recurring_cuts(headers, len(pages))
+    bottom_cuts = recurring_cuts(footers, len(pages))
+    book.page_crops = {page_num: (round(top_cuts.get(page_num, 0.0) * 100, 2),
+                                  round(bottom_cuts.get(page_num, 0.0) * 100, 2))
+                       for page_num in sorted(top_cuts.keys() | bottom_cuts.keys())}
+    logger.info(f"Auto crop: header cropped on {len(top_cuts)} and footer on {len(bottom_cuts)} "
+                f"of {len(pages)} pages")
+
+def submit_render(render_executor, book, page_num):
+    """Schedule rendering of a page on the process pool"""
+    return render_executor.submit(render_page, book.pdf_path, page_num, *page_crop(book, page_num))
+
+def ocr_pages_parallel(tasks, progress_bar, options):
+    """Render (book, page_num) tasks on a process pool and OCR them on a thread
+    pool, yielding (book, page_num, annotation) as pages finish. Rendering is CPU bound
+    and scales with cores, OCR is network bound. With --batch-size > 1 rendered
+    pages are grouped into one batch_annotate_images request, with --mosaic
+    pages with little text are packed into one image. Pages are admitted for
+    rendering while their images fit in the memory budget."""
+    render_workers = max(1, min(options.render_workers, len(tasks)))
+    ocr_workers = max(1, min(ocr_backend.max_workers(), len(tasks)))
+    # PDFs opened here to measure the pages
+    documents = {}
+
+    with open_render_pool(options, render_workers) as render_executor, \
+            ThreadPoolExecutor(max_workers=ocr_workers) as ocr_executor:
+        pending = deque(tasks)
+        next_size = None
+        render_futures = {}
+        ocr_futures = {}
+        running = set()
+        batch = []
+        mosaic = []
+
+        def submit_ocr(function, pages, *args):
+            ocr_future = ocr_executor.submit(function, *args, progress_bar)
+            ocr_futures[ocr_future] = pages
+            running.add(ocr_future)
 
-    document = Document()
-    style = document.styles['Normal']
-    style.font.name = 'NotoSansDevanagari-Regular'
-    style.font.size = Pt(10)
+        try:
+            while True:
+                # Admit pages while their images fit in the memory budget
+                while pending:
+                    if next_size is None:
+                        next_size = page_footprint(documents, *pending[0], options)
+                    if not memory_budget.fits(next_size):
+                        break
+                    book, page_num = pending.popleft()
+                    memory_budget.reserve(next_size)
+                    future = submit_render(render_executor, book, page_num)
+                    render_futures[future] = (book, page_num, next_size)
+                    running.add(future)
+                    next_size = None
+
+                # Send a partial batch or mosaic once no more pages are coming
+                # until memory is released
+                if not render_futures:
+                    if batch:
+                        submit_ocr(annotate_images, batch, batch)
+                        batch = []
+                    if mosaic:
+                        submit_ocr(annotate_mosaic, mosaic, mosaic, options)
+                        mosaic = []
+                if not running:
+                    break
+
+                done, running = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future in ocr_futures:
+                        # A list of tasks for batched requests and mosaics
+                        pages = ocr_futures.pop(future)
+                        if isinstance(pages, list):
+                            for (book, page_num, image), annotation in zip(pages, future.result()):
+                                memory_budget.release(held_bytes(image))
+                                yield book, page_num, annotation
+                        else:
+                            book, page_num, size = pages
+                            memory_budget.release(size)
+                            yield book, page_num, future.result()
+                        continue
+
+                    book, page_num, size = render_futures.pop(future)
+                    try:
+                        img_bytes, timings, tile = future.result()
+                        record_metrics(book, page_num, **timings)
+                    except Exception as e:
+                        logger.error(f"Render worker failed on {page_label(book, page_num)}: {e}")
+                        img_bytes, tile = None, None
+                    memory_budget.resize(size, held_bytes(tile if tile is not None else img_bytes))
+
+                    if tile is not None:
+                        if not mosaic_fits([t for _, _, t in mosaic], tile):
+                            submit_ocr(annotate_mosaic, mosaic, mosaic, options)
+                            mosaic = []
+                        mosaic.append((book, page_num, tile))
+                    elif img_bytes is None:
+                        memory_budget.release(0)
+                        progress_bar.update(1)
+                        yield book, page_num, None
+                    elif options.batch_size > 1:
+                        batch.append((book, page_num, img_bytes))
+                        if len(batch) >= options.batch_size:
+                            submit_ocr(annotate_images, batch, batch)
+                            batch = []
+                    else:
+                        submit_ocr(annotate_image, (book, page_num, len(img_bytes)), book, page_num, img_bytes)
+        finally:
+            for pdf_document in documents.values():
+                pdf_document.close()
+
+async def ocr_pages_asyncio(tasks, progress_bar, save_result, options):
+    """asyncio engine: render -> OCR -> persist stages connected by bounded queues.
+    Renders run on the process pool, OCR uses the async Vision client so hundreds
+    of requests can be in flight from one thread, and a full queue stops the
+    stage before it. Pages are admitted for rendering while their images fit in
+    the memory budget."""
+    if options.batch_size > 1:
+        logger.warning("--batch-size is not used by the asyncio engine, pages are sent one per request")
+
+    slot_cond = asyncio.Condition()
+    memory_cond = asyncio.Condition()
+    # PDFs opened here to measure the pages
+    documents = {}
+    task_queue = asyncio.Queue()
+    image_queue = asyncio.Queue(maxsize=options.queue_size)
+    result_queue = asyncio.Queue(maxsize=options.queue_size)
+    for task in tasks:
+        task_queue.put_nowait(task)
+
+    render_workers = max(1, min(options.render_workers, len(tasks)))
+    ocr_workers = max(1, min(ocr_backend.max_workers(), len(tasks)))
+
+    async def render_stage(render_executor):
+        while not task_queue.empty():
+            book, page_num = task_queue.get_nowait()
+            size = page_footprint(documents, book, page_num, options)
+            async with memory_cond:
+                await memory_cond.wait_for(lambda: memory_budget.fits(size))
+                memory_budget.reserve(size)
+            try:
+                img_bytes, timings, _ = await asyncio.wrap_future(submit_render(render_executor, book, page_num))
+                record_metrics(book, page_num, **timings)
+            except Exception as e:
+                logger.error(f"Render worker failed on {page_label(book, page_num)}: {e}")
+                img_bytes = None
+            memory_budget.resize(size, held_bytes(img_bytes))
+            await image_queue.put((book, page_num, img_bytes))
+
+    async def ocr_stage():
+        while True:
+            item = await image_queue.get()
+            if item is None:
+                break
+            book, page_num, img_bytes = item
+            label = page_label(book, page_num)
+            annotation = None
+            try:
+                if img_bytes is not None:
+                    key = cache_key(book, img_bytes)
+                    annotation = ocr_cache.get(key)
+                    if annotation is None:
+                        metrics = {"backend": ocr_backend.name}
+                        annotation = await ocr_backend.annotate_async(img_bytes, label, metrics, slot_cond)
+                        record_metrics(book, page_num, cache="miss", **metrics)
+                        if annotation is not None:
+                            ocr_cache.put(key, annotation)
+                    else:
+                        record_metrics(book, page_num, cache="hit")
+            except Exception as e:
+                # A consumer that died would leave render_stage blocked on the full image queue
+                logger.error(f"Error processing {label}: {e}")
+                annotation = None
+            async with memory_cond:
+                memory_budget.release(held_bytes(img_bytes))
+                memory_cond.notify_all()
+            progress_bar.update(1)
+            await result_queue.put((book, page_num, annotation))
 
-    # Use tqdm for DOCX creation progress
-    with tqdm(total=len(page_texts), desc="Creating DOCX", unit="page") as progress_bar:
-        for i, text in enumerate(page_texts, 1):
-            if text.strip():  # Only add non-empty pages
-                # Add page number header
-                document.add_paragraph(f"--- Page {i} ---", style=style)
-                document.add_paragraph(text, style=style)
-            else:
-                document.add_paragraph(f"--- Page {i} (No text detected) ---", style=style)
+    async def persist_stage():
+        while True:
+            item = await result_queue.get()
+            if item is None:
+                break
+            try:
+                save_result(*item, options)
+            except Exception as e:
+                # The page stays pending in the manifest and is retried with --resume
+                book, page_num, _ = item
+                logger.error(f"Error saving {page_label(book, page_num)}: {e}")
+                if page_num not in book.failed_pages:
+                    book.failed_pages.append(page_num)
+
+    with open_render_pool(options, render_workers) as render_executor:
+        persist_task = asyncio.create_task(persist_stage())
+        ocr_tasks = [asyncio.create_task(ocr_stage()) for _ in range(ocr_workers)]
+        await asyncio.gather(*(render_stage(render_executor) for _ in range(render_workers)))
+
+        # Stop the stages in order once everything upstream is done
+        for _ in ocr_tasks:
+            await image_queue.put(None)
+        await asyncio.gather(*ocr_tasks)
+        await result_queue.put(None)
+        await persist_task
+    for pdf_document in documents.values():
+        pdf_document.close()
 
-            document.add_page_break()
-            progress_bar.update(1)
+def write_pages_pdf(book, pages, path):
+    """Write a PDF of the given (0-based) pages of a book, in order"""
+    source = fitz.open(book.pdf_path)
+    subset = fitz.open()
+    try:
+        # Copy runs of consecutive pages in one go
+        start = 0
+        for i in range(1, len(pages) + 1):
+            if i == len(pages) or pages[i] != pages[i - 1] + 1:
+                subset.insert_pdf(source, from_page=pages[start], to_page=pages[i - 1])
+                start = i
+        subset.save(path, garbage=3, deflate=True)
+    finally:
+        subset.close()
+        source.close()
+
+def ocr_file_async(book, pending_pages, progress_bar, options):
+    """Offline mode: let Vision annotate the pending pages with the async file API.
+    A PDF of just those pages is uploaded to --gcs-bucket, since every page of the
+    uploaded file is billed, and the JSON results are read back from it,
+    yielding (book, page_num, annotation) for the pending pages."""
+    # Only needed for this mode
+    from google.cloud import storage
+
+    if book.top_crop > 0 or book.bottom_crop > 0 or options.auto_crop:
+        logger.warning("Cropping is not applied in async file mode, Vision renders the pages itself")
+
+    pending_pages = sorted(pending_pages)
+    with fitz.open(book.pdf_path) as pdf_document:
+        whole_book = pending_pages == list(range(len(pdf_document)))
+    # Page n of the uploaded PDF is page pending_pages[n - 1] of the book
+    pages_hash = hashlib.sha256(json.dumps(pending_pages).encode('utf-8')).hexdigest()[:16]
+    bucket = storage.Client().bucket(options.gcs_bucket)
+    run_prefix = f"translate_pdf/{book.name}/{book.input_hash[:16]}/{pages_hash}"
+    source_blob = bucket.blob(f"{run_prefix}/{os.path.basename(book.pdf_path)}")
+    output_prefix = f"{run_prefix}/output/"
+
+    logger.info(f"Uploading {len(pending_pages)} pages to gs://{options.gcs_bucket}/{source_blob.name}, "
+                f"all of them are billed")
+    if whole_book:
+        source_blob.upload_from_filename(book.pdf_path)
+    else:
+        pages_path = os.path.join(book.output_folder, f"{book.name}_pending_pages.pdf")
+        try:
+            write_pages_pdf(book, pending_pages, pages_path)
+            source_blob.upload_from_filename(pages_path)
+        finally:
+            if os.path.exists(pages_path):
+                os.remove(pages_path)
+
+    request = vision.AsyncAnnotateFileRequest(
+        features=[vision.Feature(type_=vision.Feature.Type[OCR_FEATURE])],
+        input_config=vision.InputConfig(
+            gcs_source=vision.GcsSource(uri=f"gs://{options.gcs_bucket}/{source_blob.name}"),
+            mime_type="application/pdf",
+        ),
+        output_config=vision.OutputConfig(
+            gcs_destination=vision.GcsDestination(uri=f"gs://{options.gcs_bucket}/{output_prefix}"),
+            batch_size=ASYNC_OUTPUT_BATCH_SIZE,
+        ),
+    )
 
-    document.save(final_fname)
-    logger.info(f"DOCX file saved: {final_fname}")
-    return final_fname
+    logger.info(f"Waiting for async file annotation of {book.name} to finish...")
+    operation = get_vision_client(options.vision_endpoint).async_batch_annotate_files(requests=[request])
+    operation.result(timeout=ASYNC_TIMEOUT_SECONDS)
+
+    wanted = set(pending_pages)
+    seen = set()
+    for blob in bucket.list_blobs(prefix=output_prefix):
+        file_response = vision.AnnotateFileResponse.from_json(blob.download_as_bytes(), ignore_unknown_fields=True)
+        for response in file_response.responses:
+            index = response.context.page_number - 1
+            page_num = pending_pages[index] if 0 <= index < len(pending_pages) else None
+            if page_num in wanted and page_num not in seen:
+                seen.add(page_num)
+                progress_bar.update(1)
+                metrics = {"backend": "vision-async-file"}
+                annotation = response_to_annotation(response, page_label(book, page_num), metrics)
+                record_metrics(book, page_num, **metrics)
+                yield book, page_num, annotation
+        blob.delete()
+    source_blob.delete()
+
+    for page_num in sorted(wanted - seen):
+        logger.error(f"No async annotation returned for {page_label(book, page_num)}")
+        progress_bar.update(1)
+        yield book, page_num, None
+
+class DuplicateIndex:
+    """Perceptual hashes of the pages OCR'd in this run, to find near-duplicates
+    within a book and across books. Hash candidates are confirmed by overlaying
+    the ink of both pages, since pages of running text in the same layout have
+    close hashes too."""
+
+    def __init__(self, max_distance):
+        self.max_distance = max_distance
+        self.hashes = np.zeros(1024, dtype=np.uint64)
+        self.pages = []
+        # Open PDFs and ink images of recently compared pages, least recently used first
+        self.documents = {}
+        self.ink_images = {}
+
+    def find(self, book, page_num, phash):
+        """The (book, page_num) this page is a near-duplicate of, or None"""
+        if not self.pages:
+            return None
+        differing = self.hashes[:len(self.pages)] ^ np.uint64(phash)
+        distances = np.unpackbits(differing.view(np.uint8).reshape(-1, 8), axis=1).sum(axis=1)
+        candidates = np.flatnonzero(distances <= self.max_distance)
+        candidates = candidates[np.argsort(distances[candidates], kind="stable")][:DUPLICATE_MAX_CANDIDATES]
+        for i in candidates:
+            original = self.pages[i]
+            if overlay_similarity(self.ink_image(*original), self.ink_image(book, page_num)) >= DUPLICATE_MIN_SIMILARITY:
+                return original
+        return None
 
-def save_text_files(page_texts):
-    """Save extracted text to individual page files and a combined file"""
-    if not page_texts:
-        logger.warning("No text to save!")
-        return None, None
-    
-    # Save individual page files
-    page_files = []
-    start_page_num = (START_PAGE if START_PAGE is not None else 0) + 1
-    
-    logger.info(f"Saving individual page text files...")
-    for i, text in enumerate(page_texts):
-        actual_page_num = start_page_num + i
-        page_filename = os.path.join(OUTPUT_FOLDER, f"page_{actual_page_num:03d}.txt")
-        
+    def add(self, book, page_num, phash):
+        """Index a page that is sent for OCR"""
+        if len(self.pages) == len(self.hashes):
+            self.hashes = np.concatenate((self.hashes, np.zeros_like(self.hashes)))
+        self.hashes[len(self.pages)] = phash
+        self.pages.append((book, page_num))
+
+    def ink_image(self, book, page_num):
+        """Ink of a page rendered at DUPLICATE_ZOOM with the book's crop"""
+        key = (book.pdf_path, page_num)
+        image = self.ink_images.pop(key, None)
+        if image is None:
+            page = open_cached_document(self.documents, book.pdf_path)[page_num]
+            pix = page.get_pixmap(matrix=fitz.Matrix(DUPLICATE_ZOOM, DUPLICATE_ZOOM),
+                                  clip=crop_rect(page, *page_crop(book, page_num)), colorspace=fitz.csGRAY)
+            image = ink_darkness(pixmap_array(pix))
+            if len(self.ink_images) >= DUPLICATE_MAX_CANDIDATES * 2:
+                self.ink_images.pop(next(iter(self.ink_images)))
+        self.ink_images[key] = image
+        return image
+
+    def close(self):
+        """Close the PDFs opened for comparisons"""
+        for pdf_document in self.documents.values():
+            pdf_document.close()
+        self.documents.clear()
+
+def skip_pages(book, pages, options):
+    """Pre-pass for --skip-blank and --skip-duplicates: probe pages on a process
+    pool, save blank pages and near-duplicates of pages OCR'd earlier in this run
+    without OCR, and return the pages that still need it"""
+    workers = max(1, min(options.render_workers, len(pages)))
+    crops = [page_crop(book, page_num) for page_num in pages]
+    with open_render_pool(options, workers) as executor:
+        fingerprints = list(executor.map(fingerprint_page, repeat(book.pdf_path), pages,
+                                         [top for top, _ in crops], [bottom for _, bottom in crops],
+                                         chunksize=max(1, len(pages) // (workers * 4))))
+
+    ocr_pages = []
+    blank = duplicates = 0
+    for page_num, fingerprint in zip(pages, fingerprints):
+        if fingerprint is None:
+            ocr_pages.append(page_num)
+            continue
+        coverage, phash = fingerprint
+        record_metrics(book, page_num, ink=coverage, phash=f"{phash:016x}" if phash is not None else None)
+
+        if options.skip_blank and coverage < BLANK_INK_RATIO:
+            save_page_text(book, page_num, BLANK_PAGE_TEXT)
+            record_page(book, page_num, "done", source="blank")
+            book.combined_writer.add(page_num, BLANK_PAGE_TEXT)
+            write_report(book, page_num, status="skipped", source="blank")
+            blank += 1
+            continue
+
+        if duplicate_index is not None and phash is not None:
+            original = duplicate_index.find(book, page_num, phash)
+            if original is not None:
+                label = page_label(*original)
+                text = DUPLICATE_PAGE_TEXT.format(page=label)
+                save_page_text(book, page_num, text)
+                record_page(book, page_num, "done", source="duplicate", duplicate_of=label)
+                book.combined_writer.add(page_num, text)
+                write_report(book, page_num, status="skipped", source="duplicate", duplicate_of=label)
+                duplicates += 1
+                continue
+            duplicate_index.add(book, page_num, phash)
+
+        ocr_pages.append(page_num)
+
+    save_manifest(book)
+    logger.info(f"Skipping {blank} blank and {duplicates} duplicate pages, {len(ocr_pages)} need OCR")
+    return ocr_pages
+
+def page_range(book, total_pages):
+    """The book's pages from --start-page to --end-page, clamped to the document"""
+    start_page = book.start_page if book.start_page is not None else 0
+    end_page = book.end_page if book.end_page is not None else total_pages - 1
+    start_page = max(0, min(start_page, total_pages - 1))
+    end_page = max(start_page, min(end_page, total_pages - 1))
+    return list(range(start_page, end_page + 1))
+
+def prepare_book(book, options):
+    """Work out which pages of a book still need OCR. Pages already done by an
+    earlier run are skipped when resuming, and with --hybrid pages with a usable
+    text layer are saved right away, as are blank and duplicate pages with
+    --skip-blank and --skip-duplicates. Returns the pages to OCR."""
+    logger.info(f"Opening PDF: {book.pdf_path}")
+    init(book, options)
+
+    # Open PDF to get page count
+    pdf_document = fitz.open(book.pdf_path)
+    total_pages = len(pdf_document)
+    book.pages = page_range(book, total_pages)
+    logger.info(f"Processing pages {book.pages[0] + 1}-{book.pages[-1] + 1} ({len(book.pages)} pages out of {total_pages} total)...")
+
+    # Headers and footers are detected over the whole range, so every run and
+    # every shard crops a page the same way
+    range_pages = book.pages
+
+    # A shard keeps its own manifest and only redoes its pages that aren't done
+    shard = options.shard
+    if shard:
+        book.shard_name = shard.name
+        book.manifest_file = os.path.join(book.output_folder, SHARD_FOLDER, f"{shard.name}.manifest.json")
+        os.makedirs(os.path.dirname(book.manifest_file), exist_ok=True)
+        book.pages = shard.select(book.pages)
+        logger.info(f"Shard {shard.spec}: {len(book.pages)} pages ({format_page_list(book.pages) or 'none'})")
+
+    book.manifest = load_manifest(book)
+    book.input_hash = file_hash(book.pdf_path)
+    book.params = ocr_params(book, options)
+    book.failed_pages = []
+    if shard:
+        book.manifest["shard"] = {"spec": shard.spec, "pages": format_page_list(book.pages)}
+        save_manifest(book)
+    if options.resume or shard:
+        pending_pages = [p for p in book.pages if not is_page_done(book, p, options)]
+        logger.info(f"Resuming: {len(book.pages) - len(pending_pages)} pages already done, {len(pending_pages)} to process")
+    else:
+        pending_pages = book.pages
+
+    # The combined file is written while pages complete. Pages done by an
+    # earlier run are read back from their files when their turn comes.
+    book.combined_writer = CombinedTextWriter(book, options.docx)
+    book.reports = []
+    book.report_file = open(report_filename(book), 'a', encoding='utf-8', buffering=1)
+    pending_set = set(pending_pages)
+    for page_num in book.pages:
+        if page_num not in pending_set:
+            book.combined_writer.add(page_num)
+
+    book.page_crops = {}
+    if options.auto_crop and pending_pages:
+        detect_page_crops(book, range_pages, options)
+
+    # Pages with a usable text layer don't need OCR at all
+    if options.hybrid and pending_pages:
+        ocr_pages = []
+        for page_num in pending_pages:
+            text = extract_text_layer(pdf_document[page_num], *page_crop(book, page_num))
+            if text is None:
+                ocr_pages.append(page_num)
+            else:
+                save_page_text(book, page_num, text)
+                record_page(book, page_num, "done", source="text-layer")
+                book.combined_writer.add(page_num, text)
+                write_report(book, page_num, status="done", source="text-layer")
+        save_manifest(book)
+        logger.info(f"Hybrid: {len(pending_pages) - len(ocr_pages)} pages use the embedded text layer, {len(ocr_pages)} need OCR")
+        pending_pages = ocr_pages
+
+    pdf_document.close()
+
+    # Blank pages and repeats of pages already OCR'd don't need OCR either
+    if (options.skip_blank or options.skip_duplicates) and pending_pages:
+        pending_pages = skip_pages(book, pending_pages, options)
+
+    return pending_pages
+
+def save_result(book, page_num, annotation, options):
+    """Save a page as soon as it is done so an interrupted run can be resumed.
+    The annotation is stored next to the text so the text can be re-rendered later."""
+    step = time.perf_counter()
+    text = annotation_to_text(decode_annotation(annotation), options.text_layout) if annotation is not None else None
+    parse_seconds = time.perf_counter() - step
+
+    step = time.perf_counter()
+    if text is None:
+        book.failed_pages.append(page_num)
+        record_page(book, page_num, "failed")
+    else:
+        save_annotation(book, page_num, annotation)
+        save_page_text(book, page_num, text)
+        record_page(book, page_num, "done")
+    journal_page(book, page_num)
+    book.combined_writer.add(page_num, text or '')
+
+    with metrics_lock:
+        metrics = page_metrics.setdefault((book.pdf_path, page_num), {})
+        metrics["write"] = time.perf_counter() - step
+        metrics["parse"] = metrics.get("parse", 0.0) + parse_seconds
+        if "started" in metrics:
+            metrics["latency"] = time.time() - metrics["started"]
+    write_report(book, page_num, status="failed" if text is None else "done", source="ocr")
+
+def run_filename(book, suffix):
+    """Path of a file written by a run of a book: in its output folder, or in
+    the shard folder for a shard run"""
+    if book.shard_name:
+        return os.path.join(book.output_folder, SHARD_FOLDER, f"{book.shard_name}{suffix}")
+    return os.path.join(book.output_folder, f"{book.name}{suffix}")
+
+def report_filename(book):
+    """Path of the per-page NDJSON report of a book"""
+    return run_filename(book, "_report.ndjson")
+
+def write_report(book, page_num, **values):
+    """Append the record of a finished page to the book's report"""
+    record_metrics(book, page_num, **values)
+    record = page_report(book, page_num)
+    book.reports.append(record)
+    book.report_file.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+def write_report_summary(book):
+    """Close the report of a book and write the summary of this run next to it"""
+    book.report_file.close()
+    summary = summarize_reports(book.reports)
+    summary_path = run_filename(book, "_report_summary.json")
+    with open(summary_path, 'w', encoding='utf-8') as f:
+        json.dump(summary, f, indent=1)
+
+def interleave_pages(pending):
+    """Round-robin (book, page_num) tasks over all books, so every book gets a
+    fair share of the shared workers instead of running one after the other"""
+    tasks = []
+    longest = max((len(pages) for _, pages in pending), default=0)
+    for i in range(longest):
+        for book, pages in pending:
+            if i < len(pages):
+                tasks.append((book, pages[i]))
+    return tasks
+
+def extract_text_from_books(books, options):
+    """Extract text from the pages of all books with one shared scheduler.
+    Each page is saved as soon as it is done. Returns the books that could be opened."""
+    pending = []
+    for book in books:
         try:
-            with open(page_filename, 'w', encoding='utf-8') as f:
-                f.write(text)
-            page_files.append(page_filename)
-            logger.debug(f"Saved page {actual_page_num}: {page_filename}")
+            pending.append((book, prepare_book(book, options)))
         except Exception as e:
-            logger.error(f"Error saving page {actual_page_num}: {e}")
-    
-    # Save combined file
-    combined_filename = os.path.join(OUTPUT_FOLDER, f"{FNAME_PREFIX}_all_pages.txt")
-    logger.info(f"Saving combined text file...")
-    
+            logger.error(f"Error opening PDF file {book.pdf_path}: {e}")
+
+    tasks = interleave_pages(pending)
+
+    # Create progress bar
+    try:
+        with tqdm(total=len(tasks), desc="Extracting text", unit="page") as progress_bar:
+            if options.gcs_bucket:
+                for book, pages in pending:
+                    if pages:
+                        for result in ocr_file_async(book, pages, progress_bar, options):
+                            save_result(*result, options)
+            elif options.engine == "asyncio" and tasks:
+                asyncio.run(ocr_pages_asyncio(tasks, progress_bar, save_result, options))
+            elif tasks:
+                for result in ocr_pages_parallel(tasks, progress_bar, options):
+                    save_result(*result, options)
+    finally:
+        for book, _ in pending:
+            book.combined_writer.close()
+            write_report_summary(book)
+            save_manifest(book)
+
+    logger.info(f"Text extraction completed for {len(tasks)} pages!")
+    for book, _ in pending:
+        if book.failed_pages:
+            failed_display = ", ".join(str(p + 1) for p in sorted(book.failed_pages))
+            rerun = f"--shard {options.shard.spec}" if options.shard else "--resume"
+            logger.warning(f"{book.name}: {len(book.failed_pages)} pages failed and will be retried with {rerun}: {failed_display}")
+
+    return [book for book, _ in pending]
+
+def page_filename(book, page_num):
+    """Path of the text file for a (0-based) page"""
+    return os.path.join(book.output_folder, f"page_{page_num + 1:03d}.txt")
+
+def save_page_text(book, page_num, text):
+    """Save the extracted text of a single page. The file is written under a
+    temporary name and renamed, so readers never see a partial page."""
+    path = page_filename(book, page_num)
+    tmp_path = f"{path}.tmp"
     try:
-        with open(combined_filename, 'w', encoding='utf-8') as f:
-            for i, text in enumerate(page_texts):
-                actual_page_num = start_page_num + i
-                f.write(f"{'='*50}\n")
-                f.write(f"Page {actual_page_num}\n")
-                f.write(f"{'='*50}\n\n")
-                f.write(text)
-                f.write("\n\n")
-        
-        logger.info(f"Combined file saved: {combined_filename}")
-        return page_files, combined_filename
-        
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+        logger.debug(f"Saved {page_label(book, page_num)}: {path}")
     except Exception as e:
-        logger.error(f"Error saving combined file: {e}")
-        return page_files, None
+        logger.error(f"Error saving {page_label(book, page_num)}: {e}")
 
-def convert_docx_to_pdf(docx_path):
-    """Convert DOCX to PDF"""
-    if not docx_path:
-        return None
+def annotation_filename(book, page_num):
+    """Path of the stored annotation of a (0-based) page"""
+    return os.path.join(book.output_folder, ANNOTATION_FOLDER, f"page_{page_num + 1:03d}.pb.z")
 
-    base_name = os.path.splitext(os.path.basename(docx_path))[0]
-    pdf_path = os.path.join(OUTPUT_FOLDER, f"{base_name}.pdf")
+def save_annotation(book, page_num, annotation):
+    """Save the stored form of a page's annotation, atomically like the page text"""
+    path = annotation_filename(book, page_num)
+    tmp_path = f"{path}.tmp"
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(tmp_path, 'wb') as f:
+            f.write(annotation)
+        os.replace(tmp_path, path)
+    except Exception as e:
+        logger.error(f"Error saving annotation of {page_label(book, page_num)}: {e}")
 
-    logger.info("Converting DOCX to PDF...")
+def load_page_text(book, page_num):
+    """Read the saved text of a single page, empty if it was never extracted"""
+    try:
+        with open(page_filename(book, page_num), 'r', encoding='utf-8') as f:
+            return f.read()
+    except FileNotFoundError:
+        return ''
+
+def docx_filename(book):
+    """Path of the docx file"""
+    return os.path.join(book.output_folder, f"{book.name}_extracted.docx")
+
+# Characters that are not allowed in XML 1.0
+INVALID_XML_CHARS = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]")
+
+DOCX_CONTENT_TYPES = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">
+<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>
+<Default Extension="xml" ContentType="application/xml"/>
+<Override PartName="/word/document.xml" ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/>
+<Override PartName="/word/styles.xml" ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.styles+xml"/>
+</Types>"""
+
+DOCX_PACKAGE_RELS = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
+<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="word/document.xml"/>
+</Relationships>"""
+
+DOCX_DOCUMENT_RELS = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
+<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles" Target="styles.xml"/>
+</Relationships>"""
+
+DOCX_STYLES = f"""<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<w:styles xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main">
+<w:style w:type="paragraph" w:default="1" w:styleId="Normal">
+<w:name w:val="Normal"/>
+<w:qFormat/>
+<w:rPr>
+<w:rFonts w:ascii="{DOCX_FONT}" w:hAnsi="{DOCX_FONT}" w:cs="{DOCX_FONT}"/>
+<w:sz w:val="{DOCX_FONT_SIZE_PT * 2}"/>
+<w:szCs w:val="{DOCX_FONT_SIZE_PT * 2}"/>
+</w:rPr>
+</w:style>
+</w:styles>"""
+
+DOCX_DOCUMENT_START = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main">
+<w:body>
+"""
+
+DOCX_DOCUMENT_END = """<w:sectPr>
+<w:pgSz w:w="12240" w:h="15840"/>
+<w:pgMar w:top="1440" w:right="1440" w:bottom="1440" w:left="1440" w:header="720" w:footer="720" w:gutter="0"/>
+</w:sectPr>
+</w:body>
+</w:document>"""
+
+def docx_paragraph(text):
+    """WordprocessingML paragraph in the Normal style. Line breaks and tabs
+    inside the text become <w:br/> and <w:tab/>, like python-docx does."""
+    runs = []
+    for line_index, line in enumerate(INVALID_XML_CHARS.sub("", text).replace("\r\n", "\n").split("\n")):
+        if line_index:
+            runs.append("<w:br/>")
+        for part_index, part in enumerate(line.split("\t")):
+            if part_index:
+                runs.append("<w:tab/>")
+            if part:
+                runs.append(f'<w:t xml:space="preserve">{escape(part)}</w:t>')
+    return f'<w:p><w:pPr><w:pStyle w:val="Normal"/></w:pPr><w:r>{"".join(runs)}</w:r></w:p>\n'
+
+class DocxWriter:
+    """Writes a docx file while pages arrive, streaming the document body
+    straight into the zip. Memory stays constant whatever the size of the book.
+
+    Every page gets a "--- Page N ---" header paragraph in the Noto Devanagari
+    Normal style, its text, and a page break."""
+
+    def __init__(self, path):
+        self.path = path
+        self.pages = 0
+        self.zip = zipfile.ZipFile(path, 'w', compression=zipfile.ZIP_DEFLATED)
+        self.zip.writestr("[Content_Types].xml", DOCX_CONTENT_TYPES)
+        self.zip.writestr("_rels/.rels", DOCX_PACKAGE_RELS)
+        self.zip.writestr("word/_rels/document.xml.rels", DOCX_DOCUMENT_RELS)
+        self.zip.writestr("word/styles.xml", DOCX_STYLES)
+        # Must stay the last entry, nothing else can be written while it is open
+        body_info = zipfile.ZipInfo("word/document.xml", date_time=time.localtime()[:6])
+        body_info.compress_type = zipfile.ZIP_DEFLATED
+        self.body = self.zip.open(body_info, 'w', force_zip64=True)
+        self.body.write(DOCX_DOCUMENT_START.encode('utf-8'))
+
+    def add_page(self, page_num, text):
+        """Append a (0-based) page"""
+        if text.strip():  # Only add non-empty pages
+            xml = docx_paragraph(f"--- Page {page_num + 1} ---") + docx_paragraph(text)
+        else:
+            xml = docx_paragraph(f"--- Page {page_num + 1} (No text detected) ---")
+        xml += '<w:p><w:r><w:br w:type="page"/></w:r></w:p>\n'
+        self.body.write(xml.encode('utf-8'))
+        self.pages += 1
+
+    def close(self):
+        """Finish the document body and the zip"""
+        self.body.write(DOCX_DOCUMENT_END.encode('utf-8'))
+        self.body.close()
+        self.zip.close()
+        logger.info(f"DOCX file saved: {self.path} ({self.pages} pages)")
+
+def combined_filename(book):
+    """Path of the combined text file"""
+    return run_filename(book, "_all_pages.txt")
+
+class CombinedTextWriter:
+    """Appends pages to the combined text file in page order while they complete.
+
+    Pages that finish out of order wait in a reorder buffer until every page
+    before them is written, then the contiguous run is flushed. Only the
+    out-of-order pages are held in memory, and the file on disk is always a
+    usable prefix of the book. The byte offset and length of every page's text
+    are written to the page offset index (see page_index.py) on close."""
+
+    def __init__(self, book, docx=False):
+        self.book = book
+        self.next_index = 0
+        self.buffer = {}
+        self.path = combined_filename(book)
+        # Written as bytes to know the offsets, with the line endings of a text file
+        self.file = open(self.path, 'wb')
+        self.offset = 0
+        self.offsets = {}
+        # The docx is written from the same ordered stream of pages, for a
+        # sharded book only by --merge
+        self.docx = DocxWriter(docx_filename(book)) if docx and not book.shard_name else None
+
+    def add(self, page_num, text=None):
+        """Add a finished page. With text None it is read from its page file."""
+        page_nums = self.book.pages
+        self.buffer[page_num] = text
+        while self.next_index < len(page_nums) and page_nums[self.next_index] in self.buffer:
+            current = page_nums[self.next_index]
+            current_text = self.buffer.pop(current)
+            if current_text is None:
+                current_text = load_page_text(self.book, current)
+            self.write(f"{'='*50}\n")
+            self.write(f"Page {current + 1}\n")
+            self.write(f"{'='*50}\n\n")
+            start = self.offset
+            self.write(current_text)
+            self.offsets[current + 1] = (start, self.offset - start)
+            self.write("\n\n")
+            if self.docx:
+                self.docx.add_page(current, current_text)
+            self.next_index += 1
+        self.file.flush()
+
+    def write(self, text):
+        data = text.replace("\n", os.linesep).encode('utf-8')
+        self.file.write(data)
+        self.offset += len(data)
+
+    def close(self):
+        """Close the file and write its page offset index. Returns True if every page was written."""
+        self.file.close()
+        page_index.write_index(page_index.index_filename(self.path), self.offsets, self.offset)
+        if self.docx:
+            self.docx.close()
+        if self.next_index < len(self.book.pages):
+            missing = self.book.pages[self.next_index]
+            logger.warning(f"Combined file of {self.book.name} is incomplete, it stops before page {missing + 1}")
+            return False
+        return True
+
+def rerender_book(book, options):
+    """Regenerate the page files and the combined file of an earlier run from the
+    stored annotations with the current --text-layout, without any OCR. Pages
+    without an annotation (text layer pages) keep their text. Returns False if
+    there is no earlier run."""
+    if not os.path.exists(book.manifest_file):
+        logger.error(f"No earlier run of {book.name} found in {book.output_folder}")
+        return False
+
+    book.manifest = load_manifest(book)
+    pages = sorted(int(p) - 1 for p, entry in book.manifest["pages"].items() if entry.get("status") == "done")
+    if book.start_page is not None:
+        pages = [p for p in pages if p >= book.start_page]
+    if book.end_page is not None:
+        pages = [p for p in pages if p <= book.end_page]
+    book.pages = pages
+
+    rendered = 0
+    writer = CombinedTextWriter(book, options.docx)
     try:
-        docx2pdf.convert(docx_path, pdf_path)
-        logger.info(f"PDF file saved: {pdf_path}")
-        return pdf_path
+        for page_num in tqdm(pages, desc=f"Re-rendering {book.name}", unit="page"):
+            try:
+                with open(annotation_filename(book, page_num), 'rb') as f:
+                    annotation = f.read()
+            except FileNotFoundError:
+                writer.add(page_num)
+                continue
+            text = annotation_to_text(decode_annotation(annotation), options.text_layout)
+            save_page_text(book, page_num, text)
+            writer.add(page_num, text)
+            rendered += 1
+    finally:
+        writer.close()
+
+    logger.info(f"{book.name}: {rendered} pages re-rendered from annotations, "
+                f"{len(pages) - rendered} pages kept their text")
+    return True
+
+def merge_book(book, options):
+    """Assemble a book processed with --shard: check that every page of its page
+    range is done by a shard with the current input and OCR parameters, then write its manifest,
+    combined text file (and docx with --docx) and report in page order. Nothing
+    is written if pages are missing, and merging again gives the same result.
+    Returns False if the book can't be merged."""
+    shard_folder = os.path.join(book.output_folder, SHARD_FOLDER)
+    manifest_names = sorted(name for name in os.listdir(shard_folder) if name.endswith(".manifest.json")) \
+        if os.path.isdir(shard_folder) else []
+    if not manifest_names:
+        logger.error(f"No shards of {book.name} found in {shard_folder}")
+        return False
+
+    with fitz.open(book.pdf_path) as pdf_document:
+        book.pages = page_range(book, len(pdf_document))
+    book.input_hash = file_hash(book.pdf_path)
+    params = book.params = ocr_params(book, options)
+
+    # A done page of any shard wins, stale pages of an earlier input or other
+    # parameters don't count, as on --resume
+    entries = {}
+    owners = {}
+    other_params = {}
+    for name in manifest_names:
+        shard_manifest = load_manifest(book, os.path.join(shard_folder, name))
+        shard = shard_manifest.get("shard", {})
+        if shard.get("pages"):
+            for page_num in parse_page_list(shard["pages"]):
+                owners.setdefault(page_num, shard["spec"])
+        for page, entry in shard_manifest["pages"].items():
+            if entry.get("input_hash") != book.input_hash:
+                continue
+            if entry.get("params") != params:
+                if entry.get("status") == "done":
+                    shard_params = entry.get("params") or {}
+                    other_params[page] = {name for name in set(params) | set(shard_params)
+                                          if shard_params.get(name) != params.get(name)}
+                continue
+            if entry.get("status") == "done" or page not in entries:
+                entries[page] = entry
+
+    missing = [p for p in book.pages
+               if entries.get(str(p + 1), {}).get("status") != "done" or not os.path.exists(page_filename(book, p))]
+    if missing:
+        logger.error(f"{book.name}: {len(missing)} of {len(book.pages)} pages are not done, nothing was merged")
+        by_shard = {}
+        for page_num in missing:
+            by_shard.setdefault(owners.get(page_num), []).append(page_num)
+        for spec, pages in by_shard.items():
+            if spec is None:
+                logger.error(f"  - Pages {format_page_list(pages)} are not in any shard")
+                continue
+            mismatched = [p for p in pages if str(p + 1) in other_params]
+            if mismatched:
+                names = sorted(set().union(*(other_params[str(p + 1)] for p in mismatched)))
+                logger.error(f"  - Pages {format_page_list(mismatched)} of shard {spec} were OCR'd with other "
+                             f"settings ({', '.join(names)}), run it again with --shard {spec} and the options given here")
+            pages = [p for p in pages if p not in mismatched]
+            if pages:
+                logger.error(f"  - Pages {format_page_list(pages)} of shard {spec}, run it again with --shard {spec}")
+        return False
+
+    book.manifest = {"source": book.pdf_path, "pages": {str(p + 1): entries[str(p + 1)] for p in book.pages}}
+    save_manifest(book)
+
+    writer = CombinedTextWriter(book, options.docx)
+    try:
+        for page_num in book.pages:
+            writer.add(page_num)
+    finally:
+        writer.close()
+
+    # The last record of a page wins, a shard that ran again appended newer ones
+    records = {}
+    for name in manifest_names:
+        report_path = os.path.join(shard_folder, name.replace(".manifest.json", "_report.ndjson"))
+        if os.path.exists(report_path):
+            with open(report_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    if line.strip():
+                        record = json.loads(line)
+                        records[record["page"] - 1] = record
+    book.reports = [records[p] for p in book.pages if p in records]
+    book.report_file = open(report_filename(book), 'w', encoding='utf-8')
+    for record in book.reports:
+        book.report_file.write(json.dumps(record, ensure_ascii=False) + "\n")
+    write_report_summary(book)
+
+    logger.info(f"{book.name}: merged {len(book.pages)} pages from {len(manifest_names)} shards into "
+                f"{os.path.basename(combined_filename(book))}")
+    return True
+
+def word_script(text):
+    """Text layer font for a word: devanagari, gujarati or latin"""
+    for ch in text:
+        code = ord(ch)
+        if 0x0A80 <= code <= 0x0AFF:
+            return "gujarati"
+        if 0x0900 <= code <= 0x097F or 0xA8E0 <= code <= 0xA8FF:
+            return "devanagari"
+    return "latin"
+
+def word_boxes(annotation, clip, mat=None):
+    """(text, rect) of every word of an annotation, the rect in page coordinates.
+    Boxes are pixels of the image rendered from the clip rectangle with mat,
+    or normalized to 0-1 for async file results. Without mat the image is
+    assumed to be an unrotated rendering of the clip."""
+    page = annotation.pages[0]
+    if mat is not None:
+        inverse = ~mat
+        origin = (clip * mat).irect.top_left
+    for block in page.blocks:
+        for paragraph in block.paragraphs:
+            for word in paragraph.words:
+                text = "".join(symbol.text for symbol in word.symbols)
+                box = word.bounding_box
+                if box.normalized_vertices:
+                    points = [fitz.Point(clip.x0 + v.x * clip.width, clip.y0 + v.y * clip.height)
+                              for v in box.normalized_vertices]
+                elif mat is not None:
+                    points = [(fitz.Point(v.x, v.y) + origin) * inverse for v in box.vertices]
+                elif page.width and page.height:
+                    scale_x = clip.width / page.width
+                    scale_y = clip.height / page.height
+                    points = [fitz.Point(clip.x0 + v.x * scale_x, clip.y0 + v.y * scale_y) for v in box.vertices]
+                else:
+                    points = [fitz.Point(clip.x0 + v.x / RENDER_ZOOM, clip.y0 + v.y / RENDER_ZOOM)
+                              for v in box.vertices]
+                if not points:
+                    continue
+                xs = [point.x for point in points]
+                ys = [point.y for point in points]
+                yield text, fitz.Rect(min(xs), min(ys), max(xs), max(ys))
+
+def add_text_layer(page, annotation, fonts, top_crop, bottom_crop, render=None):
+    """Write the words of an annotation onto a page as invisible text (render mode 3),
+    each word stretched to its box so search hits and selections line up with the scan.
+    render is the zoom and angle the page image was rendered with, if known."""
+    clip = crop_rect(page, top_crop, bottom_crop) or page.rect
+    mat = render_matrix(render["zoom"], render["angle"]) if render else None
+    shape = page.new_shape()
+    inserted = set()
+    for text, rect in word_boxes(annotation, clip, mat):
+        if not text.strip() or rect.is_empty:
+            continue
+        script = word_script(text)
+        font = fonts[script]
+        if script not in inserted:
+            page.insert_font(fontname=script, fontbuffer=font.buffer)
+            inserted.add(script)
+
+        fontsize = rect.height * TEXT_LAYER_FONT_SCALE
+        width = font.text_length(text, fontsize=fontsize)
+        # Shapes take unrotated page coordinates, the boxes are in the rendered (rotated) view
+        origin = fitz.Point(rect.x0, rect.y1 - rect.height * (1 - TEXT_LAYER_FONT_SCALE)) * page.derotation_matrix
+        morph = None
+        if width:
+            # Stretch along the visual baseline, which is the page's y axis on 90/270 degree pages
+            scale = rect.width / width
+            morph = (origin, fitz.Matrix(scale, 1) if page.rotation % 180 == 0 else fitz.Matrix(1, scale))
+        # A trailing space keeps words apart in extracted text
+        shape.insert_text(origin, text + " ", fontsize=fontsize, fontname=script, render_mode=3,
+                          rotate=page.rotation, morph=morph)
+    shape.commit()
+
+def create_searchable_pdf(book):
+    """Copy the input PDF and add the stored annotation of every OCR'd page as an
+    invisible text layer. Pages are processed one at a time and the copy is saved
+    incrementally, so memory stays bounded and the original page images are untouched.
+    A repaired or broken input can't be saved incrementally and is written in full at the end."""
+    final_fname = os.path.join(book.output_folder, f"{book.name}_searchable.pdf")
+    tmp_path = f"{final_fname}.tmp"
+    full_tmp_path = f"{final_fname}.full.tmp"
+
+    fonts = {script: fitz.Font(script=code) for script, code in TEXT_LAYER_SCRIPTS.items()}
+    fonts["latin"] = fitz.Font(language="en")
+
+    pdf_document = None
+    layered = 0
+    try:
+        shutil.copyfile(book.pdf_path, tmp_path)
+        pdf_document = fitz.open(tmp_path)
+        incremental = pdf_document.can_save_incrementally()
+        if not incremental:
+            logger.warning(f"{book.pdf_path} was repaired when opened, the searchable PDF is written in full")
+        for page_num in tqdm(book.pages, desc="Creating searchable PDF", unit="page"):
+            try:
+                with open(annotation_filename(book, page_num), 'rb') as f:
+                    annotation = decode_annotation(f.read())
+            except FileNotFoundError:
+                # Text layer and failed pages stay as they are
+                continue
+            if not annotation.pages:
+                continue
+            # The crop the page was rendered with, which may differ from the current options
+            entry = book.manifest["pages"].get(str(page_num + 1), {})
+            params = entry.get("params", {})
+            top_crop, bottom_crop = entry.get("crop") or (params.get("top_crop", book.top_crop),
+                                                          params.get("bottom_crop", book.bottom_crop))
+            add_text_layer(pdf_document[page_num], annotation, fonts, top_crop, bottom_crop, entry.get("render"))
+            layered += 1
+            if incremental and layered % SEARCHABLE_SAVE_PAGES == 0:
+                pdf_document.save(tmp_path, incremental=True, encryption=fitz.PDF_ENCRYPT_KEEP)
+        if incremental:
+            pdf_document.save(tmp_path, incremental=True, encryption=fitz.PDF_ENCRYPT_KEEP)
+        else:
+            # A full save can't overwrite the file the document was opened from
+            pdf_document.save(full_tmp_path, garbage=1, deflate=True, encryption=fitz.PDF_ENCRYPT_KEEP)
+        pdf_document.close()
+        pdf_document = None
+        if not incremental:
+            os.replace(full_tmp_path, tmp_path)
     except Exception as e:
-        logger.error(f"Error converting to PDF: {e}")
+        logger.error(f"Error creating searchable PDF for {book.name}: {e}")
+        if pdf_document is not None:
+            pdf_document.close()
+        for path in (tmp_path, full_tmp_path):
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
         return None
 
-def main():
-    """Main execution function"""
+    os.replace(tmp_path, final_fname)
+    logger.info(f"Searchable PDF saved: {final_fname} ({layered} pages with a text layer)")
+    return final_fname
+
+def word_accuracy(reference, text):
+    """Share of the reference words found, in order, in text"""
+    reference_words = reference.split()
+    if not reference_words:
+        return 1.0
+    matcher = SequenceMatcher(None, reference_words, text.split(), autojunk=False)
+    return sum(block.size for block in matcher.get_matching_blocks()) / len(reference_words)
+
+def dpi_report(book, options):
+    """OCR a sample of pages at the fixed DPI_REPORT_ZOOMS and at the adaptive zoom,
+    and report image bytes, OCR time and word accuracy against the highest zoom.
+    Written to <name>_dpi_report.json in the output folder."""
+    pdf_document = fitz.open(book.pdf_path)
+    first = book.start_page if book.start_page is not None else 0
+    last = book.end_page if book.end_page is not None else len(pdf_document) - 1
+    last = min(last, len(pdf_document) - 1)
+    count = min(options.dpi_report, last - first + 1)
+    # Spread the samples evenly over the page range
+    samples = sorted({first + (i * (last - first + 1)) // count for i in range(count)})
+    logger.info(f"DPI report for {book.name}: {len(samples)} sample pages, "
+                f"{len(samples) * (len(DPI_REPORT_ZOOMS) + 1)} OCR requests")
+
+    settings = [(f"{zoom}x", zoom) for zoom in DPI_REPORT_ZOOMS] + [("adaptive", None)]
+    results = {name: {"bytes": [], "seconds": [], "accuracy": [], "zoom": []} for name, _ in settings}
+    pages = []
+    for page_num in tqdm(samples, desc="DPI report", unit="page"):
+        page = pdf_document[page_num]
+        clip = crop_rect(page, book.top_crop, book.bottom_crop)
+        auto_zoom, angle = analyse_page(page, clip, True, options.deskew, options.target_x_height)
+        texts = {}
+        for name, zoom in settings:
+            zoom = zoom or auto_zoom
+            img_bytes = encode_pixmap(render_pixmap(page, clip, zoom, angle, options), options)
+            step = time.perf_counter()
+            annotation = ocr_backend.annotate(img_bytes, f"{page_label(book, page_num)} at {zoom}x", {})
+            seconds = time.perf_counter() - step
+            texts[name] = annotation_to_text(decode_annotation(annotation)) if annotation else ""
+            results[name]["bytes"].append(len(img_bytes))
+            results[name]["seconds"].append(seconds)
+            results[name]["zoom"].append(zoom)
+
+        reference = texts[f"{max(DPI_REPORT_ZOOMS)}x"]
+        for name, _ in settings:
+            results[name]["accuracy"].append(word_accuracy(reference, texts[name]))
+        pages.append({"page": page_num + 1, "auto_zoom": auto_zoom, "angle": angle,
+                      "accuracy": {name: results[name]["accuracy"][-1] for name, _ in settings}})
+    pdf_document.close()
+
+    summary = {}
+    logger.info(f"{'setting':<10} {'zoom':>6} {'DPI':>6} {'KB/page':>9} {'OCR s':>7} {'accuracy':>9}")
+    for name, _ in settings:
+        values = results[name]
+        zoom = sum(values["zoom"]) / len(values["zoom"])
+        summary[name] = {
+            "zoom": zoom,
+            "dpi": zoom * 72,
+            "bytes_per_page": sum(values["bytes"]) / len(values["bytes"]),
+            "seconds_per_page": sum(values["seconds"]) / len(values["seconds"]),
+            "accuracy": sum(values["accuracy"]) / len(values["accuracy"]),
+        }
+        logger.info(f"{name:<10} {zoom:>6.2f} {zoom * 72:>6.0f} {summary[name]['bytes_per_page'] / 1024:>9.1f} "
+                    f"{summary[name]['seconds_per_page']:>7.2f} {summary[name]['accuracy']:>9.1%}")
+
+    os.makedirs(book.output_folder, exist_ok=True)
+    report_path = os.path.join(book.output_folder, f"{book.name}_dpi_report.json")
+    with open(report_path, 'w', encoding='utf-8') as f:
+        json.dump({"reference": f"{max(DPI_REPORT_ZOOMS)}x", "target_x_height": options.target_x_height,
+                   "settings": summary, "pages": pages}, f, indent=1)
+    logger.info(f"DPI report written to {report_path}")
+
+def list_text_files(book):
+    """Return the individual page files and the combined file written while extracting"""
+    if not book.pages:
+        logger.warning(f"No text to save for {book.name}!")
+        return None, None
+
+    page_files = [page_filename(book, p) for p in book.pages if os.path.exists(page_filename(book, p))]
+    combined = combined_filename(book)
+    return page_files, combined if os.path.exists(combined) else None
+
+def reset_run_state(options):
+    """Clear the counters and measurements of an earlier run in the same process.
+    The Vision client, the rate limiter and the adaptive concurrency stay warm."""
+    global upload_bytes, upload_pages
+    global request_count, retry_count, throttle_count, duplicate_index, memory_budget
+    with upload_lock:
+        upload_bytes = upload_pages = 0
+    with concurrency_cond:
+        request_count = retry_count = throttle_count = 0
+    with metrics_lock:
+        page_metrics.clear()
+    duplicate_index = None
+    memory_budget = MemoryBudget(options.memory_budget_bytes)
+
+def run(options=None, parser=None):
+    """Run the tool with an Options object, or with command line options given as
+    a list, e.g. run(["-f", "book.pdf", "-s", "10", "-e", "12"]), parsed with
+    parser if given. Returns the statistics of the run, None if nothing could be
+    processed."""
+    if not isinstance(options, Options):
+        _, options = parse_args(options, parser)
+    return execute(options)
+
+def execute(options):
+    """Process the books of the options. Returns the statistics of the run, None
+    if nothing could be processed. Raises ValueError for options that can't be
+    used together. Runs started from several threads wait for each other."""
+    options.check()
+    with run_lock:
+        return process_books(options)
+
+def process_books(options):
+    """Body of execute(), called with run_lock held"""
+    global ocr_backend, ocr_cache, duplicate_index
     start = time.time()
-    
-    # Parse command line arguments first
-    parse_args()
+    reset_run_state(options)
 
     logger.info("=== PDF Text Extraction Tool (PyMuPDF + Vision API) ===")
-    logger.info(f"Processing file: {BASE_FILE}")
-    if START_PAGE is not None or END_PAGE is not None:
-        start_display = (START_PAGE + 1) if START_PAGE is not None else "first"
-        end_display = (END_PAGE + 1) if END_PAGE is not None else "last"
-        logger.info(f"Page range: {start_display} to {end_display}")
-
-    # Check if input file exists
-    if not os.path.exists(BASE_FILE):
-        logger.error(f"Input file not found: {BASE_FILE}")
-        return
+    books = []
+    for book in options.books:
+        logger.info(f"Processing file: {book.pdf_path}")
+        if book.start_page is not None or book.end_page is not None:
+            start_display = (book.start_page + 1) if book.start_page is not None else "first"
+            end_display = (book.end_page + 1) if book.end_page is not None else "last"
+            logger.info(f"Page range: {start_display} to {end_display}")
+
+        # Check if input file exists
+        if not os.path.exists(book.pdf_path):
+            logger.error(f"Input file not found: {book.pdf_path}")
+            continue
+        books.append(book)
+
+    if not books:
+        return None
+
+    # Offline: only the stored annotations of an earlier run are needed
+    if options.rerender:
+        rerendered = 0
+        for book in books:
+            if not rerender_book(book, options):
+                continue
+            rerendered += 1
+            if options.searchable_pdf:
+                create_searchable_pdf(book)
+        return {"books": rerendered} if rerendered else None
+
+    # Offline: assemble books processed in shards
+    if options.merge:
+        # Only for the OCR parameters the shards are checked against
+        ocr_backend = create_ocr_backend(options)
+        merged = 0
+        try:
+            for book in books:
+                if not merge_book(book, options):
+                    continue
+                merged += 1
+                if options.searchable_pdf:
+                    create_searchable_pdf(book)
+        finally:
+            ocr_backend.close()
+        return {"books": merged} if merged == len(books) else None
 
     # Initialize
     logger.info("Initializing...")
-    init()
+    ocr_cache = OcrCache(options.cache_folder, options.cache_max_bytes)
+    ocr_backend = create_ocr_backend(options)
+    logger.info(f"Using OCR backend: {ocr_backend.name}")
+    if options.skip_duplicates:
+        duplicate_index = DuplicateIndex(options.duplicate_distance)
+
+    if options.dpi_report:
+        try:
+            for book in books:
+                dpi_report(book, options)
+        finally:
+            ocr_backend.close()
+        return {"books": len(books)}
 
     try:
         # Step 1: Extract text from all pages
         logger.info("--- Step 1: Extracting text from PDF pages ---")
-        page_texts = extract_text_from_pdf_parallel()
+        books = [book for book in extract_text_from_books(books, options) if book.pages]
 
-        if not page_texts:
+        if not books:
             logger.warning("No text extracted. Exiting...")
-            return
-
-        # Step 2: Save extracted text to files
-        logger.info("--- Step 2: Saving extracted text to files ---")
-        page_files, combined_file = save_text_files(page_texts)
+            return None
 
         # Summary
         end = time.time()
         total_time = end - start
         minutes = int(total_time // 60)
         seconds = int(total_time % 60)
+        total_pages = sum(len(book.pages) for book in books)
 
         logger.info("=== PROCESSING COMPLETED ===")
         logger.info(f"Total processing time: {minutes}m {seconds}s ({total_time:.1f} seconds)")
-        logger.info(f"Output files created in: {OUTPUT_FOLDER}")
-        
-        if page_files:
-            logger.info(f"  - Individual page files: {len(page_files)} files (page_XXX.txt)")
-        if combined_file:
-            logger.info(f"  - Combined file: {os.path.basename(combined_file)}")
+
+        # Step 2: Pages and the combined file were saved while extracting
+        total_chars = 0
+        for book in books:
+            page_files, combined_file = list_text_files(book)
+            book_chars = sum(len(load_page_text(book, p)) for p in book.pages)
+            total_chars += book_chars
+
+            logger.info(f"Output files created in: {book.output_folder}")
+            if page_files:
+                logger.info(f"  - Individual page files: {len(page_files)} files (page_XXX.txt)")
+            if combined_file:
+                logger.info(f"  - Combined file: {os.path.basename(combined_file)}")
+            if len(books) > 1:
+                logger.info(f"  - Pages: {len(book.pages)}, characters: {book_chars:,}")
+
+            failed = [int(p) for p, entry in book.manifest["pages"].items()
+                      if entry.get("status") == "failed" and int(p) - 1 in book.pages]
+            if failed:
+                rerun = f"--shard {options.shard.spec}" if options.shard else "--resume"
+                logger.warning(f"  - Failed pages: {len(failed)} ({', '.join(str(p) for p in sorted(failed))}), rerun with {rerun}")
+
+            # The docx and searchable PDF of a sharded book are made by --merge
+            if options.shard:
+                logger.info(f"  - Shard {options.shard.spec} done, assemble the book with --merge once all shards are done")
+                continue
+            if options.docx:
+                logger.info(f"  - DOCX file: {os.path.basename(docx_filename(book))}")
+            if options.searchable_pdf:
+                create_searchable_pdf(book)
 
         # Calculate some stats
-        total_chars = sum(len(text) for text in page_texts)
-        avg_time_per_page = total_time / len(page_texts) if page_texts else 0
+        avg_time_per_page = total_time / total_pages if total_pages else 0
+        pages_per_minute = total_pages / total_time * 60 if total_time else 0
 
         logger.info("Statistics:")
-        logger.info(f"  - Pages processed: {len(page_texts)}")
+        if len(books) > 1:
+            logger.info(f"  - Books processed: {len(books)}")
+        logger.info(f"  - Pages processed: {total_pages}")
         logger.info(f"  - Total characters extracted: {total_chars:,}")
         logger.info(f"  - Average time per page: {avg_time_per_page:.1f} seconds")
+        logger.info(f"  - Throughput: {pages_per_minute:.1f} pages per minute")
+        if ocr_cache.folder:
+            logger.info(f"  - OCR cache hits: {ocr_cache.hits}")
+            logger.info(f"  - OCR cache misses: {ocr_cache.misses}")
+            logger.info(f"  - OCR cache size: {ocr_cache.size_bytes / (1024 * 1024):.1f} MB")
+        logger.info(f"  - Vision requests: {request_count} ({retry_count} retries, {throttle_count} throttled)")
+        logger.info(f"  - Final Vision concurrency: {concurrency_limit}")
+        if memory_budget.peak_pages:
+            logger.info(f"  - Page images in flight: peak {memory_budget.peak_bytes / (1024 * 1024):.1f} MB, "
+                        f"{memory_budget.peak_pages} pages"
+                        + (f" (budget {options.memory_budget_bytes / (1024 * 1024):.0f} MB)"
+                           if options.memory_budget_bytes else ""))
+        if upload_pages:
+            logger.info(f"  - Image bytes sent ({options.image_format}): {upload_bytes / (1024 * 1024):.1f} MB, "
+                        f"{upload_bytes / upload_pages / 1024:.1f} KB per page")
+        latencies = [m["latency"] for m in page_metrics.values() if "latency" in m]
+        if latencies:
+            logger.info(f"  - Page latency: p50 {percentile(latencies, 50):.2f}s, p99 {percentile(latencies, 99):.2f}s")
+        summary = summarize_reports([record for book in books for record in book.reports])
+        for stage, values in summary["stages"].items():
+            if stage in ("latency", "upload_bytes", "retries", "zoom", "angle"):
+                continue
+            logger.info(f"  - Stage {stage}: p50 {values['p50'] * 1000:.1f}ms, p99 {values['p99'] * 1000:.1f}ms, "
+                        f"total {values['total']:.1f}s")
+        if options.adaptive_dpi and "zoom" in summary["stages"]:
+            zooms = summary["stages"]["zoom"]
+            logger.info(f"  - Render zoom: p50 {zooms['p50']}x ({zooms['p50'] * 72:.0f} DPI), max {zooms['max']}x")
+        logger.info(f"  - Estimated Vision cost: ${summary['estimated_cost_usd']:.2f} "
+                    f"({summary['vision_units']} images at ${VISION_PRICE_PER_1000:.2f} per 1000)")
+        skipped = summary["skipped_blank"] + summary["skipped_duplicate"]
+        if skipped:
+            logger.info(f"  - Pages not sent for OCR: {summary['skipped_blank']} blank, "
+                        f"{summary['skipped_duplicate']} duplicates "
+                        f"(${skipped * VISION_PRICE_PER_1000 / 1000:.2f} saved)")
+        for book in books:
+            logger.info(f"  - Page report: {report_filename(book)}")
+
+        stats = {
+            "books": len(books),
+            "pages": total_pages,
+            "ocr_pages": len(latencies),
+            "failed_pages": sum(len(book.failed_pages) for book in books),
+            "seconds": total_time,
+            "pages_per_second": total_pages / total_time if total_time else 0,
+            "latency_p50": percentile(latencies, 50),
+            "latency_p99": percentile(latencies, 99),
+            "requests": request_count,
+            "retries": retry_count,
+            "throttled": throttle_count,
+            "cache_hits": ocr_cache.hits,
+            "cache_misses": ocr_cache.misses,
+            "upload_bytes": upload_bytes,
+            "peak_in_flight_bytes": memory_budget.peak_bytes,
+            "peak_in_flight_pages": memory_budget.peak_pages,
+            "vision_units": summary["vision_units"],
+            "estimated_cost_usd": summary["estimated_cost_usd"],
+            "skipped_blank": summary["skipped_blank"],
+            "skipped_duplicate": summary["skipped_duplicate"],
+            "stages": summary["stages"],
+        }
+        if options.stats_json:
+            with open(options.stats_json, 'w', encoding='utf-8') as f:
+                json.dump(stats, f, indent=1)
+            logger.info(f"Statistics written to {options.stats_json}")
+        return stats
 
     except KeyboardInterrupt:
         logger.info("Process interrupted by user. Cleaning up...")
     except Exception as e:
         logger.error(f"Unexpected error: {e}")
+    finally:
+        ocr_backend.close()
+        if duplicate_index is not None:
+            duplicate_index.close()
+    return None
+
+def service_parser():
+    """Argument parser for service jobs, raising ValueError for invalid options
+    instead of exiting the service. Without -h, which would print the help on
+    the service's stdout and exit."""
+    parser = build_parser(add_help=False)
+
+    def error(message):
+        raise ValueError(message)
+
+    parser.error = error
+    return parser
+
+class ServiceJob:
+    """A run of the tool queued in service mode"""
+
+    def __init__(self, job_id, argv, cwd):
+        self.id = job_id
+        self.argv = argv
+        self.cwd = cwd
+        self.status = "queued"
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.stats = None
+        self.error = None
+        self.log = []
+        self.done = threading.Event()
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "args": self.argv,
+            "cwd": self.cwd,
+            "status": self.status,
+            "submitted": self.submitted,
+            "started": self.started,
+            "finished": self.finished,
+            "stats": self.stats,
+            "error": self.error,
+            "log": self.log,
+        }
+
+class JobLogHandler(logging.Handler):
+    """Keeps the last SERVICE_LOG_LINES log lines of the running job"""
+
+    def __init__(self, lines):
+        super().__init__()
+        self.lines = lines
+        self.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+
+    def emit(self, record):
+        self.lines.append(self.format(record))
+        del self.lines[:-SERVICE_LOG_LINES]
+
+class JobQueue:
+    """Jobs of the service. They run one at a time on a worker thread, since a
+    run keeps its counters in module globals."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.jobs = {}
+        self.pending = queue.Queue()
+        self.next_id = 1
+
+    def submit(self, argv, cwd):
+        """Queue a job after checking its options, raises ValueError if they are invalid"""
+        args, _ = parse_args(argv, service_parser())
+        if args.serve or args.server:
+            raise ValueError("--serve and --server can't be used in a job")
+        with self.lock:
+            job = ServiceJob(self.next_id, argv, cwd)
+            self.jobs[job.id] = job
+            self.next_id += 1
+            # Forget the oldest finished jobs
+            finished = [job_id for job_id, other in self.jobs.items() if other.done.is_set()]
+            for job_id in finished[:max(0, len(finished) - SERVICE_KEEP_JOBS)]:
+                del self.jobs[job_id]
+        self.pending.put(job)
+        return job
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def list(self):
+        with self.lock:
+            return [{key: value for key, value in job.to_dict().items() if key != "log"}
+                    for job in self.jobs.values()]
+
+    def work(self):
+        """Worker thread: run queued jobs forever"""
+        while True:
+            self.run_job(self.pending.get())
+
+    def run_job(self, job):
+        job.status = "running"
+        job.started = time.time()
+        handler = JobLogHandler(job.log)
+        logger.addHandler(handler)
+        cwd = os.getcwd()
+        try:
+            # Relative paths in the options are relative to the submitter
+            os.chdir(job.cwd)
+            job.stats = run(job.argv, service_parser())
+            job.status = "done" if job.stats is not None else "failed"
+        except (Exception, SystemExit) as e:
+            logger.error(f"Job {job.id} failed: {e}")
+            job.status = "failed"
+            job.error = str(e)
+            # A crashed render worker breaks the pool, start a fresh one
+            close_render_pool()
+        finally:
+            os.chdir(cwd)
+            logger.removeHandler(handler)
+            job.finished = time.time()
+            job.done.set()
+        logger.info(f"Job {job.id} {job.status} in {job.finished - job.started:.1f}s")
+
+def make_service_handler(jobs):
+    """HTTP request handler of the service:
+    POST /jobs {"args": [...], "cwd": ..., "wait": true} as application/json
+    queues a job, with wait the response is sent when it is finished; requests
+    with an Origin header, i.e. from a browser, are refused. GET /jobs lists the jobs and
+    GET /jobs/<id> returns one with its log."""
+    class ServiceHandler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            logger.debug(f"Service request: {format % args}")
+
+        def send_json(self, status, body):
+            data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            path = self.path.rstrip("/")
+            if path == "/jobs":
+                self.send_json(200, jobs.list())
+                return
+            job_id = path[len("/jobs/"):] if path.startswith("/jobs/") else ""
+            job = jobs.get(int(job_id)) if job_id.isdigit() else None
+            if job is None:
+                self.send_json(404, {"error": f"Unknown job {self.path}"})
+            else:
+                self.send_json(200, job.to_dict())
+
+        def do_POST(self):
+            if self.path.rstrip("/") != "/jobs":
+                self.send_json(404, {"error": f"Unknown path {self.path}"})
+                return
+            # A web page can POST a form to localhost but can't send JSON without
+            # a CORS preflight, and browsers always send Origin on cross-site requests
+            if self.headers.get("Origin") is not None:
+                self.send_json(403, {"error": "Requests from web pages are not accepted"})
+                return
+            if self.headers.get_content_type() != "application/json":
+                self.send_json(415, {"error": "Content-Type must be application/json"})
+                return
+            try:
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                if not isinstance(body, dict):
+                    raise ValueError("The request body must be a JSON object")
+                args = body.get("args", [])
+                cwd = body.get("cwd") or os.getcwd()
+                if not isinstance(args, list) or not isinstance(cwd, str):
+                    raise ValueError("args must be a list and cwd a string")
+                job = jobs.submit([str(arg) for arg in args], cwd)
+            except ValueError as e:
+                self.send_json(400, {"error": str(e)})
+                return
+            if body.get("wait"):
+                job.done.wait()
+                self.send_json(200, job.to_dict())
+            else:
+                self.send_json(202, job.to_dict())
+
+    return ServiceHandler
+
+def serve(port):
+    """Service mode: accept jobs over HTTP on localhost and run them one at a
+    time, keeping the Google libraries, the Vision client with its connection
+    pool and the render workers with their open PDFs warm between jobs"""
+    global keep_render_pool
+    keep_render_pool = True
+    # Import the Google libraries now instead of in the first job
+    vision.TextAnnotation
+
+    jobs = JobQueue()
+    threading.Thread(target=jobs.work, daemon=True).start()
+    server = ThreadingHTTPServer(("127.0.0.1", port), make_service_handler(jobs))
+    server.daemon_threads = True
+    logger.info(f"Serving OCR jobs on http://127.0.0.1:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.info("Service stopped")
+    finally:
+        server.server_close()
+        close_render_pool()
+
+def strip_option(argv, option):
+    """Command line arguments without an option and its value"""
+    stripped = []
+    skip = False
+    for arg in argv:
+        if skip:
+            skip = False
+        elif arg == option:
+            skip = True
+        elif not arg.startswith(option + "="):
+            stripped.append(arg)
+    return stripped
+
+def submit_job(server, argv):
+    """Run a job on a service started with --serve and print its log. Returns the exit status."""
+    body = json.dumps({"args": argv, "cwd": os.getcwd(), "wait": True}).encode('utf-8')
+    request = urllib.request.Request(f"{server.rstrip('/')}/jobs", data=body,
+                                     headers={"Content-Type": "application/json"})
+    try:
+        with urllib.request.urlopen(request) as response:
+            job = json.load(response)
+    except urllib.error.HTTPError as e:
+        logger.error(f"Service rejected the job: {json.load(e).get('error', e)}")
+        return 2
+    except OSError as e:
+        logger.error(f"Could not reach the service at {server}: {e}")
+        return 1
+
+    for line in job["log"]:
+        print(line)
+    if job["status"] != "done":
+        logger.error(f"Job {job['id']} failed{': ' + job['error'] if job['error'] else ''}")
+        return 1
+    return 0
+
+def main():
+    """Command line entry point: process the books, run the service with --serve
+    or hand the job to a running service with --server"""
+    argv = sys.argv[1:]
+    args, options = parse_args(argv)
+    if args.serve:
+        serve(args.port)
+    elif args.server:
+        sys.exit(submit_job(args.server, strip_option(argv, "--server")))
+    else:
+        execute(options)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file